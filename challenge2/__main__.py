@@ -0,0 +1,10 @@
+import os
+import sys
+
+# i moduli di questa cartella si importano tra loro come moduli di primo livello
+# (import pointcloud_preprocessor, ...), come quando si lancia main.py da qui dentro
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import cli
+
+cli.main()
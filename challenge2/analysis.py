@@ -0,0 +1,230 @@
+import os
+
+import numpy as np
+
+import pointcloud_preprocessor as pcpp
+import pcd_cache
+import annotation_index
+import streaming
+import spatial_index
+import parallel
+import instrumentation
+
+# =========================================================
+# Pipeline di analisi "headless"
+# =========================================================
+
+# Stessa analisi di main.py (approssimazione di tronco e rami + feature dei rami), ma
+# senza nessuna finestra Open3D e senza costruire LineSet/cilindri: è quello che gira
+# sui nodi di calcolo senza GPU né display (vedi cli.py).
+
+BRANCH_CLASS = "Branch 1"
+TREE_CLASS = "Tree"
+
+
+def scan_name(pcd_path):
+    """
+    Nome leggibile di una scansione: "<dataset>/<file>" se il PCD sta nella struttura
+    Supervisely (dataset/pointcloud/file.pcd), altrimenti solo il nome del file.
+    """
+    pcd_path = os.path.abspath(pcd_path)
+    folder = os.path.dirname(pcd_path)
+    if os.path.basename(folder) == "pointcloud":
+        return os.path.basename(os.path.dirname(folder)) + "/" + os.path.basename(pcd_path)
+    return os.path.basename(pcd_path)
+
+
+@instrumentation.timed()
+def load_scan(pcd_path, ann_path):
+    """
+    Carica punti, colori e indice delle annotazioni di una scansione (passando dalle cache).
+
+    Ritorna (nel formato compatto, vedi pointcloud_preprocessor):
+        - points: array (N,3) float32 (mappato dalla cache, non copiato in memoria)
+        - colors: array (N,3) uint8 (grigio se il PCD non ha colori)
+        - index: AnnotationIndex
+    """
+    xyz, rgb = pcd_cache.load_point_cloud(pcd_path)
+    points = pcpp.compact_points(xyz)
+    colors = rgb if rgb is not None else np.full(points.shape, 128, dtype=pcpp.COLOR_DTYPE)
+    index = annotation_index.load_annotation_index(ann_path)
+    return points, colors, index
+
+
+@instrumentation.timed()
+def approximate_trees(points, colors, index, tolerance=None):
+    """
+    Approssima con una polilinea ogni oggetto tronco (con segmenti adattivi se è data
+    tolerance, vedi pcpp.adaptive_segments).
+
+    Ritorna:
+        - lista di dizionari {"object", "principal_component", "centers"} (uno per tronco approssimabile)
+    """
+    trees = []
+    for tree_obj in index.objects_of_class(TREE_CLASS):
+        tree_indices = index.object_indices(tree_obj)
+        if len(tree_indices) < 2:
+            continue
+        res = pcpp.approximate_branch(points[tree_indices], colors[tree_indices], with_pc_line=False,
+                                      mode="binned" if tolerance is None else "adaptive", tolerance=tolerance)
+        _, _, tree_dir, centers, _ = res
+        if centers is None:
+            continue
+        trees.append({"object": int(tree_obj), "principal_component": tree_dir, "centers": centers})
+    return trees
+
+
+def branch_table(points, colors, indices, offsets, tree_dir, tolerance=None, robust_samples=None, workers=1):
+    """
+    Tabella delle feature dei rami (vedi BranchBatch.compute), nel processo corrente se
+    workers è 1, altrimenti su workers processi (0 o None: tutti i core, vedi
+    parallel.parallel_branch_table).
+    """
+    if workers == 1:
+        return pcpp.BranchBatch.from_indices(points, colors, indices, offsets, tolerance=tolerance,
+                                             robust_samples=robust_samples).compute(tree_dir)
+    return parallel.parallel_branch_table(points, colors, indices, offsets, tree_dir, workers=workers,
+                                          tolerance=tolerance, robust_samples=robust_samples)
+
+
+def attach_trunks(table, trees):
+    """Aggancia i rami della tabella ai segmenti delle polilinee dei tronchi (vedi spatial_index)."""
+    trunk_index = spatial_index.SegmentIndex.from_polylines([t["centers"] for t in trees])
+    return spatial_index.attach_trunk_segments(table, trunk_index)
+
+
+@instrumentation.timed()
+def analyze_scan(pcd_path, ann_path, streaming_chunk_size=None, tolerance=None, robust_samples=None, workers=1):
+    """
+    Analizza una scansione: approssimazione di tronchi e rami e feature dei rami.
+
+    Parametri:
+        - pcd_path, ann_path: file .pcd e relativo ann/*.pcd.json
+        - streaming_chunk_size: se dato, la nuvola viene letta a blocchi di questa
+          dimensione (vedi streaming.py) invece di essere caricata tutta in memoria
+        - tolerance: se data, segmentazione adattiva di rami e tronchi con questa tolleranza
+          in metri (vedi pcpp.adaptive_segments) invece di k intervalli uguali; il numero
+          di segmenti varia da ramo a ramo. Non disponibile in streaming
+        - robust_samples: se dato, assi e diametri dei rami vengono da una PCA robusta
+          agli outlier (foglie, fili) su al più robust_samples punti per ramo e per segmento
+          (vedi pcpp.robust_covariances). Non disponibile in streaming
+        - workers: numero di processi su cui distribuire i rami (vedi branch_table);
+          1 = tutto nel processo corrente. Non disponibile in streaming
+
+    Ritorna:
+        Un dizionario con:
+            - scan: nome della scansione
+            - index: AnnotationIndex
+            - branch_objects: posizioni (nell'indice) dei rami, nell'ordine della tabella
+            - table: tabella colonnare delle feature (vedi BranchBatch.compute)
+            - tree_dir: direzione globale del tronco (usata per le inclinazioni dei rami
+              che non si possono agganciare a un segmento di tronco)
+            - trees: polilinee dei tronchi (vedi approximate_trees)
+    """
+    if streaming_chunk_size is None:
+        points, colors, index = load_scan(pcd_path, ann_path)
+        return analyze_loaded(scan_name(pcd_path), points, colors, index, tolerance=tolerance,
+                              robust_samples=robust_samples, workers=workers)
+    if tolerance is not None:
+        raise ValueError("la segmentazione adattiva non è disponibile in streaming")
+    if robust_samples is not None:
+        raise ValueError("la PCA robusta non è disponibile in streaming")
+    if workers != 1:
+        raise ValueError("l'elaborazione su più processi non è disponibile in streaming")
+
+    index = annotation_index.load_annotation_index(ann_path)
+    branch_objects = index.objects_of_class(BRANCH_CLASS)
+    table, tree_dir, trees = streaming.stream_branch_features(
+        pcd_path, index, branch_objects, index.objects_of_class(TREE_CLASS),
+        chunk_size=streaming_chunk_size)
+    # come in memoria: inclinazione rispetto al segmento di tronco più vicino alla base
+    attach_trunks(table, trees)
+    result = {
+        "scan": scan_name(pcd_path),
+        "index": index,
+        "branch_objects": branch_objects,
+        "table": table,
+        "tree_dir": tree_dir,
+        "trees": trees,
+    }
+    record_branch_counters(result)
+    return result
+
+
+@instrumentation.timed()
+def analyze_loaded(scan, points, colors, index, tolerance=None, robust_samples=None, workers=1):
+    """
+    Come analyze_scan (modalità in memoria), per una scansione già caricata con load_scan.
+    """
+    trees = approximate_trees(points, colors, index, tolerance=tolerance)
+    # come in main.py: si usa la direzione dell'ultimo tronco
+    tree_dir = trees[-1]["principal_component"] if trees else np.array([0.0, 0.0, 1.0])
+    branch_objects = index.objects_of_class(BRANCH_CLASS)
+    branch_indices, branch_offsets = index.subset(branch_objects)
+    table = branch_table(points, colors, branch_indices, branch_offsets, tree_dir,
+                         tolerance=tolerance, robust_samples=robust_samples, workers=workers)
+
+    # inclinazione rispetto al segmento di tronco più vicino alla base di ogni ramo
+    attach_trunks(table, trees)
+
+    result = {
+        "scan": scan,
+        "index": index,
+        "branch_objects": branch_objects,
+        "table": table,
+        "tree_dir": tree_dir,
+        "trees": trees,
+    }
+    record_branch_counters(result)
+    return result
+
+
+def record_branch_counters(result):
+    """Contatori per ramo (punti e segmenti) per instrumentation, se attiva."""
+    if instrumentation.active() is None:
+        return
+    table, index = result["table"], result["index"]
+    instrumentation.add_items(
+        "branch",
+        scan=[result["scan"]] * len(result["branch_objects"]),
+        object_key=index.object_keys[result["branch_objects"]],
+        num_points=table["num_points"],
+        num_segments=np.diff(table["segment_offsets"]),
+        valid=table["valid"],
+    )
+
+
+def segment_rows(result):
+    """
+    Appiattisce il risultato di analyze_scan in righe (una per segmento di ogni ramo valido),
+    con le feature del ramo ripetute su ogni riga.
+    """
+    table, index = result["table"], result["index"]
+    rows = []
+    for b, obj in enumerate(result["branch_objects"]):
+        if not table["valid"][b]:
+            continue
+        insertion = table["insertion_point"][b] if "insertion_point" in table else np.full(3, np.nan)
+        for s in range(table["segment_offsets"][b], table["segment_offsets"][b+1]):
+            center = table["segment_centers"][s]
+            color = table["mean_colors"][s]
+            rows.append({
+                "scan": result["scan"],
+                "object_key": str(index.object_keys[obj]),
+                "segment_index": int(s - table["segment_offsets"][b]),
+                "segment_num_points": int(table["segment_num_points"][s]),
+                "diameter": float(table["diameters"][s]),
+                "center_x": float(center[0]),
+                "center_y": float(center[1]),
+                "center_z": float(center[2]),
+                "mean_r": float(color[0]),
+                "mean_g": float(color[1]),
+                "mean_b": float(color[2]),
+                "branch_num_points": int(table["num_points"][b]),
+                "branch_length": float(table["branch_length"][b]),
+                "inclination_angle": float(table["inclination_angle"][b]),
+                "insertion_x": float(insertion[0]),
+                "insertion_y": float(insertion[1]),
+                "insertion_z": float(insertion[2]),
+            })
+    return rows
@@ -0,0 +1,236 @@
+import json
+import os
+
+import numpy as np
+
+import pcd_cache
+import instrumentation
+
+# =========================================================
+# Indice oggetto -> punti delle annotazioni Supervisely
+# =========================================================
+
+# Il file ann/*.pcd.json contiene:
+# - "objects": gli oggetti annotati (key, classTitle, updatedAt, ...)
+# - "figures": le figure, ognuna con l'objectKey dell'oggetto a cui appartiene e gli
+#   indici dei punti in geometry.indices. Un oggetto può essere spezzato in più figure.
+#
+# main.py cercava l'oggetto di ogni figura con una scansione lineare di data["objects"]
+# (O(figure * oggetti)) e accumulava gli indici in liste Python.
+#
+# Qui il JSON viene letto una volta sola e trasformato in formato CSR
+# (Compressed Sparse Row):
+# - indices: un unico array int32 con gli indici dei punti di tutti gli oggetti,
+#   raggruppati per oggetto (nell'ordine delle figure, come con defaultdict(list).extend)
+# - offsets: array (num_oggetti+1,): i punti dell'oggetto i sono
+#   indices[offsets[i]:offsets[i+1]]
+# - class_ids: id della classe di ogni oggetto, preso da meta.json
+#
+# L'indice viene salvato in un .npz accanto al JSON: riaprire una scansione già
+# indicizzata non richiede più json.load.
+
+INDEX_SUFFIX = ".index.npz"
+INDEX_VERSION = 2
+
+
+def find_meta_path(ann_path):
+    """
+    Cerca meta.json risalendo le cartelle a partire dal file di annotazione
+    (struttura Supervisely: progetto/meta.json, progetto/dataset/ann/*.pcd.json).
+    """
+    folder = os.path.dirname(os.path.abspath(ann_path))
+    for _ in range(4):
+        candidate = os.path.join(folder, "meta.json")
+        if os.path.exists(candidate):
+            return candidate
+        folder = os.path.dirname(folder)
+    return None
+
+
+def default_index_path(ann_path):
+    return os.fspath(ann_path) + INDEX_SUFFIX
+
+
+class AnnotationIndex:
+    """
+    Indice CSR degli oggetti annotati in una pointcloud.
+
+    Attributi:
+        - object_keys: array (num_oggetti,) delle key degli oggetti
+        - object_updated_at: array (num_oggetti,) dei timestamp updatedAt
+        - class_ids: array int32 (num_oggetti,) con l'id (meta.json) della classe di ogni oggetto
+        - indices: array int32 con gli indici dei punti, raggruppati per oggetto
+        - offsets: array int64 (num_oggetti+1,)
+        - classes: dizionario titolo classe -> id
+        - ann_key: key dell'annotazione (campo "key" del JSON, mappato in key_id_map.json)
+    """
+
+    def __init__(self, object_keys, object_updated_at, class_ids, indices, offsets, classes, ann_key=""):
+        self.object_keys = np.asarray(object_keys)
+        self.object_updated_at = np.asarray(object_updated_at)
+        self.class_ids = np.asarray(class_ids, dtype=np.int32)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.classes = dict(classes)
+        self.ann_key = str(ann_key)
+        self._key_to_object = {k: i for i, k in enumerate(self.object_keys.tolist())}
+
+    def __len__(self):
+        return len(self.object_keys)
+
+    @classmethod
+    @instrumentation.timed("AnnotationIndex.from_json")
+    def from_json(cls, ann_path, meta_path=None):
+        """Costruisce l'indice leggendo il JSON delle annotazioni (e meta.json per gli id delle classi)."""
+        with open(ann_path, "r") as f:
+            data = json.load(f)
+
+        meta_path = meta_path or find_meta_path(ann_path)
+        classes = {}
+        if meta_path is not None:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            classes = {c["title"]: int(c["id"]) for c in meta.get("classes", [])}
+
+        objects = data.get("objects", [])
+        # classi non presenti in meta.json: id negativi, così restano distinguibili
+        for o in objects:
+            if o["classTitle"] not in classes:
+                classes[o["classTitle"]] = -(len(classes) + 1)
+
+        key_to_object = {o["key"]: i for i, o in enumerate(objects)}
+        figures = [fig for fig in data.get("figures", []) if fig["objectKey"] in key_to_object]
+        fig_object = np.array([key_to_object[fig["objectKey"]] for fig in figures], dtype=np.int64)
+        fig_arrays = [np.asarray(fig["geometry"]["indices"], dtype=np.int32) for fig in figures]
+        fig_counts = np.array([len(a) for a in fig_arrays], dtype=np.int64)
+
+        # ordiniamo le figure per oggetto (ordinamento stabile: l'ordine delle figure
+        # dello stesso oggetto resta quello del file)
+        order = np.argsort(fig_object, kind="stable")
+        indices = (np.concatenate([fig_arrays[i] for i in order]) if len(order) > 0
+                   else np.zeros(0, dtype=np.int32))
+        counts = np.bincount(fig_object, weights=fig_counts, minlength=len(objects)).astype(np.int64)
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+
+        return cls(
+            object_keys=np.array([o["key"] for o in objects], dtype=str),
+            object_updated_at=np.array([o.get("updatedAt", "") for o in objects], dtype=str),
+            class_ids=np.array([classes[o["classTitle"]] for o in objects], dtype=np.int32),
+            indices=indices,
+            offsets=offsets,
+            classes=classes,
+            ann_key=data.get("key", ""),
+        )
+
+    def save(self, index_path, source=None):
+        """Salva l'indice in un .npz (source: impronta del JSON, vedi pcd_cache.source_info)."""
+        tmp_path = index_path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            version=np.array(INDEX_VERSION),
+            source=np.array(json.dumps(source or {})),
+            classes=np.array(json.dumps(self.classes)),
+            ann_key=np.array(self.ann_key),
+            object_keys=self.object_keys,
+            object_updated_at=self.object_updated_at,
+            class_ids=self.class_ids,
+            indices=self.indices,
+            offsets=self.offsets,
+        )
+        os.replace(tmp_path, index_path)
+
+    @classmethod
+    def load(cls, index_path):
+        """Carica un indice salvato con save(). Ritorna (indice, impronta del sorgente)."""
+        with np.load(index_path, allow_pickle=False) as z:
+            if int(z["version"]) != INDEX_VERSION:
+                raise ValueError("versione dell'indice non supportata")
+            index = cls(
+                object_keys=z["object_keys"],
+                object_updated_at=z["object_updated_at"],
+                class_ids=z["class_ids"],
+                indices=z["indices"],
+                offsets=z["offsets"],
+                classes=json.loads(str(z["classes"])),
+                ann_key=str(z["ann_key"]),
+            )
+            source = json.loads(str(z["source"]))
+        return index, source
+
+    # ------------------------------
+    # Interrogazioni
+    # ------------------------------
+
+    def object_position(self, key):
+        """Posizione (riga del CSR) dell'oggetto con la key data."""
+        return self._key_to_object[key]
+
+    def object_indices(self, obj):
+        """Indici dei punti dell'oggetto obj (posizione nel CSR): è una slice, non una copia."""
+        return self.indices[self.offsets[obj]:self.offsets[obj+1]]
+
+    def counts(self):
+        """Numero di punti (con ripetizioni) di ogni oggetto."""
+        return np.diff(self.offsets)
+
+    def objects_of_class(self, class_title):
+        """Posizioni degli oggetti della classe con il titolo dato."""
+        class_id = self.classes.get(class_title)
+        if class_id is None:
+            return np.zeros(0, dtype=np.int64)
+        return np.flatnonzero(self.class_ids == class_id)
+
+    def point_objects(self):
+        """Per ogni elemento di indices, la posizione dell'oggetto a cui appartiene."""
+        return np.repeat(np.arange(len(self), dtype=np.int32), self.counts())
+
+    def subset(self, objects):
+        """
+        Sotto-CSR con solo gli oggetti dati, nell'ordine dato.
+
+        Ritorna:
+            - indices, offsets (come per BranchBatch.from_indices)
+        """
+        objects = np.asarray(objects, dtype=np.int64)
+        counts = self.counts()[objects]
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        if len(objects) == 0:
+            return np.zeros(0, dtype=np.int32), offsets
+        indices = np.concatenate([self.object_indices(o) for o in objects])
+        return indices, offsets
+
+
+@instrumentation.timed()
+def load_annotation_index(ann_path, meta_path=None, index_path=None, rebuild=False):
+    """
+    Carica l'indice delle annotazioni dal .npz accanto al JSON, ricostruendolo
+    (e risalvandolo) se manca o se il JSON è cambiato.
+
+    Parametri:
+        - ann_path: percorso del file ann/*.pcd.json
+        - meta_path: percorso di meta.json (default: cercato risalendo le cartelle)
+        - index_path: percorso dell'indice (default: accanto al JSON, suffisso .index.npz)
+        - rebuild: forza la ricostruzione
+
+    Ritorna:
+        - un AnnotationIndex
+    """
+    index_path = index_path or default_index_path(ann_path)
+    if not rebuild and os.path.exists(index_path):
+        try:
+            index, source = AnnotationIndex.load(index_path)
+        except (ValueError, KeyError, OSError):
+            index, source = None, None
+        if index is not None:
+            st = os.stat(ann_path)
+            if source.get("size") == st.st_size and source.get("mtime_ns") == st.st_mtime_ns:
+                return index
+            if source.get("sha256") == pcd_cache.file_sha256(ann_path):
+                # contenuto invariato: aggiorniamo solo l'impronta
+                index.save(index_path, pcd_cache.source_info(ann_path, sha256=source["sha256"]))
+                return index
+
+    source = pcd_cache.source_info(ann_path)
+    index = AnnotationIndex.from_json(ann_path, meta_path)
+    index.save(index_path, source)
+    return index
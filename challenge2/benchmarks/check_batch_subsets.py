@@ -0,0 +1,104 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pointcloud_preprocessor as pcpp
+import synthetic_vineyard
+
+# =========================================================
+# BranchBatch su un sottoinsieme di rami == BranchBatch su tutti i rami
+# =========================================================
+
+# incremental.py ricalcola solo i rami modificati, in un batch più piccolo, e ne mescola i
+# risultati con quelli salvati dal batch completo: le feature di un ramo non devono
+# dipendere dagli altri rami del batch. Qui si confronta, per ogni modalità (intervalli
+# fissi, adattiva, robusta, adattiva + robusta), la tabella del batch completo con quella
+# di alcuni sottoinsiemi di rami: stesso numero di segmenti e stesse feature (a meno degli
+# arrotondamenti float32 della traslazione sul baricentro, che cambia con il batch).
+
+MODES = {
+    "binned": {},
+    "adaptive": {"tolerance": pcpp.ADAPTIVE_TOLERANCE},
+    "robust": {"robust_samples": pcpp.ROBUST_MAX_SAMPLES},
+    "adaptive_robust": {"tolerance": pcpp.ADAPTIVE_TOLERANCE, "robust_samples": pcpp.ROBUST_MAX_SAMPLES},
+}
+
+
+def branch_csr(labels, first_branch):
+    """Indici dei punti di ogni ramo (label >= first_branch) in formato CSR."""
+    branch_labels = labels - first_branch
+    indices = np.flatnonzero(branch_labels >= 0)
+    indices = indices[np.argsort(branch_labels[indices], kind="stable")]
+    counts = np.bincount(branch_labels[indices])
+    return indices, np.concatenate(([0], np.cumsum(counts)))
+
+
+def subset_csr(indices, offsets, branches):
+    parts = [indices[offsets[b]:offsets[b+1]] for b in branches]
+    sub_offsets = np.concatenate(([0], np.cumsum([len(p) for p in parts])))
+    return np.concatenate(parts), sub_offsets
+
+
+def compare(full, sub, branches, rtol, atol):
+    """Differenze tra le righe dei rami branches della tabella completa e la tabella sub."""
+    errors = []
+    for i, b in enumerate(branches):
+        fs, fe = full["segment_offsets"][b], full["segment_offsets"][b+1]
+        ss, se = sub["segment_offsets"][i], sub["segment_offsets"][i+1]
+        if fe - fs != se - ss:
+            errors.append(f"ramo {b}: {fe - fs} segmenti nel batch completo, {se - ss} nel sottoinsieme")
+            continue
+        # il verso dell'asse principale è arbitrario
+        pc_full, pc_sub = full["principal_component"][b], sub["principal_component"][i]
+        checks = {
+            "center": (full["center"][b], sub["center"][i]),
+            "principal_component": (pc_full, pc_sub * np.sign(np.dot(pc_full, pc_sub))),
+            "branch_length": (full["branch_length"][b], sub["branch_length"][i]),
+            "segment_num_points": (full["segment_num_points"][fs:fe], sub["segment_num_points"][ss:se]),
+            "segment_centers": (full["segment_centers"][fs:fe], sub["segment_centers"][ss:se]),
+            "diameters": (full["diameters"][fs:fe], sub["diameters"][ss:se]),
+        }
+        for name, (a, c) in checks.items():
+            if not np.allclose(a, c, rtol=rtol, atol=atol, equal_nan=True):
+                errors.append(f"ramo {b}: {name} diverso (max diff {np.nanmax(np.abs(np.subtract(a, c))):.2e})")
+    return errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Confronto di BranchBatch su sottoinsiemi di rami e sul batch completo")
+    parser.add_argument("--points", type=int, default=200_000)
+    parser.add_argument("--branches", type=int, default=60)
+    parser.add_argument("--trees", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rtol", type=float, default=1e-4)
+    parser.add_argument("--atol", type=float, default=1e-6)
+    args = parser.parse_args(argv)
+
+    xyz, rgb, labels, _ = synthetic_vineyard.generate_vineyard(args.points, args.branches, args.trees, seed=args.seed)
+    points = pcpp.compact_points(xyz)
+    indices, offsets = branch_csr(labels, args.trees)
+    B = len(offsets) - 1
+    tree_dir = np.array([0.0, 0.0, 1.0])
+    subsets = {"br[5:]": np.arange(5, B), "br[::3]": np.arange(0, B, 3), "br[5]": np.array([5])}
+
+    ok = True
+    print(f"{'modalità':<16} {'sottoinsieme':<14} {'rami':>6} {'differenze':>11}")
+    for mode, kwargs in MODES.items():
+        full = pcpp.BranchBatch.from_indices(points, rgb, indices, offsets, **kwargs).compute(tree_dir)
+        for name, branches in subsets.items():
+            sub_indices, sub_offsets = subset_csr(indices, offsets, branches)
+            sub = pcpp.BranchBatch.from_indices(points, rgb, sub_indices, sub_offsets, **kwargs).compute(tree_dir)
+            errors = compare(full, sub, branches, args.rtol, args.atol)
+            print(f"{mode:<16} {name:<14} {len(branches):>6} {len(errors):>11}")
+            for e in errors[:5]:
+                print(f"    {e}")
+            ok &= not errors
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import linalg3
+
+# =========================================================
+# Accuratezza e velocità di linalg3.eigh3 rispetto a np.linalg.eigh
+# =========================================================
+
+# Casi provati (stack di M matrici):
+# - spd: covarianze generiche (X X^T con X gaussiana)
+# - thin: covarianze di segmenti di ramo (varianza lungo l'asse >> varianze della sezione)
+# - round: come thin ma con sezione circolare (due autovalori piccoli uguali, il caso critico)
+# - disc: due autovalori grandi uguali
+# - indefinite: simmetriche qualsiasi
+# - diagonal / isotropic: casi degeneri
+#
+# Per ogni caso si stampano l'errore massimo sugli autovalori (relativo alla norma di A),
+# l'errore relativo mediano sull'autovalore minimo (quello che dà il diametro), il
+# residuo ||AV - V diag(w)|| / ||A|| e la distanza di V da una matrice ortogonale.
+
+
+def _rotated(rng, diag):
+    Q = np.linalg.qr(rng.normal(size=(len(diag), 3, 3)))[0]
+    return Q @ (diag[:, :, None] * np.swapaxes(Q, 1, 2))
+
+
+def make_cases(M, rng):
+    X = rng.normal(size=(M, 3, 3))
+    thin = np.stack([np.full(M, 1e-2), 10**rng.uniform(-8, -4, M), 10**rng.uniform(-10, -4, M)], axis=1)
+    round_ = thin.copy()
+    round_[:, 2] = round_[:, 1]
+    disc = np.stack([np.full(M, 1e-6), np.full(M, 1e-2), np.full(M, 1e-2)], axis=1)
+    S = rng.normal(size=(M, 3, 3))
+    return {
+        "spd": X @ np.swapaxes(X, 1, 2),
+        "thin": _rotated(rng, thin),
+        "round": _rotated(rng, round_),
+        "disc": _rotated(rng, disc),
+        "indefinite": S + np.swapaxes(S, 1, 2),
+        "diagonal": np.tile(np.diag([1.0, 1.0, 3.0]), (10, 1, 1)),
+        "isotropic": np.tile(np.eye(3) * 2.0, (10, 1, 1)),
+    }
+
+
+def check(A):
+    w, V = linalg3.eigh3(A)
+    w_ref = np.linalg.eigvalsh(A)
+    norm = np.maximum(np.linalg.norm(A, axis=(1, 2)), np.finfo(float).tiny)
+    eig_err = np.max(np.abs(w - w_ref), axis=1) / norm
+    min_err = np.abs(w[:, 0] - w_ref[:, 0]) / np.maximum(np.abs(w_ref[:, 0]), np.finfo(float).tiny)
+    residual = np.linalg.norm(A @ V - V * w[:, None, :], axis=(1, 2)) / norm
+    orth = np.max(np.abs(np.swapaxes(V, 1, 2) @ V - np.eye(3)), axis=(1, 2))
+    return eig_err.max(), np.median(min_err), residual.max(), orth.max()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Confronto di linalg3.eigh3 con np.linalg.eigh")
+    parser.add_argument("--matrices", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tolerance", type=float, default=1e-12,
+                        help="errore massimo ammesso (relativo alla norma) su autovalori e residui")
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    ok = True
+    print(f"{'caso':<12} {'err autoval':>12} {'err min (med)':>14} {'residuo':>12} {'ortog':>12}")
+    for name, A in make_cases(args.matrices, rng).items():
+        eig_err, min_err, residual, orth = check(A)
+        print(f"{name:<12} {eig_err:12.2e} {min_err:14.2e} {residual:12.2e} {orth:12.2e}")
+        ok &= max(eig_err, residual, orth) < args.tolerance
+
+    A = make_cases(args.matrices, rng)["thin"]
+    t0 = time.perf_counter()
+    linalg3.eigh3(A)
+    t_eigh3 = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    np.linalg.eigh(A)
+    t_eigh = time.perf_counter() - t0
+    n_loop = min(len(A), 20_000)
+    t0 = time.perf_counter()
+    for a in A[:n_loop]:
+        np.linalg.eig(a)
+    t_loop = (time.perf_counter() - t0) * len(A) / n_loop
+    print(f"\n{len(A)} matrici: eigh3 {t_eigh3*1e3:.1f} ms, np.linalg.eigh (batch) {t_eigh*1e3:.1f} ms, "
+          f"np.linalg.eig (ciclo, stimato) {t_loop*1e3:.1f} ms")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import spatial_index
+
+# =========================================================
+# VoxelHash / SegmentIndex rispetto alla ricerca esaustiva
+# =========================================================
+
+# Query provate, per una nuvola casuale nel cubo unitario:
+# - inside: query dentro la nuvola (il cubo di voxel attorno alla query basta)
+# - near: query appena fuori dal bounding box della griglia
+# - far: query lontane (metri, con voxel di 1 cm): il cubo attorno alla query sarebbe
+#   enorme e la ricerca deve passare ai soli voxel occupati
+# Per ogni caso si confrontano le distanze di VoxelHash.nearest e SegmentIndex.nearest con
+# quelle esaustive e si stampano i tempi.
+
+
+def make_queries(rng, n):
+    direction = rng.normal(size=(n, 3))
+    direction /= np.linalg.norm(direction, axis=1, keepdims=True)
+    return {
+        "inside": rng.random((n, 3)),
+        "near": 0.5 + direction * rng.uniform(0.9, 1.2, (n, 1)),
+        "far": 0.5 + direction * rng.uniform(2.0, 10.0, (n, 1)),
+    }
+
+
+def brute_force_points(points, queries):
+    return np.array([np.min(np.linalg.norm(points - q, axis=1)) for q in queries])
+
+
+def brute_force_segments(index, queries):
+    return np.array([np.min(spatial_index.point_segment_distances(
+        np.repeat(q[None], len(index), axis=0), index.starts, index.ends)[0]) for q in queries])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Confronto di VoxelHash e SegmentIndex con la ricerca esaustiva")
+    parser.add_argument("--points", type=int, default=200_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--voxel-size", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    points = rng.random((args.points, 3))
+    voxel_hash = spatial_index.VoxelHash(points, args.voxel_size)
+    polylines = [0.5 + np.cumsum(rng.normal(0.0, 0.02, (50, 3)), axis=0) for _ in range(5)]
+    segment_index = spatial_index.SegmentIndex.from_polylines(polylines)
+
+    ok = True
+    print(f"{'query':<8} {'indice':<10} {'err max':>10} {'tempo':>10}")
+    for name, queries in make_queries(rng, args.queries).items():
+        for label, index, nearest, brute_force in (
+                ("voxel", voxel_hash, lambda q: voxel_hash.nearest(q)[1], lambda q: brute_force_points(points, q)),
+                ("segmenti", segment_index, lambda q: segment_index.nearest(q)[1],
+                 lambda q: brute_force_segments(segment_index, q))):
+            t0 = time.perf_counter()
+            distances = nearest(queries)
+            elapsed = time.perf_counter() - t0
+            err = np.max(np.abs(distances - brute_force(queries)))
+            print(f"{name:<8} {label:<10} {err:10.2e} {elapsed*1e3:8.1f} ms")
+            ok &= err < 1e-12
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
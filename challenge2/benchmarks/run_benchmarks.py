@@ -0,0 +1,230 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+import pointcloud_preprocessor as pcpp
+import pcd_cache
+import annotation_index
+import spatial_index
+import cut_planner
+import parallel
+import synthetic_vineyard
+
+# =========================================================
+# Benchmark delle fasi calde del preprocessing
+# =========================================================
+
+# Per ogni dimensione richiesta genera (una volta) una vigna sintetica e cronometra:
+#   - load_cold / load_warm: PCD ascii -> cache binaria, poi apertura della cache (memmap)
+#   - index_cold / index_warm: JSON -> indice CSR, poi apertura del .npz
+#   - pca: PCA di ogni ramo
+#   - approximate_mask / approximate_binned: approximate_branch su ogni ramo
+#   - features: compute_branch_features su ogni ramo
+#   - branch_batch: BranchBatch su tutti i rami insieme
+#   - branch_batch_adaptive: lo stesso con i segmenti adattivi alla curvatura (adaptive_segments)
+#   - branch_batch_robust: lo stesso con la PCA robusta (robust_covariances, campioni limitati per segmento)
+#   - parallel_1_worker / parallel_N_workers: parallel.parallel_branch_table (il percorso di
+#     analyze --workers) con 1 processo e con --workers processi, per misurarne la scalabilità
+#   - trunk_lookup: aggancio dei rami al segmento di tronco più vicino (spatial_index)
+#   - cut_planning: piani di taglio di tutti i rami (cut_planner.plan_cuts)
+#   - voxel_pyramid: piramide multi-risoluzione (VoxelPyramid) dell'intera nuvola, con le label degli oggetti
+#
+# Ogni esecuzione aggiunge una riga JSON a results/history.jsonl (commit git, macchina,
+# parametri, tempi min/mediana per fase) e confronta i tempi con l'ultima esecuzione
+# con gli stessi parametri sulla stessa macchina, segnalando le regressioni.
+
+# results/ è in .gitignore: lo storico è locale alla macchina e non va nel repository.
+
+DEFAULT_HISTORY = os.path.join(HERE, "results", "history.jsonl")
+# larghezza della colonna con il nome della fase (la più lunga è branch_batch_adaptive)
+STAGE_WIDTH = 24
+
+
+def _time_stage(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return {"min": min(times), "median": statistics.median(times), "repeat": repeat}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _machine():
+    return {"node": platform.node(), "platform": platform.platform(), "python": platform.python_version(),
+            "numpy": np.__version__, "cpu_count": os.cpu_count()}
+
+
+def run_size(workdir, params, repeat, workers):
+    """Genera (se serve) la vigna con i parametri dati e cronometra tutte le fasi."""
+    name = "p{points}_b{branches}_t{trees}_n{noise}_s{seed}".format(**params)
+    root = os.path.join(workdir, name)
+    pcd_path = os.path.join(root, "synthetic", "pointcloud", "synthetic.pcd")
+    ann_path = os.path.join(root, "synthetic", "ann", "synthetic.pcd.json")
+    stages = {}
+    if not (os.path.exists(pcd_path) and os.path.exists(ann_path)):
+        t0 = time.perf_counter()
+        synthetic_vineyard.write_project(root, params["points"], params["branches"], params["trees"],
+                                         params["noise"], seed=params["seed"])
+        print(f"[INFO] generated {name} in {time.perf_counter() - t0:.2f}s")
+
+    stages["load_cold"] = _time_stage(lambda: pcd_cache.load_point_cloud(pcd_path, rebuild=True), repeat)
+    stages["load_warm"] = _time_stage(lambda: pcd_cache.load_point_cloud(pcd_path), repeat)
+    stages["index_cold"] = _time_stage(lambda: annotation_index.load_annotation_index(ann_path, rebuild=True), repeat)
+    stages["index_warm"] = _time_stage(lambda: annotation_index.load_annotation_index(ann_path), repeat)
+
+    xyz, rgb = pcd_cache.load_point_cloud(pcd_path)
+    points = pcpp.compact_points(xyz)
+    colors = rgb
+    index = annotation_index.load_annotation_index(ann_path)
+    branch_objects = index.objects_of_class("Branch 1")
+    branches = [(points[index.object_indices(o)], colors[index.object_indices(o)]) for o in branch_objects]
+    branches = [(p, c) for p, c in branches if len(p) >= 2]
+    tree_dir = np.array([0.0, 0.0, 1.0])
+
+    def pca():
+        for p, _ in branches:
+            pcpp.PCA(p, p.mean(axis=0))
+
+    def approximate(mode):
+        return [pcpp.approximate_branch(p, c, mode=mode, with_pc_line=False) for p, c in branches]
+
+    approximations = [r for r in approximate("binned") if r[0] is not None]
+
+    def features():
+        for segments, color_segments, pc, _, _ in approximations:
+            pcpp.compute_branch_features(segments, pc, None, tree_dir, color_segments)
+
+    branch_indices, branch_offsets = index.subset(branch_objects)
+
+    def branch_batch():
+        pcpp.BranchBatch.from_indices(points, colors, branch_indices, branch_offsets).compute(tree_dir)
+
+    def branch_batch_adaptive():
+        pcpp.BranchBatch.from_indices(points, colors, branch_indices, branch_offsets,
+                                      tolerance=pcpp.ADAPTIVE_TOLERANCE).compute(tree_dir)
+
+    def branch_batch_robust():
+        pcpp.BranchBatch.from_indices(points, colors, branch_indices, branch_offsets,
+                                      robust_samples=pcpp.ROBUST_MAX_SAMPLES).compute(tree_dir)
+
+    def parallel_table(n):
+        parallel.parallel_branch_table(points, colors, branch_indices, branch_offsets, tree_dir, workers=n)
+
+    table = pcpp.BranchBatch.from_indices(points, colors, branch_indices, branch_offsets).compute(tree_dir)
+    tree_polylines = []
+    for o in index.objects_of_class("Tree"):
+        res = pcpp.approximate_branch(points[index.object_indices(o)], colors[index.object_indices(o)],
+                                      mode="binned", with_pc_line=False)
+        if res[3] is not None:
+            tree_polylines.append(res[3])
+
+    def trunk_lookup():
+        trunk_index = spatial_index.SegmentIndex.from_polylines(tree_polylines)
+        spatial_index.attach_trunk_segments(table, trunk_index)
+
+    stages["pca"] = _time_stage(pca, repeat)
+    stages["approximate_mask"] = _time_stage(lambda: approximate("mask"), repeat)
+    stages["approximate_binned"] = _time_stage(lambda: approximate("binned"), repeat)
+    stages["features"] = _time_stage(features, repeat)
+    stages["branch_batch"] = _time_stage(branch_batch, repeat)
+    stages["branch_batch_adaptive"] = _time_stage(branch_batch_adaptive, repeat)
+    stages["branch_batch_robust"] = _time_stage(branch_batch_robust, repeat)
+    stages["parallel_1_worker"] = _time_stage(lambda: parallel_table(1), repeat)
+    stages["parallel_N_workers"] = _time_stage(lambda: parallel_table(workers), repeat)
+    stages["trunk_lookup"] = _time_stage(trunk_lookup, repeat)
+    stages["cut_planning"] = _time_stage(lambda: cut_planner.plan_cuts(table), repeat)
+    # come in main.py: voxel con la chiave (oggetto, voxel)
+    point_objects = np.full(len(points), -1, dtype=np.int32)
+    point_objects[index.indices] = index.point_objects()
+    stages["voxel_pyramid"] = _time_stage(lambda: pcpp.VoxelPyramid(points, colors, labels=point_objects), repeat)
+    return stages
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(entry, history, threshold):
+    """Confronta i tempi (min) con l'ultima esecuzione con stessi parametri e macchina."""
+    previous = [h for h in history if h["params"] == entry["params"] and h["machine"]["node"] == entry["machine"]["node"]]
+    if not previous:
+        return []
+    last = previous[-1]
+    regressions = []
+    for stage, timing in entry["stages"].items():
+        old = last["stages"].get(stage)
+        if old is None or old["min"] <= 0:
+            continue
+        ratio = timing["min"] / old["min"]
+        flag = "  <-- REGRESSION" if ratio > threshold else ""
+        print(f"    {stage:<{STAGE_WIDTH}} {old['min']*1e3:10.2f} ms -> {timing['min']*1e3:10.2f} ms  (x{ratio:.2f}){flag}")
+        if ratio > threshold:
+            regressions.append(stage)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark delle fasi di preprocessing su vigne sintetiche")
+    parser.add_argument("--points", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--branches", type=int, default=100)
+    parser.add_argument("--trees", type=int, default=4)
+    parser.add_argument("--noise", type=float, default=0.002)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="processi della fase parallel_N_workers (default: tutti i core)")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "challenge2_bench"),
+                        help="cartella dove generare (e riusare) le vigne sintetiche")
+    parser.add_argument("--history", default=DEFAULT_HISTORY, help="file JSONL con lo storico dei risultati")
+    parser.add_argument("--threshold", type=float, default=1.2, help="rapporto oltre il quale segnalare una regressione")
+    args = parser.parse_args(argv)
+
+    history = load_history(args.history)
+    os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+    any_regression = False
+    for num_points in args.points:
+        params = {"points": num_points, "branches": args.branches, "trees": args.trees,
+                  "noise": args.noise, "seed": args.seed, "workers": args.workers}
+        print(f"[INFO] benchmark {params}")
+        entry = {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "commit": _git_commit(),
+            "machine": _machine(),
+            "params": params,
+            "stages": run_size(args.workdir, params, args.repeat, args.workers),
+        }
+        for stage, timing in entry["stages"].items():
+            print(f"    {stage:<{STAGE_WIDTH}} min {timing['min']*1e3:10.2f} ms   median {timing['median']*1e3:10.2f} ms")
+        if compare(entry, history, args.threshold):
+            any_regression = True
+        with open(args.history, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+        history.append(entry)
+    return 1 if any_regression else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import uuid
+
+import numpy as np
+
+# =========================================================
+# Generatore di vigne sintetiche (pointcloud + annotazioni)
+# =========================================================
+
+# Abbiamo una sola scansione reale da ~41k punti: per misurare le prestazioni su
+# dimensioni di produzione (da 10k a decine di milioni di punti) generiamo filari
+# sintetici con la stessa struttura del dataset Supervisely:
+#
+#   <root>/meta.json
+#   <root>/key_id_map.json
+#   <root>/<dataset>/pointcloud/<nome>.pcd          (PCD v0.7, DATA ascii, rgb float impacchettato)
+#   <root>/<dataset>/ann/<nome>.pcd.json            (objects + figures con geometry.indices)
+#
+# Ogni vite è un tronco (cilindro verticale) da cui partono dei rami (cilindri leggermente
+# curvi, con inclinazione e lunghezza casuali). Una parte dei punti è "rumore" non
+# annotato (foglie, pali, terreno). I punti vengono mescolati, così che gli indici di
+# ogni oggetto siano sparsi nel file come nelle scansioni reali.
+
+TREE_CLASS = {"title": "Tree", "description": "Vine tree", "shape": "point_cloud", "color": "#02C2FF",
+              "geometry_config": {}, "id": 14085274, "hotkey": "T"}
+BRANCH_CLASS = {"title": "Branch 1", "description": "", "shape": "point_cloud", "color": "#FF0079",
+                "geometry_config": {}, "id": 14085299, "hotkey": "1"}
+
+TIMESTAMP = "2025-10-03T12:00:00.000Z"
+
+
+def _cylinder_points(rng, n, start, direction, length, radius, bend=0.0):
+    """
+    Punti sulla superficie di un cilindro (eventualmente incurvato) di asse start + t*direction.
+    bend sposta l'asse lateralmente in modo parabolico (ramo curvo).
+    """
+    direction = direction / np.linalg.norm(direction)
+    # base ortonormale (u, v) perpendicolare all'asse
+    helper = np.array([1.0, 0.0, 0.0]) if abs(direction[0]) < 0.9 else np.array([0.0, 1.0, 0.0])
+    u = np.cross(direction, helper)
+    u /= np.linalg.norm(u)
+    v = np.cross(direction, u)
+    t = rng.random(n) * length
+    theta = rng.random(n) * 2*np.pi
+    offset = bend * (t / length)**2
+    return (start + np.outer(t, direction) + np.outer(offset, u)
+            + np.outer(radius*np.cos(theta), u) + np.outer(radius*np.sin(theta), v))
+
+
+def generate_vineyard(num_points, num_branches, num_trees=1, noise=0.002, background=0.2, seed=0):
+    """
+    Genera un filare sintetico.
+
+    Parametri:
+        - num_points: numero totale di punti
+        - num_branches: numero totale di rami (distribuiti tra le viti)
+        - num_trees: numero di viti del filare (distanziate di 1 m lungo x)
+        - noise: deviazione standard del rumore gaussiano sulle coordinate (m)
+        - background: frazione di punti non annotati
+        - seed: seme del generatore casuale (stessi parametri -> stessa vigna)
+
+    Ritorna:
+        - xyz: array (N,3) float32
+        - rgb: array (N,3) uint8
+        - labels: array (N,) int32 con l'oggetto di ogni punto (-1 = non annotato)
+        - objects: lista di dizionari {"key", "classTitle"} (l'indice è la label)
+    """
+    rng = np.random.default_rng(seed)
+    num_labelled = int(num_points * (1 - background))
+    num_trees = max(1, num_trees)
+
+    # geometria degli oggetti: prima i tronchi, poi i rami
+    shapes = []
+    for t in range(num_trees):
+        base = np.array([t * 1.0, 0.0, 0.0])
+        shapes.append(("Tree", base, np.array([0.0, 0.0, 1.0]), 1.2, 0.04, 0.0))
+    branch_tree = rng.integers(0, num_trees, size=num_branches)
+    for b in range(num_branches):
+        base = np.array([branch_tree[b] * 1.0, 0.0, rng.uniform(0.3, 1.1)])
+        azimuth = rng.uniform(0, 2*np.pi)
+        elevation = np.radians(rng.uniform(10, 70))
+        direction = np.array([np.cos(azimuth)*np.cos(elevation), np.sin(azimuth)*np.cos(elevation), np.sin(elevation)])
+        shapes.append(("Branch 1", base, direction, rng.uniform(0.1, 0.6), rng.uniform(0.004, 0.015),
+                       rng.uniform(-0.05, 0.05)))
+
+    # punti per oggetto proporzionali alla superficie laterale (lunghezza * raggio)
+    areas = np.array([length * radius for _, _, _, length, radius, _ in shapes])
+    counts = rng.multinomial(num_labelled, areas / areas.sum())
+
+    xyz = np.empty((num_points, 3), dtype=np.float32)
+    rgb = np.empty((num_points, 3), dtype=np.uint8)
+    labels = np.full(num_points, -1, dtype=np.int32)
+    objects = []
+    pos = 0
+    for i, ((title, base, direction, length, radius, bend), n) in enumerate(zip(shapes, counts)):
+        xyz[pos:pos+n] = _cylinder_points(rng, n, base, direction, length, radius, bend)
+        # legno: marrone scuro con un po' di variazione
+        rgb[pos:pos+n] = np.clip(rng.normal([90, 65, 60], 15, size=(n, 3)), 0, 255)
+        labels[pos:pos+n] = i
+        objects.append({"key": uuid.UUID(int=int(rng.integers(0, 2**63)) << 64 | int(rng.integers(0, 2**63))).hex,
+                        "classTitle": title})
+        pos += n
+
+    # rumore di fondo non annotato (foglie, pali, terreno) nel volume del filare
+    n = num_points - pos
+    low = np.array([-0.6, -0.6, 0.0])
+    high = np.array([(num_trees - 1) * 1.0 + 0.6, 0.6, 1.5])
+    xyz[pos:] = rng.uniform(low, high, size=(n, 3))
+    rgb[pos:] = np.clip(rng.normal([70, 120, 50], 25, size=(n, 3)), 0, 255)
+
+    xyz += rng.normal(0.0, noise, size=xyz.shape).astype(np.float32)
+
+    order = rng.permutation(num_points)
+    return xyz[order], rgb[order], labels[order], objects
+
+
+def write_ascii_pcd(path, xyz, rgb, chunk_size=1_000_000):
+    """Scrive un PCD ascii (x y z rgb, rgb come float impacchettato) a blocchi."""
+    n = len(xyz)
+    packed = ((rgb[:, 0].astype(np.uint32) << 16) | (rgb[:, 1].astype(np.uint32) << 8)
+              | rgb[:, 2].astype(np.uint32)).view(np.float32)
+    with open(path, "w") as f:
+        f.write("# .PCD v0.7 - Point Cloud Data file format\n"
+                "VERSION 0.7\nFIELDS x y z rgb\nSIZE 4 4 4 4\nTYPE F F F F\nCOUNT 1 1 1 1\n"
+                f"WIDTH {n}\nHEIGHT 1\nVIEWPOINT 0 0 0 1 0 0 0\nPOINTS {n}\nDATA ascii\n")
+        for start in range(0, n, chunk_size):
+            end = min(start + chunk_size, n)
+            block = np.column_stack((xyz[start:end].astype(np.float64), packed[start:end].astype(np.float64)))
+            np.savetxt(f, block, fmt="%.10g")
+
+
+def write_annotation(path, labels, objects, split_fraction=0.2, seed=0):
+    """
+    Scrive il JSON delle annotazioni nel formato Supervisely (objects + figures).
+    Una frazione degli oggetti viene spezzata in due figure, come succede nei dati reali.
+    Gli indici sono scritti a blocchi, senza costruire liste Python enormi.
+
+    Ritorna:
+        - dizionario key -> id delle figure (per key_id_map.json)
+        - key dell'annotazione
+    """
+    rng = np.random.default_rng(seed)
+    order = np.argsort(labels, kind="stable")
+    sorted_labels = labels[order]
+    starts = np.searchsorted(sorted_labels, np.arange(len(objects)), side="left")
+    ends = np.searchsorted(sorted_labels, np.arange(len(objects)), side="right")
+
+    figures = []
+    for i, obj in enumerate(objects):
+        obj_indices = np.sort(order[starts[i]:ends[i]])
+        parts = [obj_indices]
+        if len(obj_indices) > 1 and rng.random() < split_fraction:
+            cut = len(obj_indices) // 2
+            parts = [obj_indices[:cut], obj_indices[cut:]]
+        for part in parts:
+            figures.append((uuid.UUID(int=int(rng.integers(0, 2**63))).hex, obj["key"], part))
+
+    header = {"description": "", "key": uuid.UUID(int=int(rng.integers(0, 2**63))).hex, "tags": []}
+    with open(path, "w") as f:
+        f.write(json.dumps(header)[:-1])
+        f.write(', "objects": ')
+        json.dump([{"key": o["key"], "classTitle": o["classTitle"], "tags": [], "labelerLogin": "synthetic",
+                    "updatedAt": TIMESTAMP, "createdAt": TIMESTAMP} for o in objects], f)
+        f.write(', "figures": [')
+        for j, (fig_key, obj_key, part) in enumerate(figures):
+            if j > 0:
+                f.write(", ")
+            f.write(f'{{"key": "{fig_key}", "objectKey": "{obj_key}", "geometryType": "point_cloud", '
+                    '"geometry": {"indices": [')
+            for s in range(0, len(part), 1_000_000):
+                if s > 0:
+                    f.write(", ")
+                f.write(", ".join(map(str, part[s:s+1_000_000].tolist())))
+            f.write(f']}}, "labelerLogin": "synthetic", "updatedAt": "{TIMESTAMP}", "createdAt": "{TIMESTAMP}"}}')
+        f.write("]}")
+    return {fig_key: 1_000_000 + j for j, (fig_key, _, _) in enumerate(figures)}, header["key"]
+
+
+def write_project(root, num_points, num_branches, num_trees=1, noise=0.002, background=0.2, seed=0,
+                  dataset="synthetic", name="synthetic.pcd"):
+    """
+    Genera una vigna e la scrive come progetto Supervisely sotto root.
+
+    Ritorna:
+        - (pcd_path, ann_path)
+    """
+    xyz, rgb, labels, objects = generate_vineyard(num_points, num_branches, num_trees, noise, background, seed)
+    pcd_dir = os.path.join(root, dataset, "pointcloud")
+    ann_dir = os.path.join(root, dataset, "ann")
+    os.makedirs(pcd_dir, exist_ok=True)
+    os.makedirs(ann_dir, exist_ok=True)
+    pcd_path = os.path.join(pcd_dir, name)
+    ann_path = os.path.join(ann_dir, name + ".json")
+
+    write_ascii_pcd(pcd_path, xyz, rgb)
+    figure_ids, ann_key = write_annotation(ann_path, labels, objects, seed=seed)
+
+    with open(os.path.join(root, "meta.json"), "w") as f:
+        json.dump({"classes": [TREE_CLASS, BRANCH_CLASS], "tags": [], "projectType": "point_clouds",
+                   "projectSettings": {"multiView": {"enabled": False, "tagName": None, "tagId": None,
+                                                     "isSynced": False}}}, f, indent=4)
+    with open(os.path.join(root, "key_id_map.json"), "w") as f:
+        json.dump({"tags": {}, "objects": {o["key"]: 2_000_000 + i for i, o in enumerate(objects)},
+                   "figures": figure_ids, "videos": {ann_key: 3_000_000 + seed}}, f, indent=4)
+    return pcd_path, ann_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Genera una vigna sintetica in formato Supervisely")
+    parser.add_argument("root", help="cartella del progetto da creare")
+    parser.add_argument("--points", type=int, default=100_000)
+    parser.add_argument("--branches", type=int, default=50)
+    parser.add_argument("--trees", type=int, default=1)
+    parser.add_argument("--noise", type=float, default=0.002)
+    parser.add_argument("--background", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    pcd_path, ann_path = write_project(args.root, args.points, args.branches, args.trees,
+                                       args.noise, args.background, args.seed)
+    print(f"[INFO] Wrote {pcd_path} and {ann_path}")
@@ -0,0 +1,188 @@
+import collections
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import analysis
+import annotation_index
+import incremental
+import instrumentation
+import pcd_cache
+import pointcloud_preprocessor as pcpp
+
+# =========================================================
+# Elaborazione di intere campagne (più progetti, più scansioni)
+# =========================================================
+
+# main.py lavora su un solo dataset fissato in PCD_PATH/ANN_PATH, mentre ogni giorno
+# arriva un nuovo export Supervisely con centinaia di scansioni. Qui:
+# - discover_scans trova tutti i progetti sotto una cartella (quelli con meta.json e
+#   key_id_map.json) e, in ogni dataset, le coppie pointcloud/<file>.pcd + ann/<file>.pcd.json
+# - run_campaign le analizza una dopo l'altra mentre dei thread in background caricano
+#   le scansioni successive (lettura/conversione del PCD, indice delle annotazioni):
+#   così l'I/O si sovrappone al calcolo invece di alternarsi con esso
+#
+# Si usano thread e non asyncio: il caricamento è fatto di letture su file e di numpy,
+# che rilasciano il GIL, e le funzioni di caricamento esistenti sono sincrone.
+# Il numero di scansioni caricate in anticipo (prefetch) limita la memoria occupata:
+# oltre a quella in analisi, ce ne sono al più prefetch in RAM.
+
+META_FILE = "meta.json"
+KEY_ID_MAP_FILE = "key_id_map.json"
+
+
+def find_projects(root):
+    """Cartelle di progetto Supervisely (con meta.json e key_id_map.json) sotto root, in ordine."""
+    projects = []
+    for folder, dirs, files in os.walk(root):
+        dirs.sort()
+        if META_FILE in files and KEY_ID_MAP_FILE in files:
+            projects.append(folder)
+            dirs[:] = []  # i dataset stanno dentro il progetto: non serve scendere oltre
+    return projects
+
+
+def discover_scans(root):
+    """
+    Trova tutte le scansioni dei progetti sotto root.
+
+    Ritorna:
+        - lista di dizionari {"project", "dataset", "pcd_path", "ann_path", "meta_path",
+          "videos"}, dove videos è la mappa key -> id delle annotazioni di key_id_map.json
+    """
+    scans = []
+    for project in find_projects(root):
+        with open(os.path.join(project, KEY_ID_MAP_FILE)) as f:
+            videos = json.load(f).get("videos", {})
+        for dataset in sorted(os.listdir(project)):
+            pcd_dir = os.path.join(project, dataset, "pointcloud")
+            ann_dir = os.path.join(project, dataset, "ann")
+            if not (os.path.isdir(pcd_dir) and os.path.isdir(ann_dir)):
+                continue
+            for name in sorted(os.listdir(pcd_dir)):
+                if not name.lower().endswith(".pcd"):
+                    continue
+                ann_path = os.path.join(ann_dir, name + ".json")
+                if not os.path.exists(ann_path):
+                    print(f"[WARNING] {os.path.join(pcd_dir, name)}: manca l'annotazione {ann_path}", file=sys.stderr)
+                    continue
+                scans.append({
+                    "project": os.path.basename(os.path.normpath(project)),
+                    "dataset": dataset,
+                    "pcd_path": os.path.join(pcd_dir, name),
+                    "ann_path": ann_path,
+                    "meta_path": os.path.join(project, META_FILE),
+                    "videos": videos,
+                })
+    return scans
+
+
+@instrumentation.timed()
+def load_scan(scan):
+    """
+    Carica in RAM punti, colori e indice delle annotazioni di una scansione (vedi
+    analysis.load_scan). Il memmap della cache viene copiato, così le letture da disco
+    avvengono qui, nel thread di prefetch, e non durante l'analisi.
+    """
+    xyz, rgb = pcd_cache.load_point_cloud(scan["pcd_path"])
+    points = np.array(pcpp.compact_points(xyz))
+    colors = np.array(rgb) if rgb is not None else np.full(points.shape, 128, dtype=pcpp.COLOR_DTYPE)
+    index = annotation_index.load_annotation_index(scan["ann_path"], meta_path=scan["meta_path"])
+    return points, colors, index
+
+
+@instrumentation.timed()
+def warm_scan(scan):
+    """Costruisce (se serve) le cache di PCD e annotazioni, senza tenere i dati in memoria."""
+    pcd_cache.load_point_cloud(scan["pcd_path"])
+    return annotation_index.load_annotation_index(scan["ann_path"], meta_path=scan["meta_path"])
+
+
+def prefetched(items, load, prefetch=2):
+    """
+    Applica load agli elementi in thread di background, al più prefetch elementi in
+    anticipo rispetto a quello restituito.
+
+    Ritorna (generatore):
+        - tuple (item, value, error): value è il risultato di load(item), oppure None se
+          load ha sollevato l'eccezione error
+    """
+    items = iter(items)
+    if prefetch <= 0:
+        for item in items:
+            try:
+                yield item, load(item), None
+            except Exception as e:
+                yield item, None, e
+        return
+
+    with ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix="prefetch") as pool:
+        pending = collections.deque()
+
+        def submit_next():
+            for item in items:
+                pending.append((item, pool.submit(load, item)))
+                return
+
+        for _ in range(prefetch):
+            submit_next()
+        while pending:
+            item, future = pending.popleft()
+            # si rimpiazza l'elemento appena tolto: mentre il chiamante lavora su questo,
+            # gli elementi in caricamento o già caricati sono al più prefetch
+            submit_next()
+            try:
+                yield item, future.result(), None
+            except Exception as e:
+                yield item, None, e
+
+
+def run_campaign(scans, prefetch=2, use_incremental=False, tolerance=None, robust_samples=None, workers=1):
+    """
+    Analizza le scansioni in ordine, caricando le successive in background.
+
+    Parametri:
+        - scans: lista di scansioni (vedi discover_scans)
+        - prefetch: numero di scansioni caricate in anticipo (0: nessun thread)
+        - use_incremental: usa incremental.analyze_scan_incremental; il prefetch si limita
+          allora a preparare le cache, da cui l'analisi poi rilegge
+        - tolerance: segmentazione adattiva (vedi analysis.analyze_scan)
+        - robust_samples: PCA robusta dei rami (vedi analysis.analyze_scan)
+        - workers: processi su cui distribuire i rami di ogni scansione (vedi analysis.analyze_scan)
+
+    Ritorna (generatore):
+        - tuple (scan, result, error): result come analysis.analyze_scan, oppure None se
+          la scansione è fallita con l'eccezione error (la campagna prosegue)
+    """
+    load = warm_scan if use_incremental else load_scan
+    for scan, loaded, error in prefetched(scans, load, prefetch):
+        if error is None:
+            try:
+                with instrumentation.stage("analyze_campaign_scan", scan=scan["pcd_path"]):
+                    if use_incremental:
+                        result = incremental.analyze_scan_incremental(scan["pcd_path"], scan["ann_path"],
+                                                                      tolerance=tolerance,
+                                                                      robust_samples=robust_samples,
+                                                                      workers=workers)
+                    else:
+                        result = analysis.analyze_loaded(analysis.scan_name(scan["pcd_path"]), *loaded,
+                                                         tolerance=tolerance, robust_samples=robust_samples,
+                                                         workers=workers)
+            except Exception as e:
+                result, error = None, e
+        if error is not None:
+            yield scan, None, error
+            continue
+        result["scan_id"] = scan["videos"].get(result["index"].ann_key)
+        yield scan, result, None
+
+
+def campaign_rows(scan, result):
+    """Righe di analysis.segment_rows con in testa progetto, dataset e id della scansione."""
+    rows = []
+    for row in analysis.segment_rows(result):
+        rows.append({"project": scan["project"], "dataset": scan["dataset"], "scan_id": result["scan_id"], **row})
+    return rows
@@ -0,0 +1,307 @@
+import argparse
+import csv
+import json
+import os
+import sys
+
+import analysis
+import campaign
+import feature_store
+import incremental
+import instrumentation
+import pointcloud_preprocessor as pcpp
+
+# =========================================================
+# Interfaccia a riga di comando (batch, senza visualizzazione)
+# =========================================================
+
+# Uso:
+#   python -m challenge2 analyze <pcd> <ann> [<pcd> <ann> ...] --out features.csv
+#
+# Il formato di output dipende dall'estensione di --out: .csv, .jsonl oppure .parquet
+# (quest'ultimo richiede pyarrow), con una riga per segmento; con .npz si salva invece un
+# archivio colonnare interrogabile (vedi feature_store.py). Si possono passare più coppie pcd/ann per
+# elaborare più scansioni in una sola invocazione.
+#
+# Per un'intera campagna (uno o più export Supervisely sotto una cartella):
+#   python -m challenge2 campaign <root> --out features.parquet [--prefetch 2]
+# le scansioni vengono trovate da sole (vedi campaign.py) e caricate in background
+# mentre si analizza quella corrente; le righe vengono scritte man mano.
+#
+# Per capire dove va il tempo (vedi instrumentation.py):
+#   --timings run.json       tempi/memoria per fase e contatori per ramo, in JSON
+#   --trace run.trace.json   le stesse fasi nel formato Trace Event (chrome://tracing, Perfetto)
+#   --trace-memory           misura la memoria di ogni fase con tracemalloc invece del solo
+#                            picco di RSS dell'intero processo
+#   --cprofile run.prof      profilo cProfile dell'intera esecuzione (pstats, snakeviz)
+
+
+class RowWriter:
+    """
+    Scrive righe (dizionari) in csv, jsonl o parquet in base all'estensione, a blocchi:
+    ogni chiamata a write accoda (in parquet un row group per blocco), così una campagna
+    non deve tenere in memoria le righe di tutte le scansioni.
+    Le colonne sono quelle del primo blocco non vuoto, se non vengono date.
+    """
+
+    def __init__(self, out_path, columns=None):
+        self.ext = os.path.splitext(out_path)[1].lower()
+        if self.ext not in (".csv", ".jsonl", ".parquet"):
+            raise SystemExit(f"[ERROR] formato di output non supportato: {self.ext} (usa .csv, .jsonl o .parquet)")
+        if self.ext == ".parquet":
+            try:
+                import pyarrow  # noqa: F401
+                import pyarrow.parquet  # noqa: F401
+            except ImportError:
+                raise SystemExit("[ERROR] per scrivere .parquet serve pyarrow (pip install pyarrow)")
+        self.out_path = out_path
+        self.columns = columns
+        self.num_rows = 0
+        self._file = None
+        self._writer = None
+
+    def _open(self):
+        if self.ext == ".csv":
+            self._file = open(self.out_path, "w", newline="")
+            self._writer = csv.DictWriter(self._file, fieldnames=self.columns)
+            self._writer.writeheader()
+        elif self.ext == ".jsonl":
+            self._file = open(self.out_path, "w")
+
+    def write(self, rows):
+        if self.columns is None:
+            if not rows:
+                return
+            self.columns = list(rows[0].keys())
+        if self._file is None and self._writer is None:
+            self._open()
+        if self.ext == ".csv":
+            self._writer.writerows(rows)
+        elif self.ext == ".jsonl":
+            for row in rows:
+                self._file.write(json.dumps(row) + "\n")
+        elif rows:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.table({c: [row[c] for row in rows] for c in self.columns})
+            if self._writer is None:
+                self._writer = pq.ParquetWriter(self.out_path, table.schema)
+            self._writer.write_table(table.cast(self._writer.schema))
+        self.num_rows += len(rows)
+
+    def close(self):
+        if self.columns is None:
+            self.columns = []
+        if self.ext == ".parquet":
+            if self._writer is None:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                pq.write_table(pa.table({c: [] for c in self.columns}), self.out_path)
+            else:
+                self._writer.close()
+        else:
+            if self._file is None:
+                self._open()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ResultWriter:
+    """
+    Destinazione dei risultati delle scansioni: righe per segmento (RowWriter) oppure,
+    se out_path è un .npz, un FeatureStore con tutte le scansioni (salvato alla chiusura).
+    """
+
+    def __init__(self, out_path):
+        self.out_path = out_path
+        self.num_rows = 0
+        self.num_scans = 0
+        self._parts = None
+        self._rows = None
+        if os.path.splitext(out_path)[1].lower() == ".npz":
+            self._parts = []
+        else:
+            self._rows = RowWriter(out_path)
+
+    def write(self, result, make_rows, project="", dataset=""):
+        """
+        Scrive il risultato di una scansione; make_rows() ne costruisce le righe (chiamata
+        solo se servono). Ritorna il numero di segmenti dei rami validi.
+        """
+        with instrumentation.stage("write_rows"):
+            if self._parts is not None:
+                store = feature_store.FeatureStore.from_result(result, project=project, dataset=dataset)
+                self._parts.append(store)
+                written = int(store.branches["num_segments"][store.branches["valid"]].sum())
+            else:
+                rows = make_rows()
+                self._rows.write(rows)
+                written = len(rows)
+        self.num_rows += written
+        self.num_scans += 1
+        return written
+
+    def close(self):
+        if self._parts is not None:
+            feature_store.FeatureStore.concatenate(self._parts).save(self.out_path)
+        else:
+            self._rows.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_rows(rows, out_path, columns=None):
+    """Scrive una lista di righe (dizionari) in csv, jsonl o parquet in base all'estensione."""
+    with RowWriter(out_path, columns) as writer:
+        writer.write(rows)
+
+
+def _dataset_pairs(paths):
+    if len(paths) % 2 != 0:
+        raise SystemExit("[ERROR] servono coppie <pcd> <ann>")
+    return list(zip(paths[0::2], paths[1::2]))
+
+
+def _profiled(run, args):
+    """Esegue run(args) con la profilazione chiesta dalle opzioni --timings/--trace/--cprofile."""
+    profiler = None
+    if args.timings or args.trace or args.trace_memory:
+        profiler = instrumentation.enable(trace_memory=args.trace_memory)
+    try:
+        with instrumentation.cprofile(args.cprofile):
+            return run(args)
+    finally:
+        if profiler is not None:
+            instrumentation.disable()
+            profiler.print_summary(file=sys.stderr)
+            if args.timings:
+                profiler.save_json(args.timings)
+            if args.trace:
+                profiler.save_chrome_trace(args.trace)
+
+
+def cmd_analyze(args):
+    _profiled(_analyze, args)
+
+
+def cmd_campaign(args):
+    failed = _profiled(_campaign, args)
+    if failed:
+        raise SystemExit(1)
+
+
+def _analyze(args):
+    if args.adaptive is not None and args.chunk_size is not None:
+        raise SystemExit("[ERROR] --adaptive non è disponibile con --chunk-size")
+    if args.robust is not None and args.chunk_size is not None:
+        raise SystemExit("[ERROR] --robust non è disponibile con --chunk-size")
+    if args.workers != 1 and args.chunk_size is not None:
+        raise SystemExit("[ERROR] --workers non è disponibile con --chunk-size")
+    with ResultWriter(args.out) as writer:
+        for pcd_path, ann_path in _dataset_pairs(args.datasets):
+            _analyze_one(args, writer, pcd_path, ann_path)
+    print(f"[INFO] Wrote {writer.num_rows} segments to {args.out}", file=sys.stderr)
+
+
+def _analyze_one(args, writer, pcd_path, ann_path):
+    print(f"[INFO] Analyzing {pcd_path}...", file=sys.stderr)
+    if args.incremental:
+        result = incremental.analyze_scan_incremental(pcd_path, ann_path, tolerance=args.adaptive,
+                                                      robust_samples=args.robust, workers=args.workers)
+        stats = result["stats"]
+        print(f"[INFO] {stats['recomputed']} branches recomputed, {stats['reused']} reused, "
+              f"{stats['removed']} removed (trees recomputed: {stats['trees_recomputed']}).", file=sys.stderr)
+    else:
+        result = analysis.analyze_scan(pcd_path, ann_path, streaming_chunk_size=args.chunk_size,
+                                       tolerance=args.adaptive, robust_samples=args.robust,
+                                       workers=args.workers)
+    num_segments = writer.write(result, lambda: analysis.segment_rows(result))
+    print(f"[INFO] {int(result['table']['valid'].sum())} branches, {num_segments} segments.", file=sys.stderr)
+
+
+def _campaign(args):
+    scans = campaign.discover_scans(args.root)
+    print(f"[INFO] Found {len(scans)} scans under {args.root}", file=sys.stderr)
+    failed = []
+    with ResultWriter(args.out) as writer:
+        for scan, result, error in campaign.run_campaign(scans, prefetch=args.prefetch,
+                                                         use_incremental=args.incremental,
+                                                         tolerance=args.adaptive,
+                                                         robust_samples=args.robust,
+                                                         workers=args.workers):
+            if error is not None:
+                print(f"[WARNING] {scan['pcd_path']}: {type(error).__name__}: {error}", file=sys.stderr)
+                failed.append(scan["pcd_path"])
+                continue
+            num_segments = writer.write(result, lambda: campaign.campaign_rows(scan, result),
+                                        project=scan["project"], dataset=scan["dataset"])
+            print(f"[INFO] {result['scan']}: {int(result['table']['valid'].sum())} branches, "
+                  f"{num_segments} segments.", file=sys.stderr)
+    print(f"[INFO] Wrote {writer.num_rows} segments from {writer.num_scans} scans to {args.out}", file=sys.stderr)
+    if failed:
+        print(f"[WARNING] {len(failed)} scans failed: " + ", ".join(failed), file=sys.stderr)
+    return failed
+
+
+def _add_segmentation_arguments(parser):
+    parser.add_argument("--adaptive", type=float, nargs="?", const=pcpp.ADAPTIVE_TOLERANCE, default=None, metavar="TOL",
+                        help="segmenti adattivi alla curvatura (tolleranza in metri, default "
+                             f"{pcpp.ADAPTIVE_TOLERANCE}) invece di {pcpp.k} intervalli uguali per ramo")
+    parser.add_argument("--robust", type=int, nargs="?", const=pcpp.ROBUST_MAX_SAMPLES, default=None, metavar="N",
+                        help="assi e diametri con una PCA robusta agli outlier (foglie, fili), su al più N punti "
+                             f"per ramo e per segmento (default {pcpp.ROBUST_MAX_SAMPLES})")
+    parser.add_argument("--workers", type=int, default=1, metavar="N",
+                        help="distribuisce i rami su N processi (0: tutti i core; default 1, nessun processo in più)")
+
+
+def _add_profiling_arguments(parser):
+    parser.add_argument("--timings", default=None, help="salva tempi e memoria per fase (e contatori per ramo) in JSON")
+    parser.add_argument("--trace", default=None, help="salva le fasi in formato Chrome trace (chrome://tracing, Perfetto)")
+    parser.add_argument("--trace-memory", action="store_true", help="misura la memoria delle fasi con tracemalloc")
+    parser.add_argument("--cprofile", default=None, help="salva il profilo cProfile dell'esecuzione (file .prof)")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="challenge2", description="Analisi dei rami delle pointcloud della vigna")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    analyze = subparsers.add_parser("analyze", help="approssima tronchi e rami e calcola le feature (senza visualizzazione)")
+    analyze.add_argument("datasets", nargs="+", metavar="PCD ANN", help="una o più coppie <pcd> <ann>")
+    analyze.add_argument("--out", required=True, help="file di output: .csv, .jsonl o .parquet (una riga per segmento) oppure .npz (FeatureStore)")
+    analyze.add_argument("--chunk-size", type=int, default=None,
+                         help="legge la nuvola a blocchi di questa dimensione (per nuvole più grandi della RAM)")
+    analyze.add_argument("--incremental", action="store_true",
+                         help="riusa i risultati della run precedente e ricalcola solo gli oggetti modificati")
+    _add_segmentation_arguments(analyze)
+    _add_profiling_arguments(analyze)
+    analyze.set_defaults(func=cmd_analyze)
+
+    run = subparsers.add_parser("campaign", help="analizza tutte le scansioni dei progetti Supervisely sotto una cartella")
+    run.add_argument("root", help="cartella con uno o più progetti (meta.json + key_id_map.json)")
+    run.add_argument("--out", required=True, help="file di output consolidato: .csv, .jsonl, .parquet oppure .npz (FeatureStore)")
+    run.add_argument("--prefetch", type=int, default=2,
+                     help="scansioni caricate in anticipo in background mentre si analizza la corrente (0: nessuna)")
+    run.add_argument("--incremental", action="store_true",
+                     help="riusa i risultati della run precedente e ricalcola solo gli oggetti modificati")
+    _add_segmentation_arguments(run)
+    _add_profiling_arguments(run)
+    run.set_defaults(func=cmd_campaign)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+import numpy as np
+
+import instrumentation
+
+# =========================================================
+# Pianificazione dei tagli di potatura
+# =========================================================
+
+# In main.py i tagli erano un segnaposto: ogni ramo veniva potato con probabilità 0.4,
+# ad un'altezza casuale tra il 20% e il 70% del ramo, rifacendo la PCA del ramo e
+# costruendo una point cloud Open3D per ogni ramo tagliato.
+#
+# Qui i tagli si ricavano dalla tabella delle feature già calcolata (BranchBatch.compute
+# + spatial_index.attach_trunk_segments), per tutti i rami insieme:
+# - cut_features riassume per ogni ramo lunghezza, inclinazione e diametri
+# - una politica (policy) sceglie, per ogni ramo, a che distanza dalla base tagliarlo
+#   (NaN = non si taglia). Le politiche sono funzioni features -> distanze, quindi se ne
+#   può passare una qualunque (con functools.partial per cambiarne i parametri)
+# - plan_cuts percorre la polilinea di ogni ramo dalla base fino a quella distanza e ne
+#   ricava il piano di taglio (punto, normale), con la normale lungo il ramo verso la punta
+#
+# La polilinea di un ramo, dalla base alla punta, è:
+#   estremo di base -> centroidi dei segmenti -> estremo in punta
+# dove gli estremi sono le proiezioni estreme sull'asse principale (proj_min, proj_max),
+# ognuno dalla parte del centroide più vicino.
+# La base è l'estremo più vicino al punto di inserzione sul tronco (il primo centroide
+# se il ramo non è agganciato a un tronco). Le distanze sono lungo la polilinea.
+#
+# Nessun numero casuale: a parità di tabella e di politica i tagli sono sempre gli stessi.
+
+
+def branch_polylines(table):
+    """
+    Polilinee dei rami validi dalla base alla punta, in formato CSR.
+
+    Ritorna:
+        - branches: array (V,) dei rami validi
+        - vertices: array (M,3) dei vertici di tutte le polilinee
+        - offsets: array (V+1,): la polilinea di branches[i] è vertices[offsets[i]:offsets[i+1]]
+        - segments: array (M,) del segmento della tabella di ogni vertice (-1 per gli estremi)
+    """
+    branches = np.flatnonzero(table["valid"])
+    seg_offsets = table["segment_offsets"]
+    first, last = seg_offsets[branches], seg_offsets[branches + 1] - 1
+    centers = table["segment_centers"]
+    pc = table["principal_component"][branches]
+    center = table["center"][branches]
+    low = center + pc * table["proj_min"][branches, None]
+    high = center + pc * table["proj_max"][branches, None]
+
+    # i segmenti sono in ordine lungo il loro asse, che non ha per forza il verso di
+    # principal_component (ad es. con la PCA robusta gli assi dei segmenti adattivi vengono
+    # dalla covarianza di tutti i punti): l'estremo accanto al primo centroide si sceglie
+    # proiettando primo e ultimo centroide sull'asse del ramo
+    flipped = (np.einsum("ij,ij->i", centers[first] - center, pc)
+               > np.einsum("ij,ij->i", centers[last] - center, pc))
+    start = np.where(flipped[:, None], high, low)
+    end = np.where(flipped[:, None], low, high)
+
+    # se la base è l'estremo accanto all'ultimo centroide si percorre il ramo al contrario
+    reverse = np.zeros(len(branches), dtype=bool)
+    if "insertion_point" in table:
+        insertion = table["insertion_point"][branches]
+        with np.errstate(invalid="ignore"):
+            reverse = (np.linalg.norm(centers[last] - insertion, axis=1)
+                       < np.linalg.norm(centers[first] - insertion, axis=1))
+    base = np.where(reverse[:, None], end, start)
+    tip = np.where(reverse[:, None], start, end)
+
+    # ogni polilinea: base, num_segments centroidi, punta
+    counts = last - first + 1
+    offsets = np.concatenate(([0], np.cumsum(counts + 2)))
+    M = offsets[-1]
+    rank = np.arange(M) - np.repeat(offsets[:-1], counts + 2)   # 0..counts+1 in ogni polilinea
+    owner = np.repeat(np.arange(len(branches)), counts + 2)
+    k = rank - 1                                                # posizione tra i centroidi
+    inner = (k >= 0) & (k < counts[owner])
+    segments = np.full(M, -1, dtype=np.int64)
+    segments[inner] = np.where(reverse[owner], last[owner] - k, first[owner] + k)[inner]
+    vertices = np.empty((M, 3))
+    vertices[inner] = centers[segments[inner]]
+    vertices[offsets[:-1]] = base
+    vertices[offsets[1:] - 1] = tip
+    return branches, vertices, offsets, segments
+
+
+def cut_features(table):
+    """
+    Feature per ramo usate dalle politiche di taglio (array di lunghezza num_branches,
+    NaN per i rami non validi):
+        - valid, num_points, inclination_angle
+        - length: lunghezza della polilinea dalla base alla punta
+        - base_diameter: diametro del segmento alla base
+        - mean_diameter: media dei diametri dei segmenti, pesata per numero di punti
+    """
+    B = len(table["valid"])
+    branches, vertices, offsets, segments = branch_polylines(table)
+    steps = np.linalg.norm(np.diff(vertices, axis=0), axis=1)
+    owner = np.repeat(np.arange(len(branches)), np.diff(offsets))
+    same = owner[1:] == owner[:-1]
+    length = np.full(B, np.nan)
+    length[branches] = np.bincount(owner[1:][same], weights=steps[same], minlength=len(branches))
+
+    seg_branch = table["segment_branch"]
+    weights = table["segment_num_points"].astype(float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_diameter = (np.bincount(seg_branch, weights=weights * table["diameters"], minlength=B)
+                         / np.bincount(seg_branch, weights=weights, minlength=B))
+    mean_diameter[~table["valid"]] = np.nan
+    base_diameter = np.full(B, np.nan)
+    base_diameter[branches] = table["diameters"][segments[offsets[:-1] + 1]]
+
+    return {
+        "valid": np.asarray(table["valid"], dtype=bool),
+        "num_points": np.asarray(table["num_points"]),
+        "inclination_angle": np.asarray(table["inclination_angle"], dtype=float),
+        "length": length,
+        "base_diameter": base_diameter,
+        "mean_diameter": mean_diameter,
+    }
+
+
+# ------------------------------
+# Politiche di taglio
+# ------------------------------
+
+def spur_policy(features, spur_length=0.08, min_diameter=0.004, min_inclination=15.0, base_margin=0.01):
+    """
+    Potatura a sperone: i rami lunghi si accorciano a spur_length dalla base (lasciando
+    le prime gemme), i rami deboli (diametro medio sotto min_diameter) e i succhioni che
+    crescono quasi paralleli al tronco (inclinazione sotto min_inclination gradi) si
+    tolgono del tutto, tagliando a base_margin dalla base. I rami già corti non si toccano.
+
+    Ritorna:
+        - array (num_branches,) delle distanze di taglio dalla base (NaN = nessun taglio)
+    """
+    length = features["length"]
+    with np.errstate(invalid="ignore"):
+        remove = features["valid"] & ((features["mean_diameter"] < min_diameter)
+                                      | (features["inclination_angle"] < min_inclination))
+        shorten = features["valid"] & ~remove & (length > spur_length)
+    distance = np.full(len(length), np.nan)
+    distance[shorten] = spur_length
+    distance[remove] = np.minimum(base_margin, length[remove])
+    return distance
+
+
+def fraction_policy(features, fraction=0.5):
+    """Taglia ogni ramo valido a una frazione fissa della sua lunghezza."""
+    return np.where(features["valid"], fraction * features["length"], np.nan)
+
+
+# ------------------------------
+# Piani di taglio
+# ------------------------------
+
+@instrumentation.timed()
+def plan_cuts(table, policy=spur_policy):
+    """
+    Pianifica i tagli di tutti i rami della tabella in un solo passaggio vettorizzato.
+
+    Parametri:
+        - table: tabella delle feature (BranchBatch.compute, meglio se con
+          attach_trunk_segments per sapere dov'è la base dei rami)
+        - policy: funzione features -> distanze di taglio dalla base (vedi spur_policy)
+
+    Ritorna:
+        Un dizionario con, per ognuno dei C tagli:
+            - branch: indice del ramo nella tabella
+            - planes: array (C,2,3) di coppie (punto, normale); la normale è unitaria e
+              punta verso la parte del ramo da rimuovere
+            - distance: distanza del taglio dalla base, lungo la polilinea
+            - diameter: diametro del segmento in cui cade il taglio
+    """
+    B = len(table["valid"])
+    distance = np.asarray(policy(cut_features(table)), dtype=float)
+    if distance.shape != (B,):
+        raise ValueError(f"la politica deve ritornare una distanza per ramo ({B}), non {distance.shape}")
+
+    branches, vertices, offsets, segments = branch_polylines(table)
+    target = distance[branches]
+    keep = np.isfinite(target)
+    branches, target = branches[keep], target[keep]
+    starts, ends = offsets[:-1][keep], offsets[1:][keep]
+
+    # lunghezze cumulate lungo tutte le polilinee (i passi tra polilinee diverse valgono
+    # 0), così un'unica searchsorted trova il tratto di ogni taglio
+    steps = np.linalg.norm(np.diff(vertices, axis=0), axis=1)
+    steps[offsets[1:-1] - 1] = 0.0
+    cumulative = np.concatenate(([0.0], np.cumsum(steps)))
+    position = cumulative[starts] + np.clip(target, 0.0, cumulative[ends - 1] - cumulative[starts])
+    i = np.searchsorted(cumulative, position, side="right") - 1
+    i = np.clip(i, starts, ends - 2)            # tratto [i, i+1] dentro la polilinea
+
+    direction = vertices[i + 1] - vertices[i]
+    step = np.linalg.norm(direction, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.where(step > 0, (position - cumulative[i]) / step, 0.0)
+        normal = direction / step[:, None]
+    # tratti di lunghezza nulla: si usa l'asse principale
+    degenerate = ~(step > 0)
+    normal[degenerate] = table["principal_component"][branches[degenerate]]
+    point = vertices[i] + t[:, None] * direction
+
+    # il diametro del tratto: quello del centroide più vicino tra i due estremi del tratto
+    seg = np.where(((t < 0.5) & (segments[i] >= 0)) | (segments[i + 1] < 0), segments[i], segments[i + 1])
+    return {
+        "branch": branches,
+        "planes": np.stack((point, normal), axis=1),
+        "distance": np.clip(target, 0.0, None),
+        "diameter": table["diameters"][seg],
+    }
+
+
+def removed_points(points, indices, offsets, cuts):
+    """
+    Punti dei rami tagliati che stanno oltre il piano di taglio (la parte rimossa).
+
+    Parametri:
+        - points: array (N,3) della nuvola
+        - indices, offsets: punti di ogni ramo in formato CSR, come per BranchBatch.from_indices
+        - cuts: risultato di plan_cuts
+
+    Ritorna:
+        - cut_indices: indici (nella nuvola) dei punti di tutti i rami tagliati
+        - removed: array booleano, True per i punti di cut_indices oltre il taglio
+    """
+    branches = cuts["branch"]
+    counts = offsets[branches + 1] - offsets[branches]
+    # indici CSR dei soli rami tagliati
+    starts = np.repeat(offsets[branches] - np.concatenate(([0], np.cumsum(counts)[:-1])), counts)
+    cut_indices = np.asarray(indices)[starts + np.arange(counts.sum())]
+    owner = np.repeat(np.arange(len(branches)), counts)
+    point, normal = cuts["planes"][:, 0], cuts["planes"][:, 1]
+    side = np.einsum("ij,ij->i", np.asarray(points)[cut_indices] - point[owner], normal[owner])
+    return cut_indices, side > 0
@@ -0,0 +1,305 @@
+import os
+
+import numpy as np
+
+# =========================================================
+# Archivio colonnare delle feature (uno o più scansioni)
+# =========================================================
+
+# compute_branch_features ritorna dizionari di liste e main.py li stampa con pprint; il
+# blocco pandas commentato in pointcloud_preprocessor mostrava che si voleva una tabella.
+# L'output della CLI (csv/jsonl/parquet) è una riga per segmento, comodo da leggere ma
+# non da interrogare: filtrare i rami o aggregare su migliaia di scansioni vuol dire
+# ricostruire i rami dalle righe.
+#
+# FeatureStore tiene le feature come array a tipo fisso, su tre livelli legati da offset
+# (lo stesso formato CSR della tabella di BranchBatch):
+#
+#   scansioni --scan_offsets--> rami --segment_offsets--> segmenti
+#
+# - scans: una voce per scansione (nome, progetto, dataset, id)
+# - branches: una voce per ramo (feature del ramo + scan, l'indice della sua scansione)
+# - segments: una voce per segmento (diametro, centroide, colore, ...)
+#
+# Tutto si salva in un unico .npz (np.load non esegue codice: allow_pickle=False) e le
+# interrogazioni sono operazioni numpy sulle colonne:
+#
+#   store = FeatureStore.load("campagna.npz")
+#   b = store.branches
+#   thick_short = store.subset((b["mean_diameter"] > 0.006) & (b["branch_length"] < 0.3))
+#   per_scan = store.aggregate("branch_length", by="scan", how="mean")
+#
+# Più archivi (ad es. uno al giorno) si uniscono con FeatureStore.concatenate.
+
+STORE_VERSION = 1
+
+SCAN_COLUMNS = {
+    "scan": str,
+    "project": str,
+    "dataset": str,
+    "scan_id": np.int64,  # id dell'annotazione in key_id_map.json, -1 se sconosciuto
+}
+
+BRANCH_COLUMNS = {
+    "scan": np.int32,     # indice della scansione in scans
+    "object_key": str,
+    "valid": np.bool_,
+    "num_points": np.int32,
+    "num_segments": np.int32,
+    "center": np.float32,
+    "principal_component": np.float32,
+    "branch_length": np.float32,
+    "inclination_angle": np.float32,
+    "insertion_point": np.float32,
+    "mean_diameter": np.float32,
+}
+
+SEGMENT_COLUMNS = {
+    "branch": np.int32,   # indice del ramo in branches
+    "segment_index": np.int32,
+    "num_points": np.int32,
+    "center": np.float32,
+    "diameter": np.float32,
+    "mean_color": np.float32,
+}
+
+# livelli dell'archivio (prefissi delle chiavi nel .npz)
+_LEVELS = ("scans", "branches", "segments")
+
+
+def _column(values, dtype):
+    values = np.asarray(values)
+    if dtype is str:
+        return values.astype(str)
+    return values.astype(dtype, copy=False)
+
+
+def group_reduce(values, groups, num_groups, how="mean"):
+    """
+    Riduzione per gruppo in un solo passaggio (np.bincount / ufunc.at).
+
+    Parametri:
+        - values: array (N,) oppure (N,D)
+        - groups: array (N,) del gruppo di ogni valore, in [0, num_groups)
+        - how: "sum", "mean", "count", "min" o "max" (NaN ignorati; gruppi vuoti: NaN,
+          0 per "sum" e "count")
+
+    Ritorna:
+        - array (num_groups,) oppure (num_groups, D)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    flat = values.reshape(len(values), -1)
+    ok = ~np.isnan(flat)
+    if how == "count":
+        out = np.stack([np.bincount(groups, weights=ok[:, j], minlength=num_groups) for j in range(flat.shape[1])], axis=1)
+    elif how in ("sum", "mean"):
+        out = np.stack([np.bincount(groups, weights=np.where(ok[:, j], flat[:, j], 0.0), minlength=num_groups)
+                        for j in range(flat.shape[1])], axis=1)
+        if how == "mean":
+            counts = np.stack([np.bincount(groups, weights=ok[:, j], minlength=num_groups)
+                               for j in range(flat.shape[1])], axis=1)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                out = out / counts
+    elif how in ("min", "max"):
+        ufunc, fill = (np.fmin, np.inf) if how == "min" else (np.fmax, -np.inf)
+        out = np.full((num_groups, flat.shape[1]), fill)
+        for j in range(flat.shape[1]):
+            ufunc.at(out[:, j], groups, flat[:, j])
+        out[out == fill] = np.nan
+    else:
+        raise ValueError(f"aggregazione sconosciuta: {how}")
+    return out.reshape((num_groups,) + values.shape[1:])
+
+
+class FeatureStore:
+    """
+    Feature di rami e segmenti di una o più scansioni, in colonne a tipo fisso.
+
+    Attributi:
+        - scans, branches, segments: dizionari nome -> array (vedi SCAN_COLUMNS,
+          BRANCH_COLUMNS, SEGMENT_COLUMNS)
+        - scan_offsets: array (num_scans+1,): i rami della scansione s sono
+          branches[scan_offsets[s]:scan_offsets[s+1]]
+        - segment_offsets: array (num_branches+1,): i segmenti del ramo b sono
+          segments[segment_offsets[b]:segment_offsets[b+1]]
+    """
+
+    def __init__(self, scans, branches, segments):
+        self.scans = {name: _column(scans[name], dtype) for name, dtype in SCAN_COLUMNS.items()}
+        self.branches = {name: _column(branches[name], dtype) for name, dtype in BRANCH_COLUMNS.items()}
+        self.segments = {name: _column(segments[name], dtype) for name, dtype in SEGMENT_COLUMNS.items()}
+        self.scan_offsets = np.concatenate(([0], np.cumsum(np.bincount(self.branches["scan"], minlength=self.num_scans))))
+        self.segment_offsets = np.concatenate(([0], np.cumsum(self.branches["num_segments"], dtype=np.int64)))
+
+    @property
+    def num_scans(self):
+        return len(self.scans["scan"])
+
+    @property
+    def num_branches(self):
+        return len(self.branches["scan"])
+
+    @property
+    def num_segments(self):
+        return len(self.segments["branch"])
+
+    def __repr__(self):
+        return f"FeatureStore({self.num_scans} scans, {self.num_branches} branches, {self.num_segments} segments)"
+
+    @classmethod
+    def empty(cls):
+        def columns(spec, shapes):
+            return {name: np.zeros((0,) + shapes.get(name, ()), dtype=str if t is str else t) for name, t in spec.items()}
+        vec3 = {"center": (3,), "principal_component": (3,), "insertion_point": (3,), "mean_color": (3,)}
+        return cls(columns(SCAN_COLUMNS, {}), columns(BRANCH_COLUMNS, vec3), columns(SEGMENT_COLUMNS, vec3))
+
+    @classmethod
+    def from_result(cls, result, project="", dataset="", scan_id=None):
+        """
+        Archivio di una scansione a partire dal risultato di analysis.analyze_scan
+        (o incremental.analyze_scan_incremental / campaign.run_campaign).
+        """
+        table, index = result["table"], result["index"]
+        B = len(result["branch_objects"])
+        seg_branch = table["segment_branch"]
+        counts = np.diff(table["segment_offsets"])
+        weights = table["segment_num_points"].astype(np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean_diameter = (np.bincount(seg_branch, weights=weights * table["diameters"], minlength=B)
+                             / np.bincount(seg_branch, weights=weights, minlength=B))
+        if scan_id is None:
+            scan_id = result.get("scan_id")
+        scans = {
+            "scan": [result["scan"]],
+            "project": [project],
+            "dataset": [dataset],
+            "scan_id": [-1 if scan_id is None else scan_id],
+        }
+        branches = {
+            "scan": np.zeros(B),
+            "object_key": index.object_keys[result["branch_objects"]],
+            "valid": table["valid"],
+            "num_points": table["num_points"],
+            "num_segments": counts,
+            "center": table["center"],
+            "principal_component": table["principal_component"],
+            "branch_length": table["branch_length"],
+            "inclination_angle": table["inclination_angle"],
+            "insertion_point": table["insertion_point"] if "insertion_point" in table else np.full((B, 3), np.nan),
+            "mean_diameter": mean_diameter,
+        }
+        segments = {
+            "branch": seg_branch,
+            "segment_index": np.arange(len(seg_branch)) - table["segment_offsets"][seg_branch],
+            "num_points": table["segment_num_points"],
+            "center": table["segment_centers"],
+            "diameter": table["diameters"],
+            "mean_color": table["mean_colors"],
+        }
+        return cls(scans, branches, segments)
+
+    @classmethod
+    def concatenate(cls, stores):
+        """Unisce più archivi (in ordine), rinumerando gli indici di scansioni e rami."""
+        stores = list(stores)
+        if not stores:
+            return cls.empty()
+        scan_shift = np.cumsum([0] + [s.num_scans for s in stores[:-1]])
+        branch_shift = np.cumsum([0] + [s.num_branches for s in stores[:-1]])
+
+        def merged(level, shifted=None, shifts=None):
+            columns = {}
+            for name in getattr(stores[0], level):
+                parts = [getattr(s, level)[name] for s in stores]
+                if name == shifted:
+                    parts = [p + shift for p, shift in zip(parts, shifts)]
+                columns[name] = np.concatenate(parts)
+            return columns
+
+        return cls(merged("scans"), merged("branches", "scan", scan_shift),
+                   merged("segments", "branch", branch_shift))
+
+    # ------------------------------
+    # Salvataggio
+    # ------------------------------
+
+    def save(self, path):
+        """Salva l'archivio in un .npz (scrittura atomica)."""
+        arrays = {"version": np.array(STORE_VERSION)}
+        for level in _LEVELS:
+            for name, values in getattr(self, level).items():
+                arrays[f"{level}/{name}"] = values
+        tmp_path = os.fspath(path) + ".tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as z:
+            if int(z["version"]) != STORE_VERSION:
+                raise ValueError("versione dell'archivio delle feature non supportata")
+            columns = {level: {} for level in _LEVELS}
+            for key in z.files:
+                if "/" in key:
+                    level, name = key.split("/", 1)
+                    columns[level][name] = z[key]
+        return cls(columns["scans"], columns["branches"], columns["segments"])
+
+    # ------------------------------
+    # Interrogazioni
+    # ------------------------------
+
+    def branch_column(self, name):
+        """Colonna di scansione (name di SCAN_COLUMNS) ripetuta per ogni ramo."""
+        return self.scans[name][self.branches["scan"]]
+
+    def segment_column(self, name):
+        """Colonna di ramo (name di BRANCH_COLUMNS) ripetuta per ogni segmento."""
+        return self.branches[name][self.segments["branch"]]
+
+    def subset(self, branch_mask):
+        """
+        Archivio con i soli rami selezionati (maschera booleana o indici) e i loro
+        segmenti; le scansioni restano tutte, così gli indici di scansione non cambiano.
+        """
+        selected = np.arange(self.num_branches)[branch_mask]
+        counts = self.branches["num_segments"][selected].astype(np.int64)
+        # indici dei segmenti dei rami scelti, senza cicli: per ogni segmento in uscita,
+        # inizio del suo ramo + posizione nel ramo
+        starts = np.repeat(self.segment_offsets[selected], counts)
+        rank = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        segment_rows = starts + rank
+        branches = {name: values[selected] for name, values in self.branches.items()}
+        segments = {name: values[segment_rows] for name, values in self.segments.items()}
+        segments["branch"] = np.repeat(np.arange(len(selected)), counts)
+        return FeatureStore(self.scans, branches, segments)
+
+    def aggregate(self, column, by="scan", how="mean", level=None):
+        """
+        Aggrega una colonna di rami o di segmenti per gruppo.
+
+        Parametri:
+            - column: nome di una colonna di branches o di segments
+            - by: "scan" (per scansione), "branch" (per ramo, solo colonne dei segmenti),
+              oppure il nome di una colonna di scans (ad es. "project", "dataset"): i gruppi
+              sono allora i valori distinti di quella colonna
+            - how: vedi group_reduce
+            - level: "branches" o "segments", se column esiste in entrambi (default:
+              branches se c'è, altrimenti segments)
+
+        Ritorna:
+            - keys: le chiavi dei gruppi (nomi delle scansioni, indici dei rami o valori di by)
+            - values: il valore aggregato di ogni gruppo
+        """
+        level = level or ("branches" if column in self.branches else "segments")
+        values = getattr(self, level)[column]
+        branch = np.arange(self.num_branches) if level == "branches" else self.segments["branch"]
+        if by == "branch":
+            if level != "segments":
+                raise ValueError("by='branch' vale solo per colonne dei segmenti")
+            return np.arange(self.num_branches), group_reduce(values, branch, self.num_branches, how)
+        scan = self.branches["scan"][branch]
+        if by == "scan":
+            return self.scans["scan"], group_reduce(values, scan, self.num_scans, how)
+        keys, scan_group = np.unique(self.scans[by], return_inverse=True)
+        return keys, group_reduce(values, scan_group[scan], len(keys), how)
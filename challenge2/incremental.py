@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import pointcloud_preprocessor as pcpp
+import pcd_cache
+import annotation_index
+import analysis
+import instrumentation
+
+# =========================================================
+# Ri-analisi incrementale quando cambiano le annotazioni
+# =========================================================
+
+# I labeller modificano il JSON delle annotazioni un oggetto alla volta (updatedAt per
+# oggetto), ma ad ogni modifica si rifaceva tutta l'analisi. Qui i risultati vengono
+# salvati per oggetto in una cache persistente accanto al JSON, con chiave:
+#   - key dell'oggetto
+#   - hash dei suoi indici (se il labeller aggiunge/toglie punti, l'hash cambia)
+#   - parametri del preprocessor (seg_polilinea) e sha256 del PCD (se cambiano, si butta tutto)
+#
+# Ad ogni run si ricalcolano solo i rami aggiunti o modificati (i rimossi spariscono dalla
+# cache). Le polilinee dei tronchi si ricalcolano solo se cambia qualche oggetto Tree; le
+# inclinazioni (e i punti di inserzione) dipendono dai tronchi, ma si ricavano in un attimo
+# dagli assi e dai centroidi dei rami già salvati, quindi vengono sempre ricalcolate.
+
+CACHE_SUFFIX = ".features.json"
+CACHE_VERSION = 1
+
+
+def default_cache_path(ann_path):
+    return os.fspath(ann_path) + CACHE_SUFFIX
+
+
+def index_hash(indices):
+    """Hash (blake2b) dell'insieme di indici di un oggetto."""
+    return hashlib.blake2b(np.ascontiguousarray(indices, dtype=np.int32).tobytes(), digest_size=16).hexdigest()
+
+
+def _params(tolerance=None, robust_samples=None):
+    params = {"seg_polilinea": pcpp.seg_polilinea}
+    if tolerance is not None:
+        params.update(adaptive_tolerance=tolerance, adaptive_max_depth=pcpp.ADAPTIVE_MAX_DEPTH,
+                      adaptive_min_points=pcpp.ADAPTIVE_MIN_POINTS, adaptive_min_aspect=pcpp.ADAPTIVE_MIN_ASPECT)
+    if robust_samples is not None:
+        params.update(robust_samples=robust_samples, robust_iterations=pcpp.ROBUST_ITERATIONS,
+                      robust_cutoff=pcpp.ROBUST_CUTOFF)
+    return params
+
+
+def _load_cache(cache_path, params, pcd_sha256):
+    empty = {"version": CACHE_VERSION, "params": params, "pcd_sha256": pcd_sha256,
+             "trees": None, "branches": {}}
+    if not os.path.exists(cache_path):
+        return empty
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except ValueError:
+        return empty
+    if (cache.get("version") != CACHE_VERSION or cache.get("params") != params
+            or cache.get("pcd_sha256") != pcd_sha256):
+        return empty
+    return cache
+
+
+def _save_cache(cache_path, cache):
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, cache_path)
+
+
+def _branch_entries(table):
+    """Spezza la tabella colonnare di BranchBatch in una voce (serializzabile) per ramo."""
+    entries = []
+    for b in range(len(table["valid"])):
+        s, e = table["segment_offsets"][b], table["segment_offsets"][b+1]
+        entries.append({
+            "valid": bool(table["valid"][b]),
+            "num_points": int(table["num_points"][b]),
+            "center": table["center"][b].tolist(),
+            "principal_component": table["principal_component"][b].tolist(),
+            "proj_min": float(table["proj_min"][b]),
+            "proj_max": float(table["proj_max"][b]),
+            "branch_length": float(table["branch_length"][b]),
+            "segment_index": table["segment_index"][s:e].tolist(),
+            "segment_num_points": table["segment_num_points"][s:e].tolist(),
+            "segment_centers": table["segment_centers"][s:e].tolist(),
+            "diameters": table["diameters"][s:e].tolist(),
+            "mean_colors": table["mean_colors"][s:e].tolist(),
+        })
+    return entries
+
+
+def _table_from_entries(entries, tree_dir):
+    """Ricompone la tabella colonnare (formato di BranchBatch.compute) dalle voci per ramo."""
+    def column(name, shape=()):
+        values = [np.asarray(e[name], dtype=float).reshape((-1,) + shape) for e in entries]
+        return np.concatenate(values) if values else np.zeros((0,) + shape)
+
+    segs_per_branch = np.array([len(e["diameters"]) for e in entries], dtype=np.int64)
+    principal_components = np.array([e["principal_component"] for e in entries], dtype=float).reshape(-1, 3)
+    return {
+        "valid": np.array([e["valid"] for e in entries], dtype=bool),
+        "num_points": np.array([e["num_points"] for e in entries], dtype=np.int64),
+        "center": np.array([e["center"] for e in entries], dtype=float).reshape(-1, 3),
+        "principal_component": principal_components,
+        "proj_min": np.array([e["proj_min"] for e in entries], dtype=float),
+        "proj_max": np.array([e["proj_max"] for e in entries], dtype=float),
+        "branch_length": np.array([e["branch_length"] for e in entries], dtype=float),
+        "inclination_angle": pcpp.inclination_angles(principal_components, tree_dir),
+        "segment_offsets": np.concatenate(([0], np.cumsum(segs_per_branch))),
+        "segment_branch": np.repeat(np.arange(len(entries)), segs_per_branch),
+        "segment_index": column("segment_index").astype(np.int64),
+        "segment_num_points": column("segment_num_points").astype(np.int64),
+        "segment_centers": column("segment_centers", (3,)),
+        "diameters": column("diameters"),
+        "mean_colors": column("mean_colors", (3,)),
+    }
+
+
+@instrumentation.timed()
+def analyze_scan_incremental(pcd_path, ann_path, cache_path=None, tolerance=None, robust_samples=None, workers=1):
+    """
+    Come analysis.analyze_scan, ma riusando i risultati per oggetto della run precedente.
+
+    Parametri:
+        - pcd_path, ann_path: file .pcd e relativo ann/*.pcd.json
+        - cache_path: cache dei risultati (default: accanto al JSON, suffisso .features.json)
+        - tolerance: segmentazione adattiva (vedi analysis.analyze_scan); fa parte dei
+          parametri della cache, quindi cambiarla invalida i risultati salvati
+        - robust_samples: PCA robusta dei rami (vedi analysis.analyze_scan); come tolerance
+          fa parte dei parametri della cache
+        - workers: processi su cui distribuire i rami da ricalcolare (vedi analysis.branch_table)
+
+    Ritorna:
+        - lo stesso dizionario di analysis.analyze_scan, con in più "stats":
+          numero di rami ricalcolati, riusati e rimossi, e se i tronchi sono stati ricalcolati
+    """
+    cache_path = cache_path or default_cache_path(ann_path)
+    index = annotation_index.load_annotation_index(ann_path)
+    cache = _load_cache(cache_path, _params(tolerance, robust_samples), pcd_cache.source_hash(pcd_path))
+
+    # punti e colori servono solo per gli oggetti da ricalcolare: la nuvola è un memmap,
+    # quindi qui non si legge nulla finché non si indicizza
+    xyz, rgb = pcd_cache.load_point_cloud(pcd_path)
+
+    def gather(indices):
+        points = pcpp.compact_points(xyz[indices])
+        colors = rgb[indices] if rgb is not None else np.full(points.shape, 128, dtype=pcpp.COLOR_DTYPE)
+        return points, colors
+
+    # ------------------------------
+    # 1. TRONCHI (solo se cambiati)
+    # ------------------------------
+    tree_objects = index.objects_of_class(analysis.TREE_CLASS)
+    tree_signature = [[str(index.object_keys[o]), index_hash(index.object_indices(o))] for o in tree_objects]
+    trees_recomputed = cache["trees"] is None or cache["trees"]["signature"] != tree_signature
+    if trees_recomputed:
+        trees = []
+        for o in tree_objects:
+            points, colors = gather(index.object_indices(o))
+            if len(points) < 2:
+                continue
+            res = pcpp.approximate_branch(points, colors, with_pc_line=False,
+                                          mode="binned" if tolerance is None else "adaptive", tolerance=tolerance)
+            if res[3] is None:
+                continue
+            trees.append({"key": str(index.object_keys[o]), "principal_component": res[2].tolist(),
+                          "centers": res[3].tolist()})
+        cache["trees"] = {"signature": tree_signature, "trees": trees}
+    trees = [{"object": index.object_position(t["key"]), "principal_component": np.array(t["principal_component"]),
+              "centers": np.array(t["centers"])} for t in cache["trees"]["trees"]]
+    # come in main.py: si usa la direzione dell'ultimo tronco
+    tree_dir = trees[-1]["principal_component"] if trees else np.array([0.0, 0.0, 1.0])
+
+    # ------------------------------
+    # 2. RAMI (solo aggiunti o modificati)
+    # ------------------------------
+    branch_objects = index.objects_of_class(analysis.BRANCH_CLASS)
+    keys = [str(index.object_keys[o]) for o in branch_objects]
+    hashes = [index_hash(index.object_indices(o)) for o in branch_objects]
+    cached = cache["branches"]
+    stale = [i for i, (key, h) in enumerate(zip(keys, hashes))
+             if key not in cached or cached[key]["index_hash"] != h]
+    removed = set(cached) - set(keys)
+
+    if stale:
+        stale_indices, stale_offsets = index.subset(branch_objects[stale])
+        points, colors = gather(stale_indices)
+        # i punti raccolti sono già nell'ordine del sotto-CSR
+        table = analysis.branch_table(points, colors, np.arange(len(points)), stale_offsets, tree_dir,
+                                      tolerance=tolerance, robust_samples=robust_samples, workers=workers)
+        for i, entry in zip(stale, _branch_entries(table)):
+            cached[keys[i]] = {"index_hash": hashes[i], "updated_at": str(index.object_updated_at[branch_objects[i]]),
+                               "entry": entry}
+    for key in removed:
+        del cached[key]
+
+    if trees_recomputed or stale or removed:
+        _save_cache(cache_path, cache)
+
+    table = _table_from_entries([cached[key]["entry"] for key in keys], tree_dir)
+    analysis.attach_trunks(table, trees)
+    result = {
+        "scan": analysis.scan_name(pcd_path),
+        "index": index,
+        "branch_objects": branch_objects,
+        "table": table,
+        "tree_dir": tree_dir,
+        "trees": trees,
+        "stats": {"recomputed": len(stale), "reused": len(keys) - len(stale), "removed": len(removed),
+                  "trees_recomputed": trees_recomputed},
+    }
+    analysis.record_branch_counters(result)
+    return result
@@ -0,0 +1,272 @@
+import cProfile
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# =========================================================
+# Misura di tempi e memoria delle fasi della pipeline
+# =========================================================
+
+# Finora l'unica traccia di dove va il tempo erano i print("[INFO] ..."). Qui c'è un
+# registratore (Profiler) che, se attivato, raccoglie:
+# - le fasi (stage): nome, inizio, durata, annidamento e memoria. La memoria per fase è
+#   quella allocata da Python/numpy secondo tracemalloc (corrente a fine fase e picco
+#   durante la fase) e si misura solo se si attiva trace_memory. Senza trace_memory ogni
+#   fase riporta il picco di RSS dell'intero processo fino alla sua fine (max_rss): non
+#   è la memoria della fase, e nel riepilogo compare solo come valore del processo
+# - contatori per elemento (items): ad es. per ogni ramo numero di punti, segmenti e tempo
+#
+# Le fasi si marcano con il context manager stage() o con il decoratore timed(); quando
+# il registratore non è attivo costano un controllo e poco più, quindi restano nel codice.
+# Il risultato si esporta in JSON (save_json) oppure nel formato "Trace Event" di
+# Chrome (save_chrome_trace), che si apre con chrome://tracing o https://ui.perfetto.dev.
+#
+# Per il dettaglio funzione per funzione c'è cprofile(), che salva le statistiche di
+# cProfile (da leggere con pstats o snakeviz).
+
+_active = None
+
+
+class Profiler:
+    """
+    Registro delle fasi e dei contatori di una run.
+
+    Parametri:
+        - trace_memory: misura la memoria di ogni fase con tracemalloc (rallenta le
+          allocazioni); senza, si registra solo il picco di RSS del processo
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.events = []
+        self.items = {}
+        self._origin = time.perf_counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # tracemalloc si ferma in close() solo se l'ha avviato questo registratore:
+        # se il chiamante lo stava già usando resta attivo
+        self._started_tracing = trace_memory and not tracemalloc.is_tracing()
+        if self._started_tracing:
+            tracemalloc.start()
+
+    def close(self):
+        """Ferma tracemalloc se l'ha avviato questo registratore."""
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def stage(self, name, **args):
+        stack = self._stack()
+        entry = {"peak": 0}
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # il picco accumulato fin qui appartiene alla fase che ci contiene
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+            tracemalloc.reset_peak()
+            entry["start_memory"] = current
+        stack.append(entry)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            stack.pop()
+            event = {
+                "name": name,
+                "start": start - self._origin,
+                "duration": end - start,
+                "depth": len(stack),
+                "thread": threading.get_ident(),
+            }
+            if args:
+                event["args"] = args
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                peak = max(entry["peak"], peak)
+                event["memory"] = current
+                event["memory_delta"] = current - entry["start_memory"]
+                event["memory_peak"] = peak
+                if stack:
+                    stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+                tracemalloc.reset_peak()
+            elif resource is not None:
+                # ru_maxrss è in KiB su Linux
+                event["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            with self._lock:
+                self.events.append(event)
+
+    def add_items(self, category, **columns):
+        """
+        Aggiunge contatori per elemento: ogni colonna è un array (o lista) con un valore per
+        elemento, tutte della stessa lunghezza. Chiamate successive accodano.
+        """
+        columns = {k: np.asarray(v).tolist() for k, v in columns.items()}
+        with self._lock:
+            table = self.items.setdefault(category, {})
+            for key, values in columns.items():
+                table.setdefault(key, []).extend(values)
+
+    def summary(self):
+        """Tempi aggregati per nome di fase: numero di chiamate, totale, massimo (e picco di memoria)."""
+        summary = {}
+        for event in self.events:
+            s = summary.setdefault(event["name"], {"calls": 0, "total": 0.0, "max": 0.0})
+            s["calls"] += 1
+            s["total"] += event["duration"]
+            s["max"] = max(s["max"], event["duration"])
+            if "memory_peak" in event:
+                s["memory_peak"] = max(s.get("memory_peak", 0), event["memory_peak"])
+        return summary
+
+    def max_rss(self):
+        """Picco di RSS del processo (byte) alla fine dell'ultima fase, None se non misurato."""
+        values = [event["max_rss"] for event in self.events if "max_rss" in event]
+        return max(values) if values else None
+
+    def to_dict(self):
+        return {
+            "trace_memory": self.trace_memory,
+            "max_rss": self.max_rss(),
+            "summary": self.summary(),
+            "events": self.events,
+            "items": self.items,
+        }
+
+    def save_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def save_chrome_trace(self, path):
+        """Salva le fasi come eventi "complete" (ph = X) del formato Trace Event di Chrome."""
+        pid = os.getpid()
+        trace = []
+        for event in self.events:
+            args = dict(event.get("args", {}))
+            for key in ("memory", "memory_delta", "memory_peak", "max_rss"):
+                if key in event:
+                    args[key] = event[key]
+            trace.append({
+                "name": event["name"],
+                "ph": "X",
+                "ts": event["start"] * 1e6,
+                "dur": event["duration"] * 1e6,
+                "pid": pid,
+                "tid": event["thread"],
+                "args": {k: _jsonable(v) for k, v in args.items()},
+            })
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+    def print_summary(self, file=None):
+        for name, s in sorted(self.summary().items(), key=lambda kv: -kv[1]["total"]):
+            memory = f"  peak {s['memory_peak'] / 2**20:8.1f} MiB" if "memory_peak" in s else ""
+            print(f"    {name:32s} {s['calls']:6d} calls  {s['total']*1e3:10.2f} ms total  "
+                  f"{s['max']*1e3:10.2f} ms max{memory}", file=file)
+        max_rss = self.max_rss()
+        if max_rss is not None:
+            print(f"    process max RSS {max_rss / 2**20:.1f} MiB (whole process, not per stage; "
+                  "use trace_memory for per-stage memory)", file=file)
+
+
+def _jsonable(value):
+    if isinstance(value, (np.integer, np.floating)):
+        return value.item()
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+# ------------------------------
+# Interfaccia a livello di modulo
+# ------------------------------
+
+def enable(trace_memory=False):
+    """
+    Attiva un nuovo registratore globale e lo ritorna. Con trace_memory la memoria si
+    misura per fase con tracemalloc (avviato qui se non è già attivo e fermato da
+    disable() solo in quel caso); senza, si registra solo il picco di RSS del processo.
+    """
+    global _active
+    if _active is not None:
+        _active.close()
+    _active = Profiler(trace_memory=trace_memory)
+    return _active
+
+
+def disable():
+    """Disattiva il registratore globale e lo ritorna (per esportarne i risultati)."""
+    global _active
+    profiler, _active = _active, None
+    if profiler is not None:
+        profiler.close()
+    return profiler
+
+
+def active():
+    """Il registratore globale, oppure None se non attivo."""
+    return _active
+
+
+@contextmanager
+def stage(name, **args):
+    """Marca una fase: registrata solo se il registratore globale è attivo."""
+    profiler = _active
+    if profiler is None:
+        yield
+        return
+    with profiler.stage(name, **args):
+        yield
+
+
+def timed(name=None):
+    """Decoratore: ogni chiamata della funzione è una fase (di default con il nome della funzione)."""
+    def decorator(fn):
+        stage_name = name or fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return fn(*args, **kwargs)
+            with _active.stage(stage_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_items(category, **columns):
+    """Contatori per elemento (vedi Profiler.add_items), ignorati se il registratore non è attivo."""
+    if _active is not None:
+        _active.add_items(category, **columns)
+
+
+@contextmanager
+def cprofile(path):
+    """Profila con cProfile il blocco e salva le statistiche in path (se path è None non fa nulla)."""
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
@@ -0,0 +1,167 @@
+import numpy as np
+
+# =========================================================
+# Autovalori/autovettori di matrici simmetriche 3x3, vettorizzati
+# =========================================================
+
+# Le covarianze dei rami e dei segmenti sono matrici 3x3 simmetriche (semi)definite
+# positive. np.linalg.eig è il solver generale per matrici non simmetriche (può anche
+# ritornare valori complessi) e per ogni chiamata paga l'overhead di LAPACK: con milioni
+# di segmenti è quello il collo di bottiglia.
+#
+# Qui gli autovalori si calcolano in forma chiusa (metodo trigonometrico) e gli
+# autovettori con prodotti vettoriali, tutto vettorizzato su stack (M,3,3).
+# Riferimento: D. Eberly, "A Robust Eigensolver for 3x3 Symmetric Matrices".
+#
+# In breve:
+# - scaliamo A per il suo elemento di modulo massimo (evita overflow/underflow)
+# - con q = trace(A)/3 e p = sqrt(trace((A-qI)^2)/6), la matrice B = (A-qI)/p ha
+#   autovalori 2cos(phi), 2cos(phi + 2pi/3), 2cos(phi + 4pi/3) con phi = acos(det(B)/2)/3
+# - l'autovettore dell'autovalore "più isolato" (il massimo se det(B) >= 0, altrimenti il
+#   minimo) è il prodotto vettoriale più lungo tra due righe di (A - lambda I)
+# - gli altri due si trovano diagonalizzando (con una rotazione di Jacobi) la matrice 2x2
+#   che A induce nel piano ortogonale al primo: così restano accurati anche quando sono
+#   quasi uguali, come le due varianze della sezione circolare di un ramo
+
+
+def _cross_rows_eigenvector(A, lam):
+    """Autovettore di un autovalore semplice: prodotto vettoriale più lungo tra le righe di A - lam I."""
+    r = A - lam[:, None, None] * np.eye(3)
+    r0, r1, r2 = r[:, 0], r[:, 1], r[:, 2]
+    candidates = np.stack((np.cross(r0, r1), np.cross(r0, r2), np.cross(r1, r2)), axis=1)
+    norms2 = np.einsum("mij,mij->mi", candidates, candidates)
+    best = np.argmax(norms2, axis=1)
+    vec = candidates[np.arange(len(A)), best]
+    length = np.sqrt(norms2[np.arange(len(A)), best])
+    # length == 0 solo se A = lam I (autovalore triplo): va bene qualunque vettore
+    degenerate = ~(length > 0)
+    vec[degenerate] = [1.0, 0.0, 0.0]
+    length[degenerate] = 1.0
+    return vec / length[:, None]
+
+
+def _orthogonal_complement(w):
+    """Due vettori u, v tali che (u, v, w) sia una base ortonormale."""
+    u = np.zeros_like(w)
+    use_x = np.abs(w[:, 0]) > np.abs(w[:, 1])
+    inv = 1.0 / np.sqrt(np.where(use_x, w[:, 0]**2 + w[:, 2]**2, w[:, 1]**2 + w[:, 2]**2))
+    u[:, 0] = np.where(use_x, -w[:, 2] * inv, 0.0)
+    u[:, 1] = np.where(use_x, 0.0, w[:, 2] * inv)
+    u[:, 2] = np.where(use_x, w[:, 0] * inv, -w[:, 1] * inv)
+    v = np.cross(w, u)
+    return u, v
+
+
+def _plane_eigensystem(A, w):
+    """
+    Autovalori e autovettori di A nel piano ortogonale a w (autovettore già noto).
+    Il problema si riduce a una matrice 2x2 simmetrica, diagonalizzata con una rotazione
+    di Jacobi: formule stabili anche quando i due autovalori sono quasi uguali
+    (caso tipico: la sezione circolare di un ramo).
+    """
+    u, v = _orthogonal_complement(w)
+    Au = np.einsum("mij,mj->mi", A, u)
+    Av = np.einsum("mij,mj->mi", A, v)
+    a = np.einsum("mi,mi->m", u, Au)
+    b = np.einsum("mi,mi->m", u, Av)
+    c = np.einsum("mi,mi->m", v, Av)
+
+    # rotazione di Jacobi che annulla b: t = tan(angolo), scelta nel ramo |angolo| <= pi/4
+    with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+        theta = (c - a) / (2.0 * b)
+        t = np.sign(theta) / (np.abs(theta) + np.sqrt(theta*theta + 1.0))
+    t = np.where(b == 0, 0.0, t)
+    cos = 1.0 / np.sqrt(t*t + 1.0)
+    sin = t * cos
+    lam_u = a - t * b
+    lam_v = c + t * b
+    vec_u = cos[:, None] * u - sin[:, None] * v
+    vec_v = sin[:, None] * u + cos[:, None] * v
+    return lam_u, vec_u, lam_v, vec_v
+
+
+def _scaled_eigenvalues(A):
+    """Autovalori (crescenti, formula trigonometrica) di A già scalata, più det(B)/2."""
+    q = np.trace(A, axis1=1, axis2=2) / 3.0
+    Aq = A - q[:, None, None] * np.eye(3)
+    p2 = np.einsum("mij,mij->m", Aq, Aq) / 6.0
+    p = np.sqrt(p2)
+    isotropic = ~(p > 0)
+    p_safe = np.where(isotropic, 1.0, p)
+    half_det = np.linalg.det(Aq / p_safe[:, None, None]) / 2.0
+    half_det = np.clip(half_det, -1.0, 1.0)
+    angle = np.arccos(half_det) / 3.0
+    beta2 = 2.0 * np.cos(angle)
+    beta0 = 2.0 * np.cos(angle + 2.0*np.pi/3.0)
+    beta1 = -(beta0 + beta2)
+    eigvals = q[:, None] + p[:, None] * np.stack((beta0, beta1, beta2), axis=1)
+    eigvals[isotropic] = q[isotropic, None]
+    return eigvals, half_det, isotropic
+
+
+def _prepare(A):
+    A = np.asarray(A, dtype=np.float64)
+    single = A.ndim == 2
+    A = A.reshape(-1, 3, 3)
+    # usiamo solo il triangolo superiore, come eigh (UPLO="U")
+    A = np.triu(A) + np.swapaxes(np.triu(A, 1), 1, 2)
+    scale = np.max(np.abs(A), axis=(1, 2))
+    scale = np.where(scale > 0, scale, 1.0)
+    return A / scale[:, None, None], scale, single
+
+
+def eigvalsh3(A):
+    """
+    Autovalori di una o più matrici simmetriche 3x3, in ordine crescente (come np.linalg.eigvalsh).
+
+    Parametri:
+        - A: array (3,3) oppure stack (M,3,3)
+
+    Ritorna:
+        - array (3,) oppure (M,3)
+    """
+    return eigh3(A)[0]
+
+
+def eigh3(A):
+    """
+    Autovalori e autovettori di una o più matrici simmetriche 3x3 (come np.linalg.eigh).
+
+    Parametri:
+        - A: array (3,3) oppure stack (M,3,3)
+
+    Ritorna:
+        - eigvals: autovalori in ordine crescente, (3,) oppure (M,3)
+        - eigvecs: autovettori come colonne, (3,3) oppure (M,3,3): eigvecs[..., :, i] è
+          l'autovettore di eigvals[..., i]
+    """
+    As, scale, single = _prepare(A)
+    eigvals, half_det, isotropic = _scaled_eigenvalues(As)
+    M = len(As)
+
+    # autovalore più isolato: il massimo se det(B) >= 0, altrimenti il minimo.
+    # Il suo autovettore è ben condizionato; gli altri due si ricavano nel piano ortogonale
+    lam_first = np.where(half_det >= 0, eigvals[:, 2], eigvals[:, 0])
+    v_first = _cross_rows_eigenvector(As, lam_first)
+    lam_u, v_u, lam_v, v_v = _plane_eigensystem(As, v_first)
+    # la formula trigonometrica perde precisione vicino ad autovalori doppi: per l'autovalore
+    # isolato usiamo il quoziente di Rayleigh, più accurato
+    lam_first = np.einsum("mi,mij,mj->m", v_first, As, v_first)
+
+    values = np.stack((lam_first, lam_u, lam_v), axis=1)
+    vectors = np.stack((v_first, v_u, v_v), axis=2)
+    order = np.argsort(values, axis=1)
+    eigvals = np.take_along_axis(values, order, axis=1)
+    eigvecs = np.take_along_axis(vectors, order[:, None, :], axis=2)
+
+    eigvecs[isotropic] = np.eye(3)
+    eigvals[isotropic] = np.trace(As[isotropic], axis1=1, axis2=2)[:, None] / 3.0
+    # matrici con NaN/inf: risultati NaN, invece di un autovettore qualsiasi
+    invalid = ~np.all(np.isfinite(As), axis=(1, 2))
+    eigvecs[invalid] = np.nan
+    eigvals[invalid] = np.nan
+
+    eigvals = eigvals * scale[:, None]
+    if single:
+        return eigvals[0], eigvecs[0]
+    return eigvals, eigvecs
@@ -1,24 +1,54 @@
 import open3d as o3d
-import json
 import numpy as np
-from collections import defaultdict
 from pprint import pprint
-import random
 
 import pointcloud_preprocessor as pcpp
+import analysis
+import pcd_cache
+import spatial_index
+import instrumentation
 import visualization_stuff
+import cut_planner
+import feature_store
+import pcd_io
 
 PCD_PATH = "./Vineyard Pointcloud/dataset 2025-10-03 09-46-48/pointcloud/pc_color_filtered.pcd"
 ANN_PATH = "./Vineyard Pointcloud/dataset 2025-10-03 09-46-48/ann/pc_color_filtered.pcd.json"
-
-pcd = o3d.io.read_point_cloud(PCD_PATH)
-points = np.asarray(pcd.points)
-colors = np.asarray(pcd.colors)
-print(f"[INFO] Loaded {len(points)} points.")
-
-print("[INFO] Loading annotations...")
-with open(ANN_PATH, "r") as f:
-    data = json.load(f)
+# lato dei voxel della nuvola visualizzata (0 = risoluzione piena): i calcoli usano
+# sempre tutti i punti, la visualizzazione non ne ha bisogno
+DISPLAY_VOXEL_SIZE = 0.005
+# se dato, tempi e memoria delle fasi vengono salvati in questo file in formato Chrome trace
+# (vedi instrumentation.py); il riepilogo viene stampato alla fine
+PROFILE_TRACE = None  # ad es. "main.trace.json"
+# se data, rami e tronchi vengono divisi in segmenti adattivi alla curvatura con questa
+# tolleranza in metri (vedi pcpp.adaptive_segments) invece che in k intervalli uguali
+ADAPTIVE_TOLERANCE = None  # ad es. pcpp.ADAPTIVE_TOLERANCE
+# se dato, assi dei rami e diametri dei segmenti vengono da una PCA robusta agli outlier
+# (foglie, fili della spalliera) su al più questo numero di punti per ramo e per segmento
+# (vedi pcpp.robust_covariances)
+ROBUST_SAMPLES = None  # ad es. pcpp.ROBUST_MAX_SAMPLES
+# politica con cui scegliere i tagli (vedi cut_planner.py), ad es.
+# functools.partial(cut_planner.fraction_policy, fraction=0.5)
+CUT_POLICY = cut_planner.spur_policy
+# se dato, le feature di rami e segmenti vengono salvate in un archivio colonnare .npz
+# (vedi feature_store.py), da interrogare poi senza rifare l'analisi
+FEATURES_PATH = None  # ad es. "features.npz"
+# se dati, la nuvola segmentata (colori degli oggetti + campo "object", -1 = non annotato)
+# e i rami tagliati (parte rimossa in grigio + campo "removed") vengono salvati come PCD
+# binari (vedi pcd_io.py), apribili con CloudCompare, PCL o Open3D
+SEGMENTATION_PCD_PATH = None  # ad es. "segmentation.pcd"
+CUT_PCD_PATH = None  # ad es. "cuts.pcd"
+
+if PROFILE_TRACE:
+    instrumentation.enable(trace_memory=True)
+
+# il PCD ascii viene parsato solo alla prima esecuzione, poi si legge la cache binaria;
+# allo stesso modo l'indice CSR (oggetto -> indici dei punti) viene costruito dal JSON
+# solo la prima volta, poi viene riletto dal .npz salvato accanto al JSON.
+# (per l'analisi senza visualizzazione vedi cli.py: python -m challenge2 analyze ...)
+points, colors, ann_index = analysis.load_scan(PCD_PATH, ANN_PATH)
+print(f"[INFO] Loaded {len(points)} points and {len(ann_index)} annotated objects.")
+class_titles = {class_id: title for title, class_id in ann_index.classes.items()}
 
 # Mappa che associa classi di segmentazione a colori
 class_colors = {
@@ -27,44 +57,35 @@ class_colors = {
 }
 
 # colora i punti in base alla loro classe di segmentazione
-new_colors = np.ones_like(points) * 0.5  # default grigio
-
-figures = data.get("figures", [])
-
-for fig in figures:
-    obj = next((o for o in data["objects"] if o["key"] == fig["objectKey"]), None) # generator expression
-    if obj is None:
-        continue
-
-    base_color = class_colors.get(obj["classTitle"], np.array([0.5, 0.5, 0.5]))
-    # Genera una piccola variazione casuale per rendere ogni figura leggermente diversa
-    variation = (np.random.rand(3) - 0.5) # tripla di tre valori appartenenti a [-0.5, 0.5] 
-    color = np.clip(base_color + variation, 0, 1)  # mantieni valori tra 0 e 1
-    
-    indices = fig["geometry"]["indices"]
-    if len(indices) > 0:
-        new_colors[indices] = color
-
-# Siccome, alcuni oggetti sono spezzati in più figure
-# raggruppiamo tutte le figure per objectKey 
-
-# 'defaultdict(list)' è come un dict normale ma se accedi 
-# a una chiave che non esiste, viene automaticamente creata 
-# con un valore di default (in questo caso lista vuota).
-# utilizzo questa mappa, per associare ad un obj_key, gli 
-# indici dei suoi punti
-object_to_indices = defaultdict(list) 
-
-for fig in data["figures"]:
-    obj_key = fig["objectKey"]
-    indices = fig["geometry"]["indices"]
-    # estende la lista associata all'objectKey corrente
-    object_to_indices[obj_key].extend(indices) 
-
-# visualizziamo la pointcloud segmentata
+with instrumentation.stage("colouring"):
+    new_colors = np.full(points.shape, 128, dtype=np.uint8)  # default grigio (colori compatti uint8)
+
+    # un colore per oggetto: colore della classe + una piccola variazione casuale
+    # per rendere ogni oggetto leggermente diverso
+    base_colors = np.array([class_colors.get(class_titles[c], [0.5, 0.5, 0.5]) for c in ann_index.class_ids]).reshape(-1, 3)
+    variation = np.random.rand(len(ann_index), 3) - 0.5 # triple di valori appartenenti a [-0.5, 0.5]
+    object_colors = np.clip(base_colors + variation, 0, 1)  # mantieni valori tra 0 e 1
+    # un'unica assegnazione per tutti i punti annotati
+    new_colors[ann_index.indices] = pcpp.compact_colors(object_colors)[ann_index.point_objects()]
+
+# oggetto di ogni punto (-1 = non annotato)
+point_objects = np.full(len(points), -1, dtype=np.int32)
+point_objects[ann_index.indices] = ann_index.point_objects()
+
+if SEGMENTATION_PCD_PATH:
+    pcd_io.write_pcd(SEGMENTATION_PCD_PATH, points, new_colors, fields={"object": point_objects})
+    print(f"[INFO] Saved segmented point cloud to {SEGMENTATION_PCD_PATH}")
+
+# visualizziamo la pointcloud segmentata, sottocampionata a voxel
+# (ogni voxel prende la media dei colori dei suoi punti, e non mescola oggetti diversi).
+# Open3D vuole float64: la conversione si fa solo qui, sui punti visualizzati
+pyramid = pcpp.VoxelPyramid(points, colors, voxel_sizes=[DISPLAY_VOXEL_SIZE] if DISPLAY_VOXEL_SIZE > 0 else [],
+                            labels=point_objects)
+display_level = len(pyramid) - 1
 segmented_pcd = o3d.geometry.PointCloud()
-segmented_pcd.points = o3d.utility.Vector3dVector(points)
-segmented_pcd.colors = o3d.utility.Vector3dVector(new_colors)
+segmented_pcd.points = o3d.utility.Vector3dVector(pyramid.points(display_level).astype(np.float64))
+segmented_pcd.colors = o3d.utility.Vector3dVector(pyramid.reduce(new_colors, display_level) / 255.0)
+print(f"[INFO] Displaying {len(pyramid.points(display_level))} of {len(points)} points.")
 print("[INFO] Visualizing segmented point cloud...")
 o3d.visualization.draw_geometries([segmented_pcd]) # commenta via se non serve
 
@@ -72,17 +93,16 @@ o3d.visualization.draw_geometries([segmented_pcd]) # commenta via se non serve
 tree_pc_lineset = []
 tree_points = None
 tree_dir = None
-for branch_obj in data["objects"]:
-    # recupero i punti dei rami
-    if branch_obj["classTitle"] != "Tree":
-        continue
-
-    tree_indices = object_to_indices[branch_obj["key"]]
+tree_polylines = []
+for tree_obj in ann_index.objects_of_class("Tree"):
+    tree_indices = ann_index.object_indices(tree_obj)
     tree_points = points[tree_indices]
     tree_colors = colors[tree_indices]
 
-    res = pcpp.approximate_branch(tree_points, tree_colors)
+    res = pcpp.approximate_branch(tree_points, tree_colors, tolerance=ADAPTIVE_TOLERANCE,
+                                  mode="mask" if ADAPTIVE_TOLERANCE is None else "adaptive")
     tree_segments, _, tree_dir, centers, _ = res
+    tree_polylines.append(centers)
 
     lines = [[i, i+1] for i in range(len(centers)-1)]
     line_set = o3d.geometry.LineSet(
@@ -93,133 +113,86 @@ for branch_obj in data["objects"]:
     tree_pc_lineset.append(line_set) 
 
 # approssimo i rami e calcolo le feature
-branch_linesets = []
-branch_pc_linesets = []
-centers = []
-for branch_obj in data["objects"]:
-    # recupero i punti dei rami
-    if branch_obj["classTitle"] != "Branch 1":
+# invece di un ciclo per ramo (approximate_branch + compute_branch_features), tutti i rami
+# vengono elaborati insieme da BranchBatch, che ritorna una tabella colonnare
+branch_objs = ann_index.objects_of_class("Branch 1")
+branch_indices, branch_offsets = ann_index.subset(branch_objs)
+
+batch = pcpp.BranchBatch.from_indices(points, colors, branch_indices, branch_offsets,
+                                      tolerance=ADAPTIVE_TOLERANCE, robust_samples=ROBUST_SAMPLES)
+branch_table = batch.compute(tree_dir)
+# l'inclinazione rispetto al principal component dell'intero tronco non è significativa:
+# ogni ramo viene agganciato al segmento della polilinea del tronco più vicino alla sua
+# base, e l'inclinazione si misura rispetto alla direzione di quel segmento
+trunk_index = spatial_index.SegmentIndex.from_polylines(tree_polylines)
+spatial_index.attach_trunk_segments(branch_table, trunk_index)
+
+# geometrie di tutti i rami in un colpo solo (una mesh e un LineSet in tutto, invece di
+# una geometria per ramo o per segmento: vedi visualization_stuff.segments_to_mesh)
+valid = branch_table["valid"]
+
+# polilinee dei rami: coppie di centroidi consecutivi dello stesso ramo. Ad es:
+# - centers = [c0, c1, c2, c3, c4]
+# - segmenti = [c0,c1], [c1,c2], [c2,c3], [c3,c4]
+seg_branch = branch_table["segment_branch"]
+seg_centers = branch_table["segment_centers"]
+consecutive = (seg_branch[1:] == seg_branch[:-1]) & valid[seg_branch[1:]]
+with instrumentation.stage("branch_cylinders"):
+    cylinders = [visualization_stuff.segments_to_mesh(
+        seg_centers[:-1][consecutive], seg_centers[1:][consecutive], radius=0.01, colors=[1,1,0])]
+
+# linee del principal component dei rami (blu)
+principal_components = branch_table["principal_component"][valid]
+branch_centers = branch_table["center"][valid]
+pc_starts = branch_centers + principal_components * branch_table["proj_min"][valid][:, None]
+pc_ends = branch_centers + principal_components * branch_table["proj_max"][valid][:, None]
+branch_pc_linesets = [visualization_stuff.segments_to_lineset(pc_starts, pc_ends, colors=[0,0,1])]
+
+for b, branch_obj in enumerate(branch_objs):
+    if not valid[b]:
         continue
-    all_indices = object_to_indices[branch_obj["key"]]
-    branch_points = points[all_indices]
-    branch_colors = colors[all_indices]
-
-    res = pcpp.approximate_branch(branch_points, branch_colors)
-    branch_segments, color_segments, principal_component, centers, pc_line = res
-
-    branch_pc_linesets.append(pc_line)
-    # Crea line set per visualizzare i segmenti del ramo
-    # Mi basta connettere i centroidi calcolati. Ad es:
-    # - centers = [c0, c1, c2, c3, c4]
-    # - lines = [[0,1], [1,2], [2,3], [3,4]]
-    lines = [[i, i+1] for i in range(len(centers)-1)]
-    line_set = o3d.geometry.LineSet(
-        points=o3d.utility.Vector3dVector(centers),
-        lines=o3d.utility.Vector2iVector(lines)
-    )
-    line_set.colors = o3d.utility.Vector3dVector([[1,0,1] for _ in lines]) 
-    branch_linesets.append(line_set)
+    print(f"=== feature ramo {ann_index.object_keys[branch_obj]}===")
+    pprint(pcpp.BranchBatch.branch_features(branch_table, b))
 
-    print(f"=== feature ramo {branch_obj["key"]}===")
-    # FIXME: qua sto passando il principal component dell'intero tronco ... questo mi da un vettore che fa schifo.
-    # Piuttosto dovrei approssimare anche il tronco con una polilinea, e usare come tree_dir il vettore associato al segmento
-    # del tronco il cui il ramo ricade.
-    features = pcpp.compute_branch_features(branch_segments, principal_component, tree_points, tree_dir, color_segments)
-    pprint(features)
-
-cylinders = []
-for ls in branch_linesets:
-    cylinders.extend(visualization_stuff.lineset_to_cylinders(ls, radius=0.01, color=[1,1,0]))
+if FEATURES_PATH:
+    store = feature_store.FeatureStore.from_result({
+        "scan": analysis.scan_name(PCD_PATH), "index": ann_index,
+        "branch_objects": branch_objs, "table": branch_table})
+    store.save(FEATURES_PATH)
+    print(f"[INFO] Saved {store} to {FEATURES_PATH}")
 
 o3d.visualization.draw_geometries([segmented_pcd] + cylinders + branch_pc_linesets + tree_pc_lineset)
 
 
-def create_cut_plane(principal_component, threshold_point, size=0.15):
-    """
-    Crea un piano ortogonale al principal_component e centrato su threshold_point.
-    """
-    # Normalizziamo il vettore principale
-    n = principal_component / np.linalg.norm(principal_component)
-
-    # Creiamo un piano quadrato molto sottile (0.001 lungo la normale)
-    plane = o3d.geometry.TriangleMesh.create_box(width=size, height=size, depth=0.001)
-
-    # Spostiamo il piano in modo che il centro sia in origine
-    vertices = np.asarray(plane.vertices)
-    vertices -= vertices.mean(axis=0)
-    plane.vertices = o3d.utility.Vector3dVector(vertices)
-
-    # Ruotiamo il piano in modo che la normale Z diventi n
-    z = np.array([0,0,1])
-    v = np.cross(z, n)
-    s = np.linalg.norm(v)
-    if s < 1e-6:
-        R = np.eye(3)
-    else:
-        c = np.dot(z, n)
-        vx = np.array([[0,-v[2],v[1]],[v[2],0,-v[0]],[-v[1],v[0],0]])
-        R = np.eye(3) + vx + vx @ vx * ((1 - c)/(s**2))
-    plane.rotate(R, center=(0,0,0))
-
-    # Trasliamo il piano alla soglia
-    plane.translate(threshold_point)
-    plane.paint_uniform_color([0,0,1])  # blu
-
-    return plane
-
-def color_branch_cut_10_percent(branch_points, branch_colors=None):
-    center = branch_points.mean(axis=0)
-    points_centered = branch_points - center
-    cov = np.cov(points_centered.T)
-    eigvals, eigvecs = np.linalg.eig(cov)
-    principal_component = eigvecs[:, np.argmax(eigvals)]
-    principal_component /= np.linalg.norm(principal_component)
-
-    proj = points_centered.dot(principal_component)
-    min_proj, max_proj = proj.min(), proj.max()
-    # taglio ad altezze random
-    whatever = 0.2 + random.random() * 0.5
-    threshold = min_proj + whatever * (max_proj - min_proj)
-
-    mask = proj > threshold
-    pcd = o3d.geometry.PointCloud()
-    pcd.points = o3d.utility.Vector3dVector(branch_points)
-
-    if branch_colors is None:
-        colors = np.ones_like(branch_points) * 0.0
-        colors[:,1] = 1.0
-    else:
-        colors = np.array(branch_colors)
-
-    colors[mask] = np.array([0.5,0.5,0.5])
-    pcd.colors = o3d.utility.Vector3dVector(colors)
-
-    threshold_point = center + principal_component * threshold
-    cut_plane = create_cut_plane(principal_component, threshold_point)
-
-    return pcd, cut_plane
-
-
 # ========================================
-# Creazione point cloud dei rami tagliati
+# Tagli di potatura (vedi cut_planner.py)
 # ========================================
-cut_branch_pcds = []
-cut_planes = []
-
-for branch_obj in data["objects"]:
-    if branch_obj["classTitle"] != "Branch 1":
-        continue
-
-    # poto solo il 40% dei rami
-    if random.random() < 0.6:
-        continue
-    
-    all_indices = object_to_indices[branch_obj["key"]]
-    branch_points = points[all_indices]
-    branch_colors = colors[all_indices]
-
-    pcd_cut, plane = color_branch_cut_10_percent(branch_points, branch_colors)
-    cut_branch_pcds.append(pcd_cut)
-    cut_planes.append(plane)
+# i piani di taglio si ricavano dalla tabella delle feature, per tutti i rami insieme:
+# niente PCA ripetute né numeri casuali
+with instrumentation.stage("cut_planning"):
+    cuts = cut_planner.plan_cuts(branch_table, policy=CUT_POLICY)
+    cut_indices, removed = cut_planner.removed_points(points, branch_indices, branch_offsets, cuts)
+print(f"[INFO] {len(cuts['branch'])} cuts planned")
+
+# tutti i rami tagliati in un'unica point cloud, con la parte da rimuovere in grigio
+cut_colors = np.array(colors[cut_indices])
+cut_colors[removed] = 128
+if CUT_PCD_PATH:
+    pcd_io.write_pcd(CUT_PCD_PATH, points[cut_indices], cut_colors, fields={"removed": removed})
+    print(f"[INFO] Saved cut branches to {CUT_PCD_PATH}")
+cut_branch_pcd = o3d.geometry.PointCloud()
+cut_branch_pcd.points = o3d.utility.Vector3dVector(np.asarray(points[cut_indices], dtype=np.float64))
+cut_branch_pcd.colors = o3d.utility.Vector3dVector(pcd_cache.rgb_to_float(cut_colors))
+cut_branch_pcds = [cut_branch_pcd]
+
+# tutti i piani di taglio (box quadrati sottili, blu) in un'unica mesh
+with instrumentation.stage("cut_planes"):
+    cut_planes = [visualization_stuff.cut_planes_mesh(cuts["planes"][:, 0], cuts["planes"][:, 1],
+                                                      size=0.15, colors=[0,0,1])]
+
+profiler = instrumentation.disable()
+if profiler is not None:
+    profiler.print_summary()
+    profiler.save_chrome_trace(PROFILE_TRACE)
 
 o3d.visualization.draw_geometries([segmented_pcd] + cylinders + branch_pc_linesets + tree_pc_lineset + cut_branch_pcds + cut_planes)
\ No newline at end of file
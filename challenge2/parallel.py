@@ -0,0 +1,214 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import pointcloud_preprocessor as pcpp
+import instrumentation
+
+# =========================================================
+# Approssimazione dei rami in parallelo su più processi
+# =========================================================
+
+# Ogni ramo (approximate_branch -> compute_branch_features) è indipendente dagli altri,
+# quindi i rami si possono distribuire su un ProcessPoolExecutor.
+#
+# Per non serializzare (pickle) i punti ad ogni task, gli array grandi (punti, colori e
+# l'indice CSR oggetto -> punti) vengono copiati UNA volta in blocchi di
+# multiprocessing.shared_memory. Ogni worker, all'avvio, si aggancia ai blocchi e crea
+# delle viste numpy su di essi: ai task passano solo gli intervalli di rami da elaborare.
+#
+# I task sono blocchi di chunk_size rami consecutivi e executor.map ritorna i risultati
+# nell'ordine dei task, quindi l'output è deterministico qualunque sia il numero di worker.
+#
+# Ogni worker misura anche il tempo di ogni ramo: i tempi tornano al processo principale
+# insieme ai risultati e finiscono nei contatori per ramo di instrumentation (se attiva).
+#
+# parallel_branch_table fa lo stesso con BranchBatch: ogni task calcola la tabella
+# colonnare di un blocco di rami consecutivi e le tabelle dei blocchi vengono concatenate.
+# Le feature di un ramo non dipendono dagli altri rami del batch (vedi
+# benchmarks/check_batch_subsets.py), quindi il risultato è quello del batch unico a meno
+# degli arrotondamenti float32 della traslazione sul baricentro. È il percorso usato da
+# analysis.py (e da cli.py con --workers N).
+
+# viste sugli array condivisi, valorizzate nei worker da _init_worker
+_shared = {}
+
+
+def _to_shared(array):
+    """Copia un array in un nuovo blocco di shared memory. Ritorna (blocco, descrittore)."""
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _init_worker(descriptors):
+    for key, (name, shape, dtype) in descriptors.items():
+        shm = shared_memory.SharedMemory(name=name)
+        # teniamo un riferimento al blocco, altrimenti verrebbe chiuso insieme all'oggetto
+        _shared[key + "_shm"] = shm
+        _shared[key] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _process_table(task):
+    """Tabella di BranchBatch.compute dei rami [start, end) usando gli array condivisi."""
+    start, end, tree_dir, tolerance, robust_samples = task
+    indices, offsets = _shared["indices"], _shared["offsets"]
+    return pcpp.BranchBatch.from_indices(
+        _shared["points"], _shared.get("colors"), indices[offsets[start]:offsets[end]],
+        offsets[start:end+1] - offsets[start], tolerance=tolerance, robust_samples=robust_samples).compute(tree_dir)
+
+
+def _process_branches(task):
+    """Elabora i rami [start, end) usando gli array condivisi. Ritorna coppie (risultato, secondi)."""
+    start, end, tree_dir, mode = task
+    points, colors = _shared["points"], _shared.get("colors")
+    indices, offsets = _shared["indices"], _shared["offsets"]
+    return [_timed_branch_result(points, colors, indices[offsets[b]:offsets[b+1]], tree_dir, mode)
+            for b in range(start, end)]
+
+
+def _timed_branch_result(points, colors, branch_indices, tree_dir, mode):
+    t0 = time.perf_counter()
+    result = _branch_result(points, colors, branch_indices, tree_dir, mode)
+    return result, time.perf_counter() - t0
+
+
+def _branch_result(points, colors, branch_indices, tree_dir, mode):
+    branch_points = points[branch_indices]
+    branch_colors = colors[branch_indices] if colors is not None else np.ones_like(branch_points) * 0.5
+    if len(branch_points) < 2:
+        return None
+    res = pcpp.approximate_branch(branch_points, branch_colors, mode=mode, with_pc_line=False)
+    branch_segments, color_segments, principal_component, centers, _ = res
+    if branch_segments is None:
+        return None
+    features = pcpp.compute_branch_features(branch_segments, principal_component, None, tree_dir, color_segments)
+    features["principal_component"] = principal_component
+    features["centers"] = centers
+    return features
+
+
+def _record_timings(timed_results, offsets):
+    """Registra i contatori per ramo (punti, segmenti, secondi) e ritorna solo i risultati."""
+    results = [r for r, _ in timed_results]
+    instrumentation.add_items(
+        "branch",
+        num_points=np.diff(offsets),
+        num_segments=[0 if r is None else len(r["diameters"]) for r in results],
+        seconds=[s for _, s in timed_results],
+    )
+    return results
+
+
+@instrumentation.timed()
+def parallel_branch_features(points, colors, indices, offsets, tree_dir,
+                             workers=None, chunk_size=16, mode="binned"):
+    """
+    Calcola le feature di tutti i rami distribuendoli su più processi.
+
+    Parametri:
+        - points: array (N,3) dei punti della nuvola
+        - colors: array (N,3) dei colori (oppure None)
+        - indices, offsets: indice CSR dei rami (i punti del ramo b sono
+          points[indices[offsets[b]:offsets[b+1]]]), vedi AnnotationIndex.subset
+        - tree_dir: principal component del tronco
+        - workers: numero di processi (default: os.cpu_count()); con 1 niente pool
+        - chunk_size: numero di rami per task
+        - mode: modalità di approximate_branch ("binned" o "mask")
+
+    Ritorna:
+        - lista (una voce per ramo, nell'ordine di offsets) dei dizionari di
+          compute_branch_features, con in più "principal_component" e "centers";
+          None per i rami che non si possono approssimare
+    """
+    workers = workers or os.cpu_count() or 1
+    num_branches = len(offsets) - 1
+    tree_dir = np.asarray(tree_dir, dtype=float)
+    tasks = [(s, min(s + chunk_size, num_branches), tree_dir, mode)
+             for s in range(0, num_branches, chunk_size)]
+
+    if workers == 1 or len(tasks) <= 1:
+        indices, offsets = np.asarray(indices), np.asarray(offsets)
+        timed_results = [_timed_branch_result(points, colors, indices[offsets[b]:offsets[b+1]], tree_dir, mode)
+                         for b in range(num_branches)]
+        return _record_timings(timed_results, offsets)
+
+    timed_results = []
+    for chunk_results in _map_shared(_process_branches, tasks, points, colors, indices, offsets, workers):
+        timed_results.extend(chunk_results)
+    return _record_timings(timed_results, offsets)
+
+
+def _map_shared(fn, tasks, points, colors, indices, offsets, workers):
+    """
+    Esegue fn sui task in un ProcessPoolExecutor i cui worker vedono punti, colori e indice
+    CSR in shared memory. Ritorna i risultati nell'ordine dei task.
+    """
+    arrays = {"points": points, "indices": indices, "offsets": offsets}
+    if colors is not None:
+        arrays["colors"] = colors
+    blocks = []
+    try:
+        descriptors = {}
+        for key, array in arrays.items():
+            shm, descriptors[key] = _to_shared(array)
+            blocks.append(shm)
+
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)),
+                                 initializer=_init_worker, initargs=(descriptors,)) as executor:
+            return list(executor.map(fn, tasks))
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+
+def concatenate_tables(tables):
+    """
+    Concatena le tabelle di BranchBatch.compute di blocchi consecutivi di rami in
+    un'unica tabella, come se i rami fossero stati elaborati insieme.
+    """
+    branch_starts = np.cumsum([0] + [len(t["valid"]) for t in tables])
+    segment_starts = np.cumsum([0] + [len(t["diameters"]) for t in tables])
+    table = {}
+    for key in tables[0]:
+        if key == "segment_offsets":
+            table[key] = np.concatenate([[0]] + [t[key][1:] + s for t, s in zip(tables, segment_starts)])
+        elif key == "segment_branch":
+            table[key] = np.concatenate([t[key] + b for t, b in zip(tables, branch_starts)])
+        else:
+            table[key] = np.concatenate([t[key] for t in tables])
+    return table
+
+
+@instrumentation.timed()
+def parallel_branch_table(points, colors, indices, offsets, tree_dir, workers=None, chunk_size=None,
+                          tolerance=None, robust_samples=None):
+    """
+    Come BranchBatch.from_indices(...).compute(tree_dir), distribuendo blocchi di rami
+    consecutivi su più processi.
+
+    Parametri:
+        - points, colors, indices, offsets, tree_dir: come per parallel_branch_features
+        - workers: numero di processi (default: os.cpu_count()); con 1 niente pool
+        - chunk_size: numero di rami per task (default: circa 4 task per processo)
+        - tolerance, robust_samples: come per BranchBatch
+
+    Ritorna:
+        - la tabella colonnare di BranchBatch.compute
+    """
+    workers = workers or os.cpu_count() or 1
+    num_branches = len(offsets) - 1
+    tree_dir = np.asarray(tree_dir, dtype=float)
+    if workers == 1 or num_branches <= 1:
+        return pcpp.BranchBatch.from_indices(points, colors, indices, offsets, tolerance=tolerance,
+                                             robust_samples=robust_samples).compute(tree_dir)
+
+    chunk_size = chunk_size or max(1, -(-num_branches // (4 * workers)))
+    tasks = [(s, min(s + chunk_size, num_branches), tree_dir, tolerance, robust_samples)
+             for s in range(0, num_branches, chunk_size)]
+    return concatenate_tables(_map_shared(_process_table, tasks, points, colors, indices, offsets, workers))
@@ -0,0 +1,223 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+import instrumentation
+import pcd_io
+
+# =========================================================
+# Cache binaria (memory-mapped) dei file PCD
+# =========================================================
+
+# Il file .pcd del dataset è in formato "DATA ascii": ogni run di main.py lo
+# ri-parsava da testo con o3d.io.read_point_cloud. Su scansioni da milioni di punti
+# il parsing del testo domina il tempo di avvio.
+#
+# Qui il PCD viene convertito UNA volta in un file binario accanto al sorgente:
+#
+#   [ header (HEADER_SIZE byte) | xyz float32 (N,3) | rgb uint8 (N,3) ]
+#
+# - l'header è un JSON (riempito di spazi fino a HEADER_SIZE) che contiene numero di
+#   punti, offset dei blocchi e lo sha256 + dimensione + mtime del sorgente
+# - i blocchi sono colonnari: tutte le coordinate, poi tutti i colori
+# - le run successive fanno np.memmap dei blocchi: nessuna copia e nessun parsing
+#
+# La lettura del sorgente (ascii, binary o binary_compressed) è in pcd_io.py; per i PCD
+# binary la cache serve soprattutto a separare le colonne xyz/rgb già spacchettate.
+#
+# La cache viene invalidata quando cambia il sorgente: se dimensione e mtime coincidono
+# la si considera valida senza rileggere il sorgente, altrimenti si ricalcola lo sha256
+# e si ricostruisce la cache solo se il contenuto è davvero cambiato.
+
+CACHE_SUFFIX = ".cache"
+MAGIC = b"PCDCACHE"
+CACHE_VERSION = 1
+HEADER_SIZE = 4096  # spazio riservato all'header, così da poterlo riscrivere sul posto
+
+
+def rgb_to_float(rgb):
+    """Converte colori uint8 in float nel range [0,1], come np.asarray(pcd.colors) di Open3D."""
+    return np.asarray(rgb, dtype=np.float64) / 255.0
+
+
+def file_sha256(path, block_size=1 << 20):
+    """sha256 (esadecimale) del contenuto di un file, letto a blocchi."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def source_info(pcd_path, sha256=None):
+    """Impronta di un file sorgente: sha256 del contenuto più dimensione e mtime."""
+    st = os.stat(pcd_path)
+    return {
+        "sha256": sha256 if sha256 is not None else file_sha256(pcd_path),
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+    }
+
+
+def _encode_header(header):
+    raw = MAGIC + json.dumps(header).encode("utf-8")
+    if len(raw) > HEADER_SIZE:
+        raise ValueError("header della cache troppo grande")
+    return raw.ljust(HEADER_SIZE, b" ")
+
+
+def _read_cache_header(cache_path):
+    with open(cache_path, "rb") as f:
+        raw = f.read(HEADER_SIZE)
+    if len(raw) < HEADER_SIZE or not raw.startswith(MAGIC):
+        return None
+    try:
+        header = json.loads(raw[len(MAGIC):].decode("utf-8"))
+    except ValueError:
+        return None
+    if header.get("version") != CACHE_VERSION:
+        return None
+    return header
+
+
+def default_cache_path(pcd_path):
+    return os.fspath(pcd_path) + CACHE_SUFFIX
+
+
+@instrumentation.timed()
+def build_cache(pcd_path, cache_path=None, chunk_size=1_000_000):
+    """
+    Converte il PCD in cache binaria (scrittura atomica: file temporaneo + os.replace).
+    La conversione avviene a blocchi, quindi funziona anche per nuvole più grandi della RAM.
+
+    Ritorna:
+        - il percorso della cache
+    """
+    cache_path = cache_path or default_cache_path(pcd_path)
+    # calcoliamo l'hash prima del parsing: se il file cambia nel frattempo, la cache
+    # risulterà comunque non valida alla prossima apertura
+    source = source_info(pcd_path)
+    with open(pcd_path, "rb") as f:
+        pcd_header = pcd_io.read_header(f)
+    n = pcd_header["POINTS"]
+    has_rgb = "rgb" in pcd_header["FIELDS"] or "rgba" in pcd_header["FIELDS"]
+    xyz_offset = HEADER_SIZE
+    rgb_offset = xyz_offset + n * 3 * 4
+    header = {
+        "version": CACHE_VERSION,
+        "source": source,
+        "num_points": n,
+        "has_rgb": has_rgb,
+        "xyz_offset": xyz_offset,
+        "rgb_offset": rgb_offset,
+    }
+
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_encode_header(header))
+        f.truncate(rgb_offset + n * 3)  # senza colori il blocco rgb resta a zero
+        for start, xyz, rgb in iter_pcd_chunks(pcd_path, chunk_size):
+            f.seek(xyz_offset + start * 3 * 4)
+            f.write(np.ascontiguousarray(xyz, dtype=np.float32).tobytes())
+            if rgb is not None:
+                f.seek(rgb_offset + start * 3)
+                f.write(np.ascontiguousarray(rgb, dtype=np.uint8).tobytes())
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+def is_cache_valid(pcd_path, cache_path=None):
+    """
+    Controlla che la cache esista e corrisponda al sorgente.
+    Se solo dimensione/mtime sono cambiati ma il contenuto no (ad es. un `touch`),
+    l'header della cache viene aggiornato sul posto così che il controllo torni veloce.
+    """
+    cache_path = cache_path or default_cache_path(pcd_path)
+    if not os.path.exists(cache_path):
+        return False
+    header = _read_cache_header(cache_path)
+    if header is None:
+        return False
+    st = os.stat(pcd_path)
+    source = header["source"]
+    if source["size"] == st.st_size and source["mtime_ns"] == st.st_mtime_ns:
+        return True
+
+    sha256 = file_sha256(pcd_path)
+    if sha256 != source["sha256"]:
+        return False
+    header["source"] = source_info(pcd_path, sha256=sha256)
+    with open(cache_path, "r+b") as f:
+        f.write(_encode_header(header))
+    return True
+
+
+@instrumentation.timed()
+def load_point_cloud(pcd_path, cache_path=None, rebuild=False):
+    """
+    Carica un PCD passando dalla cache binaria (costruendola se manca o non è valida).
+
+    Parametri:
+        - pcd_path: percorso del file .pcd
+        - cache_path: percorso della cache (default: accanto al sorgente, con suffisso .cache)
+        - rebuild: forza la ricostruzione della cache
+
+    Ritorna:
+        - xyz: np.memmap (N,3) float32 in sola lettura
+        - rgb: np.memmap (N,3) uint8 in sola lettura, oppure None se il PCD non ha colori
+    """
+    cache_path = cache_path or default_cache_path(pcd_path)
+    if rebuild or not is_cache_valid(pcd_path, cache_path):
+        build_cache(pcd_path, cache_path)
+    header = _read_cache_header(cache_path)
+    n = header["num_points"]
+    if n == 0:
+        return np.zeros((0, 3), dtype=np.float32), (np.zeros((0, 3), dtype=np.uint8) if header["has_rgb"] else None)
+
+    xyz = np.memmap(cache_path, dtype=np.float32, mode="r", offset=header["xyz_offset"], shape=(n, 3))
+    rgb = None
+    if header["has_rgb"]:
+        rgb = np.memmap(cache_path, dtype=np.uint8, mode="r", offset=header["rgb_offset"], shape=(n, 3))
+    return xyz, rgb
+
+
+def iter_pcd_chunks(pcd_path, chunk_size=1_000_000):
+    """
+    Legge un PCD (ascii, binary o binary_compressed) a blocchi di chunk_size punti
+    (vedi pcd_io.iter_pcd_chunks).
+
+    Ritorna (generatore):
+        - tuple (start, xyz, rgb): indice del primo punto del blocco, xyz float32 (n,3),
+          rgb uint8 (n,3) oppure None
+    """
+    for start, cloud in pcd_io.iter_pcd_chunks(pcd_path, chunk_size):
+        xyz, rgb = pcd_io.xyz_rgb(cloud)
+        yield start, xyz, rgb
+
+
+def iter_point_chunks(pcd_path, chunk_size=1_000_000, cache_path=None):
+    """
+    Come iter_pcd_chunks, ma se esiste una cache valida legge i blocchi dalla cache
+    (slice del memmap, nessun parsing). I blocchi sono copiati in RAM uno alla volta.
+    """
+    cache_path = cache_path or default_cache_path(pcd_path)
+    if not is_cache_valid(pcd_path, cache_path):
+        yield from iter_pcd_chunks(pcd_path, chunk_size)
+        return
+    xyz, rgb = load_point_cloud(pcd_path, cache_path)
+    for start in range(0, len(xyz), chunk_size):
+        end = min(start + chunk_size, len(xyz))
+        yield start, np.array(xyz[start:end]), (None if rgb is None else np.array(rgb[start:end]))
+
+
+def source_hash(pcd_path, cache_path=None):
+    """
+    sha256 del PCD sorgente, letto dall'header della cache (che viene costruita o
+    aggiornata se serve): evita di rileggere tutto il file ad ogni run.
+    """
+    cache_path = cache_path or default_cache_path(pcd_path)
+    if not is_cache_valid(pcd_path, cache_path):
+        build_cache(pcd_path, cache_path)
+    return _read_cache_header(cache_path)["source"]["sha256"]
@@ -0,0 +1,379 @@
+import itertools
+import os
+
+import numpy as np
+
+import instrumentation
+
+# =========================================================
+# Lettura/scrittura dei file PCD in NumPy puro
+# =========================================================
+
+# Formato PCD (Point Cloud Library, v0.7): un header testuale seguito dai dati.
+#
+#   FIELDS x y z rgb      nomi dei campi
+#   SIZE 4 4 4 4          byte per valore
+#   TYPE F F F F          F = float, I = intero con segno, U = intero senza segno
+#   COUNT 1 1 1 1         valori per campo (ad es. 33 per un descrittore FPFH)
+#   POINTS 41140
+#   DATA ascii            ascii | binary | binary_compressed
+#
+# - ascii: una riga di testo per punto
+# - binary: i punti uno dopo l'altro, ogni punto è il record dei campi nell'ordine
+#   di FIELDS. Coincide con un array strutturato numpy: lo si mappa con np.memmap
+#   senza copiare né convertire nulla
+# - binary_compressed: due uint32 (dimensione compressa e non compressa) seguiti da un
+#   blocco compresso con LZF. Una volta decompressi i dati sono "per colonna": prima x
+#   di tutti i punti, poi tutte le y, ecc.
+#
+# Il campo rgb contiene i tre byte 0x00RRGGBB impacchettati in un float32 (o uint32):
+# nei file ascii compare come un float denormalizzato (ad es. 5.523817653e-39). Il
+# valore non va convertito ma reinterpretato bit a bit (vedi unpack_rgb).
+#
+# Le nuvole lette sono array strutturati (un campo per FIELDS); xyz_rgb ne estrae
+# coordinate e colori nel formato compatto della pipeline (float32 e uint8).
+# LZF: se è installato il modulo python-lzf (C) lo si usa, altrimenti c'è un
+# decompressore in Python (più lento, ma senza dipendenze).
+
+_KINDS = {"F": "f", "I": "i", "U": "u"}
+
+
+def read_header(f):
+    """
+    Legge l'header di un file PCD aperto in binario, fermandosi alla riga DATA.
+
+    Ritorna:
+        - un dizionario con le voci dell'header (FIELDS, SIZE, TYPE, COUNT sono liste,
+          WIDTH, HEIGHT, POINTS interi, DATA stringa); il file resta posizionato
+          all'inizio dei dati
+    """
+    header = {}
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError("header PCD incompleto: manca la riga DATA")
+        line = line.decode("ascii").strip()
+        if not line or line.startswith("#"):
+            continue
+        key, *values = line.split()
+        key = key.upper()
+        if key in ("FIELDS", "TYPE"):
+            header[key] = values
+        elif key in ("SIZE", "COUNT"):
+            header[key] = [int(v) for v in values]
+        elif key in ("WIDTH", "HEIGHT", "POINTS"):
+            header[key] = int(values[0])
+        elif key == "DATA":
+            header[key] = values[0].lower()
+            break
+        else:
+            header[key] = values
+    header.setdefault("COUNT", [1] * len(header["FIELDS"]))
+    header.setdefault("POINTS", header.get("WIDTH", 0) * header.get("HEIGHT", 1))
+    return header
+
+
+def header_dtype(header):
+    """
+    dtype strutturato (little endian, senza padding) di un punto. I campi ripetuti (ad es.
+    "_", il riempimento che PCL usa per allineare i record) vengono rinominati _1, _2, ...
+    """
+    names, formats, seen = [], [], {}
+    for name, size, kind, count in zip(header["FIELDS"], header["SIZE"], header["TYPE"], header["COUNT"]):
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}_{seen[name]}"
+        else:
+            seen[name] = 0
+        base = np.dtype(f"<{_KINDS[kind.upper()]}{size}")
+        names.append(name)
+        formats.append(base if count == 1 else (base, (count,)))
+    return np.dtype({"names": names, "formats": formats})
+
+
+def unpack_rgb(rgb_values):
+    """
+    Spacchetta il campo rgb di un PCD (float32 o uint32 con i byte 0x00RRGGBB)
+    in un array (N,3) uint8. Il float non va convertito ma reinterpretato bit a bit.
+    """
+    rgb_values = np.ascontiguousarray(rgb_values)
+    if rgb_values.dtype.kind == "f":
+        packed = rgb_values.astype(np.float32).view(np.uint32)
+    else:
+        packed = rgb_values.astype(np.uint32)
+    rgb = np.empty((len(packed), 3), dtype=np.uint8)
+    rgb[:, 0] = (packed >> 16) & 0xFF
+    rgb[:, 1] = (packed >> 8) & 0xFF
+    rgb[:, 2] = packed & 0xFF
+    return rgb
+
+
+def pack_rgb(rgb):
+    """Inverso di unpack_rgb: colori (N,3) uint8 -> float32 con i bit 0x00RRGGBB."""
+    rgb = np.asarray(rgb, dtype=np.uint32)
+    packed = (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+    return packed.astype(np.uint32).view(np.float32)
+
+
+def xyz_rgb(cloud):
+    """
+    Coordinate e colori di una nuvola letta con read_pcd / iter_pcd_chunks.
+
+    Ritorna:
+        - xyz: array (N,3) float32
+        - rgb: array (N,3) uint8, oppure None se la nuvola non ha il campo rgb/rgba
+    """
+    xyz = np.empty((len(cloud), 3), dtype=np.float32)
+    for j, name in enumerate("xyz"):
+        xyz[:, j] = cloud[name]
+    for name in ("rgb", "rgba"):
+        if name in cloud.dtype.names:
+            return xyz, unpack_rgb(cloud[name])
+    return xyz, None
+
+
+# ------------------------------
+# LZF
+# ------------------------------
+
+def lzf_decompress(data, size):
+    """
+    Decomprime un blocco LZF (formato di liblzf, usato da PCL) di size byte decompressi.
+
+    Un blocco è una sequenza di istruzioni, ognuna introdotta da un byte di controllo c:
+    - c < 32: seguono c+1 byte letterali da copiare
+    - altrimenti: copia di lunghezza (c >> 5) + 2 (se c >> 5 == 7 la lunghezza continua
+      nel byte successivo) da una distanza ((c & 31) << 8) + byte successivo + 1
+      all'indietro nell'output già prodotto
+    """
+    try:
+        import lzf
+    except ImportError:
+        lzf = None
+    if lzf is not None:
+        out = lzf.decompress(bytes(data), size)
+        if out is None or len(out) != size:
+            raise ValueError("blocco LZF non valido")
+        return out
+
+    data = memoryview(data)
+    out = bytearray(size)
+    ip = op = 0
+    end = len(data)
+    try:
+        while ip < end:
+            ctrl = data[ip]
+            ip += 1
+            if ctrl < 32:
+                length = ctrl + 1
+                out[op:op+length] = data[ip:ip+length]
+                ip += length
+                op += length
+                continue
+            length = ctrl >> 5
+            if length == 7:
+                length += data[ip]
+                ip += 1
+            length += 2
+            ref = op - ((ctrl & 0x1F) << 8) - data[ip] - 1
+            ip += 1
+            if ref < 0:
+                raise ValueError("blocco LZF non valido: riferimento prima dell'inizio")
+            distance = op - ref
+            if distance >= length:
+                out[op:op+length] = out[ref:ref+length]
+            else:
+                # copia che si sovrappone a sé stessa: ripete gli ultimi distance byte
+                pattern = bytes(out[ref:op])
+                out[op:op+length] = (pattern * (length // distance + 1))[:length]
+            op += length
+    except IndexError:
+        raise ValueError("blocco LZF troncato")
+    if op != size or len(out) != size:
+        raise ValueError(f"blocco LZF non valido: {op} byte decompressi invece di {size}")
+    return bytes(out)
+
+
+# ------------------------------
+# Lettura
+# ------------------------------
+
+def _data_offset(pcd_path):
+    with open(pcd_path, "rb") as f:
+        header = read_header(f)
+        return header, f.tell()
+
+
+def _read_ascii(f, dtype, count):
+    """Legge count righe ascii dal file (già posizionato) in un array strutturato."""
+    lines = list(itertools.islice(f, count))
+    cloud = np.zeros(len(lines), dtype=dtype)
+    if not lines:
+        return cloud
+    data = np.loadtxt(lines, dtype=np.float64, ndmin=2)
+    col = 0
+    for name in dtype.names:
+        field = dtype.fields[name][0]
+        width = int(np.prod(field.shape)) if field.shape else 1
+        values = data[:, col:col+width]
+        # rgb: il float denormalizzato del testo, riportato a float32, ritrova esattamente i bit
+        cloud[name] = values.reshape((len(lines),) + field.shape).astype(field.base)
+        col += width
+    return cloud
+
+
+def _read_compressed(f, dtype, n):
+    sizes = np.frombuffer(f.read(8), dtype="<u4")
+    if len(sizes) < 2:
+        raise ValueError("PCD binary_compressed troncato")
+    compressed, uncompressed = int(sizes[0]), int(sizes[1])
+    if uncompressed != n * dtype.itemsize:
+        raise ValueError(f"PCD binary_compressed: {uncompressed} byte decompressi, attesi {n * dtype.itemsize}")
+    raw = lzf_decompress(f.read(compressed), uncompressed) if uncompressed else b""
+    # i dati decompressi sono per colonna: un blocco contiguo per campo
+    cloud = np.empty(n, dtype=dtype)
+    offset = 0
+    for name in dtype.names:
+        field = dtype.fields[name][0]
+        block = n * field.itemsize
+        cloud[name] = np.frombuffer(raw, dtype=field.base, count=n * max(1, int(np.prod(field.shape))),
+                                    offset=offset).reshape((n,) + field.shape)
+        offset += block
+    return cloud
+
+
+@instrumentation.timed()
+def read_pcd(pcd_path, mmap=True):
+    """
+    Legge un file PCD (ascii, binary o binary_compressed).
+
+    Parametri:
+        - pcd_path: percorso del file
+        - mmap: per i file binary, mappa i dati (np.memmap, sola lettura, nessuna copia)
+          invece di leggerli in memoria
+
+    Ritorna:
+        - header: dizionario dell'header (vedi read_header)
+        - cloud: array strutturato (POINTS,) con un campo per FIELDS (vedi header_dtype)
+    """
+    header, offset = _data_offset(pcd_path)
+    dtype = header_dtype(header)
+    n = header["POINTS"]
+    fmt = header["DATA"]
+    if fmt == "binary":
+        if n == 0:
+            return header, np.zeros(0, dtype=dtype)
+        if mmap:
+            return header, np.memmap(pcd_path, dtype=dtype, mode="r", offset=offset, shape=(n,))
+        return header, np.fromfile(pcd_path, dtype=dtype, count=n, offset=offset)
+    with open(pcd_path, "rb") as f:
+        f.seek(offset)
+        if fmt == "ascii":
+            return header, _read_ascii(f, dtype, n)
+        if fmt == "binary_compressed":
+            return header, _read_compressed(f, dtype, n)
+    raise ValueError(f"formato PCD non supportato: DATA {fmt}")
+
+
+def iter_pcd_chunks(pcd_path, chunk_size=1_000_000):
+    """
+    Legge un PCD a blocchi di chunk_size punti. Per ascii e binary non tiene mai in
+    memoria più di un blocco; binary_compressed va decompresso tutto in una volta.
+
+    Ritorna (generatore):
+        - tuple (start, cloud): indice del primo punto del blocco e array strutturato
+    """
+    header, offset = _data_offset(pcd_path)
+    if header["DATA"] == "ascii":
+        dtype = header_dtype(header)
+        with open(pcd_path, "rb") as f:
+            f.seek(offset)
+            remaining, start = header["POINTS"], 0
+            while remaining > 0:
+                cloud = _read_ascii(f, dtype, min(chunk_size, remaining))
+                if len(cloud) == 0:
+                    break
+                yield start, cloud
+                start += len(cloud)
+                remaining -= len(cloud)
+        return
+    _, cloud = read_pcd(pcd_path)
+    for start in range(0, len(cloud), chunk_size):
+        yield start, cloud[start:start+chunk_size]
+
+
+# ------------------------------
+# Scrittura
+# ------------------------------
+
+def _header_text(dtype, n, fmt):
+    fields, sizes, types, counts = [], [], [], []
+    for name in dtype.names:
+        field = dtype.fields[name][0]
+        fields.append(name)
+        sizes.append(str(field.base.itemsize))
+        types.append({"f": "F", "i": "I", "u": "U"}[field.base.kind])
+        counts.append(str(int(np.prod(field.shape)) if field.shape else 1))
+    return ("# .PCD v0.7 - Point Cloud Data file format\n"
+            "VERSION 0.7\n"
+            f"FIELDS {' '.join(fields)}\n"
+            f"SIZE {' '.join(sizes)}\n"
+            f"TYPE {' '.join(types)}\n"
+            f"COUNT {' '.join(counts)}\n"
+            f"WIDTH {n}\n"
+            "HEIGHT 1\n"
+            "VIEWPOINT 0 0 0 1 0 0 0\n"
+            f"POINTS {n}\n"
+            f"DATA {fmt}\n")
+
+
+@instrumentation.timed()
+def write_pcd(pcd_path, xyz, rgb=None, fields=None, data="binary"):
+    """
+    Scrive una nuvola in formato PCD (scrittura atomica: file temporaneo + os.replace).
+
+    Parametri:
+        - xyz: array (N,3), scritto come float32
+        - rgb: colori (N,3) uint8 (oppure float in [0,1]), scritti nel campo rgb impacchettato
+        - fields: altri campi per punto, dizionario nome -> array (N,) o (N,C) (ad es.
+          {"label": labels}); il tipo è quello dell'array
+        - data: "binary" (default) oppure "ascii"
+    """
+    xyz = np.asarray(xyz)
+    n = len(xyz)
+    columns = [("x", xyz[:, 0].astype(np.float32)), ("y", xyz[:, 1].astype(np.float32)),
+               ("z", xyz[:, 2].astype(np.float32))]
+    if rgb is not None:
+        rgb = np.asarray(rgb)
+        if rgb.dtype != np.uint8:
+            rgb = np.round(np.clip(rgb, 0.0, 1.0) * 255).astype(np.uint8)
+        columns.append(("rgb", pack_rgb(rgb)))
+    for name, values in (fields or {}).items():
+        values = np.asarray(values)
+        if values.dtype == np.bool_:
+            values = values.astype(np.uint8)
+        columns.append((name, values))
+    dtype = np.dtype([(name, values.dtype.newbyteorder("<"), values.shape[1:]) for name, values in columns])
+    cloud = np.empty(n, dtype=dtype)
+    for name, values in columns:
+        cloud[name] = values
+
+    tmp_path = os.fspath(pcd_path) + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_header_text(dtype, n, data).encode("ascii"))
+        if data == "binary":
+            cloud.tofile(f)
+        elif data == "ascii":
+            formats = []
+            for name in dtype.names:
+                field = dtype.fields[name][0]
+                width = int(np.prod(field.shape)) if field.shape else 1
+                # 9 cifre significative bastano a ritrovare esattamente un float32
+                formats += ["%.9g" if field.base.kind == "f" else "%d"] * width
+            if n:
+                flat = np.column_stack([cloud[name].reshape(n, -1).astype(object) for name in dtype.names])
+                np.savetxt(f, flat, fmt=" ".join(formats))
+        else:
+            raise ValueError(f"formato PCD non supportato in scrittura: DATA {data}")
+    os.replace(tmp_path, pcd_path)
+    return pcd_path
@@ -1,9 +1,66 @@
 import numpy as np
-import open3d as o3d 
+
+import linalg3
+import instrumentation
 
 seg_polilinea = 5     # numero di segmenti della polilinea con cui si approssima ogni ramo
 k = seg_polilinea + 1 # questo è il numero di intervalli contenenti punti del ramo che utilizziamo per calcolare la polilinea
 
+# segmentazione adattiva (vedi adaptive_segments): invece di k intervalli uguali, ogni
+# segmento viene diviso a metà finché non è abbastanza dritto
+ADAPTIVE_TOLERANCE = 0.001  # scarto massimo (in metri) di un segmento dalla retta
+ADAPTIVE_MAX_DEPTH = 5      # al più 2**5 = 32 segmenti per ramo
+ADAPTIVE_MIN_POINTS = 20    # i segmenti con meno di 2*ADAPTIVE_MIN_POINTS punti non si dividono
+ADAPTIVE_MIN_ASPECT = 2.0   # le metà devono essere lunghe almeno ADAPTIVE_MIN_ASPECT volte lo spessore
+
+# PCA robusta (vedi robust_covariances): assi e diametri stimati ripesando i punti in base
+# alla distanza dall'asse, su un campione limitato di punti per gruppo
+ROBUST_MAX_SAMPLES = 256    # punti (in media, al più) campionati per segmento
+ROBUST_ITERATIONS = 3       # iterazioni di ripesatura
+ROBUST_CUTOFF = 3.0         # peso nullo oltre ROBUST_CUTOFF volte la distanza mediana dall'asse
+
+# =========================================================
+# Modello dati compatto
+# =========================================================
+
+# La precisione del sensore non giustifica float64 per le coordinate: la nuvola viaggia
+# in formato compatto (lo stesso della cache binaria di pcd_cache):
+# - xyz float32, rgb uint8, indici dei punti int32, label dei rami int32
+# Tutte le funzioni pubbliche di questo modulo accettano questi tipi senza convertire
+# l'intera nuvola: le copie float64 si fanno solo dove servono, cioè nell'accumulo dei
+# momenti (covarianze, centroidi) e solo sui punti coinvolti.
+# I colori uint8 vengono riportati in [0,1] solo nei risultati (colori medi), come
+# np.asarray(pcd.colors) di Open3D. Vanno bene anche colori float già in [0,1].
+
+POINT_DTYPE = np.float32
+COLOR_DTYPE = np.uint8
+INDEX_DTYPE = np.int32
+LABEL_DTYPE = np.int32
+
+
+def compact_points(points):
+    """Coordinate in formato compatto (float32); nessuna copia se lo sono già."""
+    return np.asarray(points, dtype=POINT_DTYPE)
+
+
+def compact_colors(colors):
+    """Colori in formato compatto (uint8); i colori float sono intesi nel range [0,1]."""
+    colors = np.asarray(colors)
+    if colors.dtype == COLOR_DTYPE:
+        return colors
+    return np.round(np.clip(colors, 0.0, 1.0) * 255).astype(COLOR_DTYPE)
+
+
+def color_scale(colors):
+    """Fattore che porta somme/medie di colori in [0,1]: 1/255 per i colori uint8, 1 per quelli float."""
+    return 1.0 / 255.0 if np.asarray(colors).dtype == np.uint8 else 1.0
+
+
+def _float_points(points):
+    """I punti in virgola mobile: quelli float32/float64 restano come sono, gli altri diventano float64."""
+    points = np.asarray(points)
+    return points if points.dtype.kind == "f" else points.astype(np.float64)
+
 # =========================================================
 # PCA per ogni ramo 
 # =========================================================
@@ -41,19 +98,65 @@ k = seg_polilinea + 1 # questo è il numero di intervalli contenenti punti del r
 # - ... TODO: finisci
 
 def PCA(points, center):
-    points_centered = points - center
-    # np.cov() si aspetta una matrice dove ogni riga è una variabile e ogni colonna è un'osservazione.
-    # Ovvero una shape: (3, num_punti)
-    # ma noi abbiamo un array di punti con shape: (num_punti, 3), e quindi facciamo una trasposta
-    cov = np.cov(points_centered.T) # .T == .transpose()
-    eigvals, eigvecs = np.linalg.eig(cov)
-    # eigvecs ha shape (3, num_eigenvecs), è quindi una matrice di vettori colonna
-    # prendiamo il vettore colonna associato all'autovalore più grande
-    principal_component = eigvecs[:, np.argmax(eigvals)]  # direzione principale
+    points = _float_points(points)
+    # i punti centrati restano nel tipo dei punti (float32 per la nuvola compatta)
+    points_centered = points - np.asarray(center, dtype=points.dtype)
+    # La covarianza si costruisce dai momenti (numero di punti, somma, somma dei prodotti
+    # esterni X^T X) invece che con np.cov, che ricentra e copia di nuovo i punti.
+    # Il risultato è lo stesso di np.cov(points_centered.T).
+    # L'accumulo dei prodotti va fatto in float64 anche per punti float32: in float32 la
+    # somma di tanti prodotti perderebbe proprio gli autovalori piccoli (i diametri)
+    centered64 = points_centered.astype(np.float64, copy=False)
+    counts = np.array([len(points_centered)])
+    sums = centered64.sum(axis=0)[None]
+    outer = (centered64.T @ centered64)[None]
+    _, cov = covariance_from_moments(counts, sums, outer)
+    # la covarianza è simmetrica: eigh3 (forma chiusa) invece del solver generale np.linalg.eig.
+    # eigvecs è una matrice di vettori colonna, con autovalori in ordine crescente:
+    # l'ultima colonna è associata all'autovalore più grande
+    eigvals, eigvecs = linalg3.eigh3(cov[0])
+    principal_component = eigvecs[:, -1]  # direzione principale
 
     return points_centered, principal_component
 
-def approximate_branch(branch_points, branch_colors):
+def segment_bins(proj, edges):
+    """
+    Assegna ad ogni proiezione l'indice del segmento in cui cade, con la stessa
+    convenzione delle maschere (edges[i] <= proj < edges[i+1]).
+
+    Attenzione: il punto con proiezione massima cade nel bin k (fuori dai segmenti),
+    esattamente come succedeva con le maschere, e va quindi scartato dal chiamante.
+
+    Parametri:
+        - proj: array (N,) delle proiezioni sull'asse del ramo
+        - edges: array (k+1,) degli estremi dei segmenti (np.linspace)
+
+    Ritorna:
+        - bins: array (N,) di interi in [0, k]
+    """
+    # np.digitize ritorna i tale che edges[i-1] <= x < edges[i], quindi togliamo 1
+    return np.digitize(proj, edges) - 1
+
+def segment_sums(values, bins, num_bins, weights=None):
+    """
+    Somma per segmento dei valori (N, D) raggruppati secondo bins, in un solo passaggio
+    (np.bincount per colonna) invece di una maschera booleana per segmento.
+    Con weights (N,) somma values * weights. Le conversioni a float64 si fanno una colonna
+    alla volta, quindi values può restare float32/uint8.
+
+    Ritorna:
+        - sums: array (num_bins, D) in float64
+    """
+    values = np.asarray(values)
+    if weights is None:
+        columns = (values[:, j] for j in range(values.shape[1]))
+    else:
+        columns = (values[:, j] * weights for j in range(values.shape[1]))
+    return np.stack([np.bincount(bins, weights=c, minlength=num_bins)[:num_bins] for c in columns], axis=1)
+
+@instrumentation.timed()
+def approximate_branch(branch_points, branch_colors, mode="mask", with_pc_line=True,
+                       tolerance=ADAPTIVE_TOLERANCE):
     """
     questa funzione, dati gli oggetti che descrivono i rami nella pointcloud segmentata,
     approssima i rami con una polilinea
@@ -61,28 +164,42 @@ def approximate_branch(branch_points, branch_colors):
     Parametri:
         - branch_points: i punti che rappresentano un ramo
         - branch_colors: colori dei punti del ramo
-        
+        - mode: come suddividere i punti nei segmenti
+            - "mask": una maschera booleana su tutto il ramo per ogni segmento (O(k*N))
+            - "binned": un solo passaggio con np.digitize + argsort; i segmenti ritornati
+              sono slice (viste) degli array ordinati per segmento, niente copie per segmento
+            - "adaptive": segmenti di lunghezza variabile (vedi adaptive_segments), in
+              numero diverso da ramo a ramo; i segmenti sono slice come in "binned"
+        - with_pc_line: se False non costruisce il LineSet di Open3D (pc_line è None),
+          così l'analisi può girare su macchine senza Open3D/display
+        - tolerance: tolleranza (in metri) della modalità "adaptive"
+
     Ritorna:
         - branch_segments: lista dei punti del ramo suddivisi per segmenti
         - color_segments: lista dei colori del ramo suddivisi per segmenti 
         - principal_component: asse che approssima il meglio possibile il ramo
         - centers: la lista di centroidi che rappresentano gli estremi dei segmenti della polilinea
-        - pc_line: la linea del principal_component del ramo (per visualizzazione)
+        - pc_line: la linea del principal_component del ramo (per visualizzazione), oppure None
     """
     
-    center = branch_points.mean(axis=0)
+    branch_points = _float_points(branch_points)
+    center = branch_points.mean(axis=0, dtype=np.float64)
     points_centered, principal_component = PCA(branch_points, center)
     # ottengo le proiezioni di tutti i punti del ramo sul principal component
     proj = points_centered.dot(principal_component)
 
     # Calcolo degli estremi della retta del principal component
-    pc_start = center + principal_component * proj.min()
-    pc_end   = center + principal_component * proj.max()
-    pc_line = o3d.geometry.LineSet(
-        points=o3d.utility.Vector3dVector([pc_start, pc_end]),
-        lines=o3d.utility.Vector2iVector([[0, 1]])
-    )
-    pc_line.colors = o3d.utility.Vector3dVector([[0, 0, 1]])  # blu
+    pc_line = None
+    if with_pc_line:
+        # import locale: Open3D serve solo per la visualizzazione
+        import open3d as o3d
+        pc_start = center + principal_component * proj.min()
+        pc_end   = center + principal_component * proj.max()
+        pc_line = o3d.geometry.LineSet(
+            points=o3d.utility.Vector3dVector([pc_start, pc_end]),
+            lines=o3d.utility.Vector2iVector([[0, 1]])
+        )
+        pc_line.colors = o3d.utility.Vector3dVector([[0, 0, 1]])  # blu
 
     # Suddivisione in k segmenti:
     # - proj.min() → valore minimo lungo l’asse
@@ -90,6 +207,20 @@ def approximate_branch(branch_points, branch_colors):
     # - np.linspace(start, stop, num) Genera num valori equidistanti tra start e stop.
     edges = np.linspace(proj.min(), proj.max(), k+1)
 
+    if mode in ("binned", "adaptive"):
+        if mode == "binned":
+            # il bin k contiene solo il punto di proiezione massima, che va scartato
+            bins, num_segments = segment_bins(proj, edges), k
+        else:
+            bins = adaptive_segments(points_centered, np.zeros(len(proj), dtype=LABEL_DTYPE), 1, tolerance=tolerance)
+            num_segments = 1 << ADAPTIVE_MAX_DEPTH
+        branch_segments, color_segments, centers = _grouped_segments(branch_points, branch_colors, bins, num_segments)
+        if len(centers) < 2:
+            return None, None, None, None, None
+        return branch_segments, color_segments, principal_component, centers, pc_line
+    elif mode != "mask":
+        raise ValueError(f"mode sconosciuto: {mode}")
+
     centers = []
     branch_segments = []
     color_segments = []
@@ -104,18 +235,46 @@ def approximate_branch(branch_points, branch_colors):
             # al segmento corrente. Di questi ne calcolo il centroide
             branch_segment_points = branch_points[mask]
             branch_segments.append(branch_segment_points)
-            centers.append(branch_segment_points.mean(axis=0))
+            centers.append(branch_segment_points.mean(axis=0, dtype=np.float64))
             color_segment = branch_colors[mask]
             color_segments.append(color_segment)
 
     centers = np.array(centers)
     if len(centers) < 2:
-        return None, None, None  # non posso creare una polilinea con <2 punti
+        return None, None, None, None, None  # non posso creare una polilinea con <2 punti
 
     return branch_segments, color_segments, principal_component, centers, pc_line
 
+def _grouped_segments(branch_points, branch_colors, bins, num_segments):
+    """
+    Versione a singolo passaggio del ciclo a maschere di approximate_branch.
+
+    - bins dice in quale segmento cade ogni punto (np.digitize per "binned",
+      adaptive_segments per "adaptive"); il bin num_segments vuol dire "scartato"
+    - un argsort stabile raggruppa i punti per segmento mantenendo l'ordine originale
+      all'interno di ogni segmento (quindi i segmenti sono identici a quelli con le maschere)
+    - np.bincount calcola in un colpo solo numero di punti e somme per i centroidi
+    """
+    order = np.argsort(bins, kind="stable")
+    counts = np.bincount(bins, minlength=num_segments+1)[:num_segments]
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    # unica copia (ordinata) dei punti e colori del ramo, i segmenti sono slice di queste
+    sorted_points = branch_points[order]
+    sorted_colors = branch_colors[order]
+
+    nonempty = np.flatnonzero(counts)
+    sums = segment_sums(branch_points, bins, num_segments)
+    centers = sums[nonempty] / counts[nonempty, None]
 
-def compute_branch_features(branch_segments, branch_dir, tree_points, tree_dir, color_segments):
+    branch_segments = [sorted_points[offsets[i]:offsets[i+1]] for i in nonempty]
+    color_segments = [sorted_colors[offsets[i]:offsets[i+1]] for i in nonempty]
+    return branch_segments, color_segments, centers
+
+
+@instrumentation.timed()
+def compute_branch_features(branch_segments, branch_dir, tree_points, tree_dir, color_segments,
+                            robust_samples=None):
     """
     Calcola feature utili per un ramo segmentato in sotto-segmenti.
 
@@ -125,6 +284,8 @@ def compute_branch_features(branch_segments, branch_dir, tree_points, tree_dir,
         - tree_points: point cloud (Nx3) del tronco/capofila principale
         - tree_dir: principal component del tronco
         - branch_colors: array_contenente i colori dei punti del ramo
+        - robust_samples: se dato, i diametri vengono da una PCA robusta su al più
+          (in media) robust_samples punti per segmento (vedi robust_covariances)
 
     Ritorna:
         Un dizionario con:
@@ -137,25 +298,28 @@ def compute_branch_features(branch_segments, branch_dir, tree_points, tree_dir,
     # ------------------------------
     # 1. DIAMETRO LOCALE PER SEGMENTO
     # ------------------------------
-    diameters = []
-    seg_centers = []
-
-    for seg in branch_segments:
-        if len(seg) < 3:
-            diameters.append(0)
-            seg_centers.append(seg.mean(axis=0))
-            continue
-
-        center = seg.mean(axis=0)
-        seg_centers.append(center)
-        # PCA locale per stimare diametro
-        pts_centered = seg - center
-        cov = np.cov(pts_centered.T)
-        eigvals, eigvecs = np.linalg.eig(cov)
+    # PCA locale di tutti i segmenti insieme: momenti per segmento con un'unica riduzione
+    # e un'unica chiamata vettorizzata a eigvalsh3 sullo stack di covarianze
+    seg_counts = np.array([len(seg) for seg in branch_segments])
+    seg_ids = np.repeat(np.arange(len(branch_segments), dtype=LABEL_DTYPE), seg_counts)
+    all_points = np.concatenate(branch_segments) if len(branch_segments) > 0 else np.zeros((0, 3))
+    # i momenti si accumulano rispetto al centro del ramo, per limitare la cancellazione numerica
+    shift = all_points.mean(axis=0, dtype=np.float64) if len(all_points) > 0 else np.zeros(3)
+    counts, sums, outer = segment_moments(all_points - shift, seg_ids, len(branch_segments))
+    seg_centers, cov = covariance_from_moments(counts, sums, outer)
+    if robust_samples is not None:
+        robust = robust_covariances(all_points - shift, seg_ids, len(branch_segments), max_samples=robust_samples)
+        _, cov = prefer_robust(robust, seg_centers, cov)
+    seg_centers = seg_centers + shift
+
+    diameters = [0] * len(branch_segments)
+    big = np.flatnonzero(seg_counts >= 3)
+    if len(big) > 0:
+        eigvals = linalg3.eigvalsh3(cov[big])
         # diametro = 2*std_dev (autovalore minore)
-        raggio = np.sqrt(np.min(eigvals))
-        diameter = 2*raggio
-        diameters.append(float(diameter))
+        raggio = np.sqrt(np.maximum(eigvals[:, 0], 0.0))
+        for i, diameter in zip(big, 2*raggio):
+            diameters[i] = float(diameter)
 
     # ------------------------------
     # 2. LUNGHEZZA TOTALE DEL RAMO
@@ -182,7 +346,7 @@ def compute_branch_features(branch_segments, branch_dir, tree_points, tree_dir,
     mean_colors = []
     for seg_colors in color_segments:
         if len(seg_colors) > 0:
-            mean_colors.append(seg_colors.mean(axis=0))
+            mean_colors.append(seg_colors.mean(axis=0, dtype=np.float64) * color_scale(seg_colors))
         else:
             mean_colors.append(None)
 
@@ -205,3 +369,792 @@ def compute_branch_features(branch_segments, branch_dir, tree_points, tree_dir,
     #     "mean_color": colors
     # })
 
+
+# =========================================================
+# Elaborazione "batch" di tutti i rami in una volta
+# =========================================================
+
+# Chiamare approximate_branch + compute_branch_features per ogni ramo significa fare,
+# per ogni ramo e per ogni segmento, un np.cov + np.linalg.eig su una matrice 3x3.
+# Con migliaia di rami il tempo se ne va quasi tutto in overhead dell'interprete e
+# in chiamate LAPACK minuscole.
+#
+# BranchBatch fa lo stesso lavoro "impilando" tutti i rami:
+# - ogni punto ha un'etichetta (label) che dice a quale ramo appartiene
+# - le statistiche per ramo/segmento (numero di punti, somme, somme dei prodotti esterni)
+#   si ottengono con riduzioni segmentate (np.bincount) su tutti i punti in un colpo solo
+# - le covarianze diventano uno stack (M,3,3) che si diagonalizza con un'unica
+#   chiamata a linalg3.eigh3 (simmetrica, in forma chiusa, autovalori reali e ordinati)
+
+def segment_moments(values, bins, num_bins, weights=None):
+    """
+    Statistiche sufficienti per gruppo: numero di punti, somma e somma dei prodotti esterni.
+
+    Parametri:
+        - values: array (N,3)
+        - bins: array (N,) di interi in [0, num_bins), il gruppo di ogni punto
+        - num_bins: numero di gruppi
+        - weights: pesi (N,) dei punti (opzionale): counts diventa la somma dei pesi
+
+    Ritorna:
+        - counts: array (num_bins,)
+        - sums: array (num_bins,3)
+        - outer: array (num_bins,3,3), somma di v v^T per gruppo
+    """
+    # i prodotti vanno fatti in float64 anche se i punti sono float32
+    values = np.asarray(values, dtype=np.float64)
+    counts = np.bincount(bins, weights=weights, minlength=num_bins)[:num_bins]
+    sums = segment_sums(values, bins, num_bins, weights=weights)
+    weighted = values if weights is None else values * weights[:, None]
+    outer = np.empty((num_bins, 3, 3))
+    # la matrice è simmetrica: bastano 6 riduzioni invece di 9
+    for a in range(3):
+        for b in range(a, 3):
+            s = np.bincount(bins, weights=weighted[:, a] * values[:, b], minlength=num_bins)[:num_bins]
+            outer[:, a, b] = s
+            outer[:, b, a] = s
+    return counts, sums, outer
+
+def covariance_from_moments(counts, sums, outer):
+    """
+    Covarianza campionaria (come np.cov, cioè divisa per n-1) a partire dai momenti.
+    I gruppi con meno di 2 punti ottengono una covarianza di NaN.
+    """
+    counts = np.asarray(counts, dtype=float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts[:, None]
+        cov = (outer - counts[:, None, None] * means[:, :, None] * means[:, None, :]) / (counts[:, None, None] - 1)
+    cov[counts < 2] = np.nan
+    return means, cov
+
+def principal_axes(cov):
+    """
+    Asse principale di uno stack di covarianze (M,3,3): autovettore dell'autovalore più grande.
+    Le covarianze non valide (NaN) ottengono un asse di NaN.
+    """
+    axes = np.full((len(cov), 3), np.nan)
+    ok = np.all(np.isfinite(cov), axis=(1, 2))
+    if np.any(ok):
+        # eigh3 ritorna gli autovalori in ordine crescente: l'ultimo autovettore è l'asse principale
+        _, eigvecs = linalg3.eigh3(cov[ok])
+        axes[ok] = eigvecs[:, :, -1]
+    return axes
+
+def assign_segments(proj, labels, proj_min, proj_max, num_segments=k):
+    """
+    Versione multi-ramo di segment_bins: assegna ogni punto al suo segmento, usando per
+    ogni ramo gli stessi estremi di np.linspace(proj.min(), proj.max(), k+1).
+
+    Parametri:
+        - proj: array (N,) delle proiezioni di ogni punto sull'asse del suo ramo
+        - labels: array (N,) del ramo di ogni punto
+        - proj_min, proj_max: array (num_rami,) degli estremi delle proiezioni di ogni ramo
+        - num_segments: numero di segmenti per ramo
+
+    Ritorna:
+        - bins: array (N,) in [0, num_segments]; num_segments vuol dire "fuori dai segmenti"
+          (il punto di proiezione massima, oppure un ramo degenere)
+    """
+    ks = num_segments
+    with np.errstate(invalid="ignore", divide="ignore"):
+        edges = np.linspace(proj_min, proj_max, ks+1, axis=1)
+        step = (proj_max - proj_min) / ks
+        # stima del bin con una divisione, poi correzione di +-1 confrontando con gli
+        # estremi esatti, così da avere la stessa convenzione di np.digitize
+        bins = np.floor((proj - proj_min[labels]) / step[labels])
+    bins = np.nan_to_num(bins, nan=ks, posinf=ks, neginf=0).astype(np.int64)
+    np.clip(bins, 0, ks, out=bins)
+    lower = edges[labels, bins]
+    bins -= (proj < lower)
+    upper = edges[labels, np.minimum(bins + 1, ks)]
+    bins += (bins < ks) & (proj >= upper)
+    # rami degeneri (tutte le proiezioni uguali): nessun segmento, come con le maschere
+    bins[~(step[labels] > 0)] = ks
+    return bins
+
+# ------------------------------
+# Segmentazione adattiva
+# ------------------------------
+
+# Con k intervalli uguali lungo l'asse globale del ramo i rametti corti vengono divisi
+# troppo, i tralci lunghi e curvi troppo poco, e dove il ramo curva molto punti lontani
+# lungo il ramo finiscono nello stesso intervallo (si "ripiegano" sull'asse dritto).
+#
+# adaptive_segments divide invece ogni segmento in due (a metà della sua estensione lungo
+# il suo asse, non quello del ramo) finché non è abbastanza dritto:
+# - si parte dal ramo intero; ad ogni passo, per ogni segmento ancora attivo, si
+#   calcolano con riduzioni segmentate l'asse principale e i centroidi dei quattro quarti
+#   del segmento lungo l'asse
+# - lo scarto del segmento è la distanza dei centroidi dei due quarti centrali dalla retta
+#   che passa per quelli dei quarti estremi: zero per un tratto dritto, cresce con la
+#   curvatura (come la freccia di un arco) e, a differenza degli autovalori della
+#   covarianza, non dipende dallo spessore del ramo né dalla forma della sua sezione.
+#   (Il centroide dell'intero segmento non basta: è sempre sulla retta per i centroidi
+#   delle sue due metà, essendone la media pesata)
+# - non si divide un segmento le cui metà sarebbero più corte di ADAPTIVE_MIN_ASPECT volte
+#   lo spessore (2*sqrt del secondo autovalore): in un segmento più corto che largo
+#   l'autovalore minore non è più quello della sezione e i diametri perdono di senso
+# - i segmenti con scarto oltre la tolleranza vengono divisi, gli altri sono definitivi e
+#   i loro punti escono dal calcolo: ogni passo costa solo i punti ancora attivi
+#
+# L'asse di ogni figlio è orientato come quello del padre, così la metà "sinistra" viene
+# sempre prima lungo il ramo: la posizione di un segmento è un intero in [0, 2**max_depth)
+# (le cifre binarie sono le scelte sinistra/destra) e ordinando per ramo e posizione i
+# segmenti sono in ordine lungo il ramo.
+# Il numero di segmenti varia da ramo a ramo; nella tabella di BranchBatch stanno comunque
+# in formato CSR (segment_offsets), come con gli intervalli fissi.
+
+def adaptive_segments(points, labels, num_branches, tolerance=ADAPTIVE_TOLERANCE,
+                      max_depth=ADAPTIVE_MAX_DEPTH, min_points=ADAPTIVE_MIN_POINTS,
+                      min_aspect=ADAPTIVE_MIN_ASPECT, min_depth=2):
+    """
+    Suddivide ricorsivamente (ma in forma vettorizzata su tutti i rami) ogni ramo in
+    segmenti quasi dritti.
+
+    Parametri:
+        - points: array (N,3) dei punti (meglio se traslati vicino all'origine)
+        - labels: array (N,) del ramo di ogni punto, in [0, num_branches)
+        - num_branches: numero di rami
+        - tolerance: scarto massimo (in metri) dei centroidi dei quarti centrali di un
+          segmento dalla retta per i centroidi dei quarti estremi
+        - max_depth: profondità massima delle divisioni (al più 2**max_depth segmenti per ramo)
+        - min_points: non si dividono segmenti con meno di 2*min_points punti
+        - min_aspect: lunghezza minima delle metà, in multipli dello spessore del segmento
+        - min_depth: divisioni fatte comunque (1: almeno 2 segmenti per ramo, se possibile)
+
+    Ritorna:
+        - seg_ids: array (N,) int64 con l'id del segmento di ogni punto,
+          ramo * 2**max_depth + posizione lungo il ramo
+    """
+    span = 1 << max_depth
+    labels = np.asarray(labels)
+    seg_ids = labels.astype(np.int64) * span
+
+    # stato dei segmenti attivi: punti (indici nell'input) e, per segmento, ramo,
+    # posizione e asse del padre (per orientare il proprio)
+    active = np.arange(len(labels))
+    piece = labels.astype(np.int64)
+    piece_branch = np.arange(num_branches, dtype=np.int64)
+    piece_pos = np.zeros(num_branches, dtype=np.int64)
+    parent_axis = None
+
+    for depth in range(max_depth):
+        P = len(piece_branch)
+        if len(active) == 0 or P == 0:
+            break
+        values = points[active]
+        counts, sums, outer = segment_moments(values, piece, P)
+        means, cov = covariance_from_moments(counts, sums, outer)
+        eigvals = np.full((P, 3), np.nan)
+        axes = np.full((P, 3), np.nan)
+        ok = np.all(np.isfinite(cov), axis=(1, 2))
+        if np.any(ok):
+            eigvals[ok], eigvecs = linalg3.eigh3(cov[ok])
+            axes[ok] = eigvecs[:, :, -1]
+        if parent_axis is not None:
+            flip = np.einsum("ij,ij->i", axes, parent_axis) < 0
+            axes[flip] *= -1
+
+        # quarti di ogni segmento lungo il suo asse
+        proj = np.einsum("ij,ij->i", values - means[piece], axes[piece])
+        proj_min = np.full(P, np.inf)
+        proj_max = np.full(P, -np.inf)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            np.minimum.at(proj_min, piece, proj)
+            np.maximum.at(proj_max, piece, proj)
+            quarter = np.floor(4 * (proj - proj_min[piece]) / (proj_max - proj_min)[piece])
+        quarter = np.clip(np.nan_to_num(quarter), 0, 3).astype(np.int64)
+        quarters = piece * 4 + quarter
+        quarter_counts = np.bincount(quarters, minlength=4*P).reshape(P, 4)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            quarter_means = (segment_sums(values, quarters, 4*P) / quarter_counts.reshape(-1)[:, None]).reshape(P, 4, 3)
+            # scarto: distanza massima dei centroidi dei quarti centrali dalla retta per i
+            # centroidi dei quarti estremi (NaN se un quarto è vuoto: non si divide)
+            chord = quarter_means[:, 3] - quarter_means[:, 0]
+            chord /= np.linalg.norm(chord, axis=1, keepdims=True)
+            offset = quarter_means[:, 1:3] - quarter_means[:, :1]
+            along = np.einsum("iqj,ij->iq", offset, chord)
+            deviation = np.linalg.norm(offset - along[:, :, None] * chord[:, None], axis=2).max(axis=1)
+
+        right = quarter >= 2
+        halves = piece * 2 + right
+        half_counts = quarter_counts[:, :2].sum(axis=1), quarter_counts[:, 2:].sum(axis=1)
+        both_halves = (half_counts[0] > 0) & (half_counts[1] > 0)
+        with np.errstate(invalid="ignore"):
+            thickness = 2 * np.sqrt(np.maximum(eigvals[:, 1], 0.0))
+            long_enough = (proj_max - proj_min) / 2 >= min_aspect * thickness
+        curved = (counts >= 2 * min_points) & long_enough & (deviation > tolerance)
+        split = both_halves & ((depth < min_depth) | curved)
+
+        # i segmenti che non si dividono sono definitivi
+        done = ~split[piece]
+        seg_ids[active[done]] = piece_branch[piece[done]] * span + piece_pos[piece[done]]
+        keep = ~done
+        if not np.any(keep):
+            break
+
+        # i figli dei segmenti divisi: metà sinistra e destra, con nuovi id compatti
+        parents = np.flatnonzero(split)
+        child = np.full(2*P, -1, dtype=np.int64)
+        child[2*parents] = 2*np.arange(len(parents))
+        child[2*parents + 1] = 2*np.arange(len(parents)) + 1
+        active = active[keep]
+        piece = child[halves[keep]]
+        piece_branch = np.repeat(piece_branch[parents], 2)
+        width = span >> (depth + 1)
+        piece_pos = np.repeat(piece_pos[parents], 2) + np.tile([0, width], len(parents))
+        parent_axis = np.repeat(axes[parents], 2, axis=0)
+    else:
+        # profondità massima raggiunta: i segmenti ancora attivi sono definitivi
+        seg_ids[active] = piece_branch[piece] * span + piece_pos[piece]
+    return seg_ids
+
+# ------------------------------
+# PCA robusta
+# ------------------------------
+
+# Diametri (2*sqrt dell'autovalore minore) e assi si ricavano dalla covarianza di tutti i
+# punti del segmento: bastano poche foglie o un pezzo di filo della spalliera finiti
+# nell'annotazione del ramo per gonfiare il diametro e far ruotare l'asse.
+#
+# robust_covariances stima invece media e covarianza con una PCA iterativamente ripesata
+# (IRLS), per tutti i gruppi insieme:
+# - da ogni gruppo si campionano in media al più max_samples punti (ogni punto è tenuto con
+#   probabilità max_samples/numero di punti del gruppo): il costo delle iterazioni dipende
+#   dal numero di gruppi e non dalla densità della scansione. L'estrazione è un hash del
+#   seme e dell'indice del punto nella nuvola (in BranchBatch): a parità di punti il
+#   campione di un gruppo è sempre lo stesso, da una run all'altra e qualunque siano gli
+#   altri gruppi, e costa un solo passaggio sui punti (niente ordinamenti)
+# - ad ogni iterazione, per ogni punto si calcola la distanza r dall'asse del suo gruppo
+#   (la retta per la media lungo l'asse principale) e il peso di Tukey
+#   (1 - (r/c)^2)^2, nullo oltre c = cutoff * mediana di r nel gruppo: i punti della
+#   superficie del ramo stanno tutti a circa un raggio dall'asse e pesano quasi uguale,
+#   quelli molto più lontani non contano più
+# - media e covarianza pesate sono riduzioni segmentate (segment_moments con weights) e
+#   gli assi un'unica chiamata a eigh3, come per la PCA normale
+# I pesi di ogni gruppo vengono riscalati perché sommino al numero di punti campionati:
+# covariance_from_moments divide allora per n-1 come per la PCA normale.
+
+def group_medians(values, groups, num_groups):
+    """Mediana (inferiore) di values per gruppo; NaN per i gruppi vuoti."""
+    order = np.lexsort((values, groups))
+    counts = np.bincount(groups, minlength=num_groups)[:num_groups]
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    medians = np.full(num_groups, np.nan)
+    nonempty = counts > 0
+    medians[nonempty] = values[order[offsets[:-1][nonempty] + (counts[nonempty] - 1) // 2]]
+    return medians
+
+
+def hash_uniform(keys, seed=0):
+    """
+    Numeri pseudo-casuali in [0,1) funzione solo di (seed, key): un hash splitmix64 delle
+    chiavi intere, invece di un generatore che dipende dall'ordine delle estrazioni.
+    """
+    mask = (1 << 64) - 1
+    x = np.asarray(keys).astype(np.uint64) + np.uint64((seed * 0x9E3779B97F4A7C15 + 0x632BE59BD9B4E019) & mask)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    x = x ^ (x >> np.uint64(31))
+    return (x >> np.uint64(11)).astype(np.float64) * 2.0**-53
+
+
+def sample_groups(groups, num_groups, max_samples=ROBUST_MAX_SAMPLES, seed=0, keys=None):
+    """
+    Indici di un campione casuale (riproducibile) dei punti, con in media al più
+    max_samples punti per gruppo; i gruppi più piccoli vengono tenuti per intero.
+
+    Ogni punto viene tenuto o scartato in base a (seed, key) e alla dimensione del suo
+    gruppo. Con chiavi stabili (ad es. l'indice del punto nella nuvola) il campione di un
+    gruppo non dipende dagli altri gruppi del batch: un ramo ricalcolato da solo (vedi
+    incremental.py) ottiene lo stesso campione che nel batch completo.
+
+    Parametri:
+        - keys: array (N,) di interi, la chiave di ogni punto (default: la sua posizione
+          in groups, che però cambia con gli altri gruppi del batch)
+    """
+    counts = np.bincount(groups, minlength=num_groups)[:num_groups]
+    with np.errstate(divide="ignore"):
+        keep_prob = np.minimum(1.0, max_samples / counts)
+    keys = np.arange(len(groups)) if keys is None else keys
+    return np.flatnonzero(hash_uniform(keys, seed) < keep_prob[groups])
+
+
+@instrumentation.timed()
+def robust_covariances(values, groups, num_groups, max_samples=ROBUST_MAX_SAMPLES,
+                       iterations=ROBUST_ITERATIONS, cutoff=ROBUST_CUTOFF, seed=0, keys=None):
+    """
+    Media e covarianza robuste di ogni gruppo di punti (PCA iterativamente ripesata su un
+    campione limitato di punti per gruppo).
+
+    Parametri:
+        - values: array (N,3)
+        - groups: array (N,) di interi in [0, num_groups), il gruppo di ogni punto
+        - num_groups: numero di gruppi
+        - max_samples: punti campionati per gruppo (in media, al più)
+        - iterations: iterazioni di ripesatura (0 = PCA normale sul campione)
+        - cutoff: distanza dall'asse, in multipli della mediana del gruppo, oltre la quale
+          un punto ha peso nullo
+        - seed: seme del campionamento
+        - keys: chiave di ogni punto per il campionamento (vedi sample_groups)
+
+    Ritorna:
+        - means: array (num_groups,3)
+        - cov: array (num_groups,3,3), NaN per i gruppi con meno di 2 punti campionati
+    """
+    groups = np.asarray(groups)
+    keep = sample_groups(groups, num_groups, max_samples, seed, keys)
+    values = np.asarray(values)[keep].astype(np.float64)
+    groups = groups[keep]
+    num_samples = np.bincount(groups, minlength=num_groups)[:num_groups]
+    weights = None
+    for _ in range(iterations):
+        counts, sums, outer = segment_moments(values, groups, num_groups, weights=weights)
+        means, cov = covariance_from_moments(counts, sums, outer)
+        axes = principal_axes(cov)[groups]
+        centered = values - means[groups]
+        along = np.einsum("ij,ij->i", centered, axes)
+        r = np.linalg.norm(centered - along[:, None] * axes, axis=1)
+        scale = cutoff * group_medians(r, groups, num_groups)[groups]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            u = r / scale
+        weights = np.where(u < 1, (1 - u**2)**2, 0.0)
+        # gruppi degeneri (tutti i punti sull'asse, meno di 3 punti): pesi uniformi
+        weights[~(scale > 0)] = 1.0
+        total = np.bincount(groups, weights=weights, minlength=num_groups)[:num_groups]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weights *= (num_samples / total)[groups]
+        weights[~np.isfinite(weights)] = 1.0
+    counts, sums, outer = segment_moments(values, groups, num_groups, weights=weights)
+    return covariance_from_moments(counts, sums, outer)
+
+
+def prefer_robust(robust, means, cov):
+    """
+    Sostituisce media e covarianza con quelle robuste (risultato di robust_covariances)
+    dove queste sono definite; altrove (gruppi con meno di 2 punti campionati) restano
+    quelle di tutti i punti.
+    """
+    robust_means, robust_cov = robust
+    ok = np.all(np.isfinite(robust_cov), axis=(1, 2))
+    means, cov = means.copy(), cov.copy()
+    means[ok] = robust_means[ok]
+    cov[ok] = robust_cov[ok]
+    return means, cov
+
+
+def inclination_angles(principal_components, tree_dir):
+    """
+    Angolo in gradi (tra 0 e 90) tra gli assi dei rami e il tronco.
+
+    Parametri:
+        - principal_components: array (B,3) degli assi dei rami (normalizzati)
+        - tree_dir: direzione del tronco, unica (3,) oppure una per ramo (B,3)
+    """
+    tree_dir = np.asarray(tree_dir, dtype=float)
+    tree_dir = tree_dir / np.linalg.norm(tree_dir, axis=-1, keepdims=True)
+    dot = np.sum(np.asarray(principal_components) * tree_dir, axis=-1)
+    return np.degrees(np.arccos(np.clip(np.abs(dot), 0.0, 1.0)))
+
+
+def branch_table_from_moments(num_points, centers, principal_components, proj_min, proj_max,
+                              seg_ids, seg_counts, seg_means, seg_cov, seg_color_sums,
+                              tree_dir, num_segments=k):
+    """
+    Costruisce la tabella colonnare delle feature (vedi BranchBatch.compute) a partire dalle
+    statistiche già ridotte per ramo e per segmento. È condivisa tra BranchBatch e la
+    pipeline in streaming, che arrivano alle stesse statistiche per strade diverse.
+
+    Parametri:
+        - num_points, centers, principal_components, proj_min, proj_max: colonne per ramo
+        - seg_ids: id (ramo*num_segments + bin) dei segmenti NON vuoti, in ordine crescente
+        - seg_counts, seg_means, seg_cov: numero di punti, centroide e covarianza dei segmenti
+        - seg_color_sums: somma dei colori per segmento (oppure None)
+        - tree_dir: principal component del tronco
+    """
+    B, ks = len(num_points), num_segments
+
+    # ------------------------------
+    # 1. DIAMETRO LOCALE PER SEGMENTO
+    # ------------------------------
+    diameters = np.zeros(len(seg_ids))
+    big = seg_counts >= 3
+    if np.any(big):
+        seg_eigvals = linalg3.eigvalsh3(seg_cov[big])
+        # diametro = 2*std_dev (autovalore minore)
+        diameters[big] = 2*np.sqrt(np.maximum(seg_eigvals[:, 0], 0.0))
+    seg_branch = seg_ids // ks
+    segs_per_branch = np.bincount(seg_branch, minlength=B)
+    segment_offsets = np.concatenate(([0], np.cumsum(segs_per_branch)))
+    # approximate_branch non costruisce la polilinea con meno di 2 segmenti
+    valid = (np.asarray(num_points) >= 2) & (segs_per_branch >= 2)
+
+    # ------------------------------
+    # 2. LUNGHEZZA TOTALE DEL RAMO
+    # ------------------------------
+    # somma delle distanze tra centroidi consecutivi dello stesso ramo
+    step_lengths = np.linalg.norm(np.diff(seg_means, axis=0), axis=1)
+    same_branch = seg_branch[1:] == seg_branch[:-1]
+    branch_length = np.bincount(seg_branch[1:][same_branch], weights=step_lengths[same_branch], minlength=B)
+
+    # ------------------------------
+    # 3. INCLINAZIONE DEL RAMO RISPETTO AL TRONCO
+    # ------------------------------
+    inclination_angle = inclination_angles(principal_components, tree_dir)
+
+    # ------------------------------
+    # 4. COLORE MEDIO PER SEGMENTO
+    # ------------------------------
+    if seg_color_sums is not None:
+        mean_colors = seg_color_sums / seg_counts[:, None]
+    else:
+        mean_colors = np.full((len(seg_ids), 3), np.nan)
+
+    return {
+        "valid": valid,
+        "num_points": np.asarray(num_points),
+        "center": centers,
+        "principal_component": principal_components,
+        "proj_min": proj_min,
+        "proj_max": proj_max,
+        "branch_length": branch_length,
+        "inclination_angle": inclination_angle,
+        "segment_offsets": segment_offsets,
+        "segment_branch": seg_branch,
+        "segment_index": seg_ids % ks,
+        "segment_num_points": seg_counts,
+        "segment_centers": seg_means,
+        "diameters": diameters,
+        "mean_colors": mean_colors,
+    }
+
+class BranchBatch:
+    """
+    Approssimazione e feature di tutti i rami di una pointcloud in forma vettorizzata.
+
+    Parametri:
+        - points: array (N,3) di tutti i punti (float32 o float64)
+        - labels: array (N,) con l'indice del ramo (0..num_branches-1) di ogni punto,
+          -1 per i punti che non appartengono a nessun ramo
+        - colors: array (N,3) dei colori, uint8 oppure float in [0,1] (opzionale)
+        - num_segments: numero di intervalli in cui dividere ogni ramo (come k)
+        - num_branches: numero di rami (default: max(labels)+1)
+        - tolerance: se dato, i segmenti non sono num_segments intervalli uguali ma quelli
+          di adaptive_segments con questa tolleranza (in metri); il loro numero varia da
+          ramo a ramo
+        - robust_samples: se dato, assi dei rami, centroidi e diametri dei segmenti vengono
+          dalla PCA robusta (robust_covariances) su al più (in media) robust_samples punti
+          per ramo e per segmento, invece che dalla covarianza di tutti i punti
+        - point_ids: array (N,) dell'indice di ogni punto nella nuvola, la chiave del
+          campionamento della PCA robusta (default: la posizione in points)
+
+    I risultati sono equivalenti a quelli di approximate_branch + compute_branch_features,
+    a meno del verso del principal component (che per la PCA è arbitrario).
+    """
+
+    def __init__(self, points, labels, colors=None, num_segments=k, num_branches=None, tolerance=None,
+                 robust_samples=None, point_ids=None):
+        labels = np.asarray(labels)
+        mask = labels >= 0
+        point_ids = np.arange(len(labels)) if point_ids is None else np.asarray(point_ids)
+        if np.all(mask):
+            self.points = np.asarray(points)
+            self.labels = labels
+            self.colors = None if colors is None else np.asarray(colors)
+            self.point_ids = point_ids
+        else:
+            self.points = np.asarray(points)[mask]
+            self.labels = labels[mask]
+            self.colors = None if colors is None else np.asarray(colors)[mask]
+            self.point_ids = point_ids[mask]
+        self.num_segments = num_segments
+        self.tolerance = tolerance
+        self.robust_samples = robust_samples
+        if num_branches is None:
+            num_branches = int(self.labels.max()) + 1 if len(self.labels) > 0 else 0
+        self.num_branches = num_branches
+
+    @classmethod
+    def from_indices(cls, points, colors, indices, offsets, num_segments=k, tolerance=None, robust_samples=None):
+        """
+        Costruisce il batch a partire dagli indici dei punti di ogni ramo, in formato CSR:
+        i punti del ramo i sono points[indices[offsets[i]:offsets[i+1]]].
+        A differenza del vettore di label, qui uno stesso punto può appartenere a più rami.
+        Gli indici sono anche le chiavi del campionamento della PCA robusta, quindi un
+        ramo ha lo stesso campione qualunque sia il batch in cui si trova.
+        """
+        indices = np.asarray(indices)
+        offsets = np.asarray(offsets)
+        labels = np.repeat(np.arange(len(offsets) - 1, dtype=LABEL_DTYPE), np.diff(offsets))
+        branch_colors = None if colors is None else np.asarray(colors)[indices]
+        return cls(np.asarray(points)[indices], labels, branch_colors,
+                   num_segments=num_segments, num_branches=len(offsets) - 1, tolerance=tolerance,
+                   robust_samples=robust_samples, point_ids=indices)
+
+    @instrumentation.timed()
+    def compute(self, tree_dir):
+        """
+        Calcola PCA, segmenti, diametri, lunghezze e inclinazioni di tutti i rami.
+
+        Parametri:
+            - tree_dir: principal component del tronco
+
+        Ritorna:
+            Una tabella colonnare (dizionario di array) con:
+            - colonne per ramo (lunghezza num_branches):
+                - valid: False se il ramo ha meno di 2 segmenti (approximate_branch ritornerebbe None)
+                - num_points, center, principal_component, proj_min, proj_max
+                - branch_length, inclination_angle
+                - segment_offsets (num_branches+1): i segmenti del ramo b sono
+                  le righe segment_offsets[b]:segment_offsets[b+1] delle colonne per segmento
+            - colonne per segmento (solo segmenti non vuoti, ordinati per ramo e lungo l'asse):
+                - segment_branch, segment_index (con tolerance: posizione del segmento nel
+                  ramo, 0..n-1), segment_num_points
+                - segment_centers, diameters, mean_colors
+        """
+        B, ks = self.num_branches, self.num_segments
+        points, labels = _float_points(self.points), self.labels
+
+        # PCA di ogni ramo.
+        # Trasliamo tutto sul baricentro globale per limitare la cancellazione numerica
+        # nel calcolo della covarianza dai momenti (coordinate lontane dall'origine).
+        # I punti traslati restano nel tipo dei punti: i momenti si accumulano comunque in float64
+        shift = points.mean(axis=0, dtype=np.float64) if len(points) > 0 else np.zeros(3)
+        shifted = points - shift.astype(points.dtype)
+        shift = shift.astype(points.dtype).astype(np.float64)
+        counts, sums, outer = segment_moments(shifted, labels, B)
+        means, cov = covariance_from_moments(counts, sums, outer)
+        if self.robust_samples is not None:
+            means, cov = prefer_robust(robust_covariances(shifted, labels, B, max_samples=self.robust_samples,
+                                                          keys=self.point_ids), means, cov)
+        principal_components = principal_axes(cov)
+
+        # proiezioni e suddivisione in segmenti
+        proj = np.einsum("ij,ij->i", shifted - means[labels], principal_components[labels])
+        proj_min = np.full(B, np.inf)
+        proj_max = np.full(B, -np.inf)
+        with np.errstate(invalid="ignore"):  # rami con meno di 2 punti hanno proiezioni NaN
+            np.minimum.at(proj_min, labels, proj)
+            np.maximum.at(proj_max, labels, proj)
+        if self.tolerance is None:
+            bins = assign_segments(proj, labels, proj_min, proj_max, ks)
+            # il bin ks contiene solo il punto di proiezione massima: lo scartiamo
+            in_segment = bins < ks
+            seg_ids = labels[in_segment] * ks + bins[in_segment]
+        else:
+            # ids ramo * 2**max_depth + posizione: stessa codifica degli intervalli fissi
+            ks = 1 << ADAPTIVE_MAX_DEPTH
+            in_segment = slice(None)
+            seg_ids = adaptive_segments(shifted, labels, B, tolerance=self.tolerance)
+
+        # statistiche per segmento
+        seg_counts, seg_sums, seg_outer = segment_moments(shifted[in_segment], seg_ids, B*ks)
+        nonempty = np.flatnonzero(seg_counts)
+        seg_means, seg_cov = covariance_from_moments(seg_counts[nonempty], seg_sums[nonempty], seg_outer[nonempty])
+        if self.robust_samples is not None:
+            robust_means, robust_cov = robust_covariances(shifted[in_segment], seg_ids, B*ks,
+                                                          max_samples=self.robust_samples,
+                                                          keys=self.point_ids[in_segment])
+            seg_means, seg_cov = prefer_robust((robust_means[nonempty], robust_cov[nonempty]), seg_means, seg_cov)
+        seg_color_sums = None
+        if self.colors is not None:
+            seg_color_sums = segment_sums(self.colors[in_segment], seg_ids, B*ks)[nonempty] * color_scale(self.colors)
+
+        table = branch_table_from_moments(
+            counts, means + shift, principal_components, proj_min, proj_max,
+            nonempty, seg_counts[nonempty], seg_means + shift, seg_cov, seg_color_sums,
+            tree_dir, ks)
+        if self.tolerance is not None:
+            # le posizioni binarie non dicono nulla a chi legge: numeriamo i segmenti 0..n-1
+            table["segment_index"] = np.arange(len(nonempty)) - table["segment_offsets"][table["segment_branch"]]
+        return table
+
+    @staticmethod
+    def branch_features(table, branch):
+        """
+        Estrae dalla tabella colonnare le feature di un singolo ramo, nello stesso
+        formato del dizionario ritornato da compute_branch_features.
+        """
+        s, e = table["segment_offsets"][branch], table["segment_offsets"][branch+1]
+        return {
+            "diameters": [float(d) for d in table["diameters"][s:e]],
+            "branch_length": float(table["branch_length"][branch]),
+            "inclination_angle": float(table["inclination_angle"][branch]),
+            "mean_colors": list(table["mean_colors"][s:e])
+        }
+
+
+# =========================================================
+# Sottocampionamento a voxel e piramide multi-risoluzione
+# =========================================================
+
+# Per la visualizzazione basta una versione "a voxel" della nuvola, dove tutti i punti
+# che cadono nello stesso cubetto di lato voxel_size vengono sostituiti dalla loro media
+# (xyz e rgb). Le feature di rami e tronchi si calcolano invece sempre a risoluzione
+# piena: la media dei punti di un voxel schiaccia la sezione dei rami e sposta i
+# centroidi dei segmenti, e con la modalità streaming (che legge tutti i punti) i
+# risultati non sarebbero più confrontabili.
+#
+# Ogni punto riceve una chiave intera (quella del voxel in cui cade); np.unique con
+# return_inverse dà insieme i voxel occupati e la mappa punto -> voxel, e le medie sono
+# riduzioni segmentate (np.bincount) come per i segmenti dei rami.
+#
+# Se si danno le label degli oggetti (una per punto, ad es. -1 = non annotato), la chiave
+# è quella della coppia (oggetto, voxel): un voxel non mescola mai punti (e colori) di
+# oggetti diversi, e la mappa punto -> voxel "traduce" gli indici delle annotazioni (che
+# si riferiscono ai punti originali) nei voxel di un livello assegnando ogni voxel a un
+# solo oggetto (VoxelPyramid.object_indices).
+
+@instrumentation.timed()
+def voxel_downsample(points, voxel_size, colors=None, weights=None, origin=None, labels=None):
+    """
+    Sottocampiona una nuvola sostituendo i punti di ogni voxel con la loro media.
+
+    Parametri:
+        - points: array (N,3)
+        - voxel_size: lato dei voxel
+        - colors: array (N,3) dei colori (opzionale), mediati come le coordinate
+        - weights: peso di ogni punto (opzionale), ad es. il numero di punti originali
+          che rappresenta quando si sottocampiona una nuvola già sottocampionata
+        - origin: origine della griglia (default: il minimo dei punti)
+        - labels: oggetto di ogni punto (opzionale): se dato, punti di oggetti diversi
+          finiscono in voxel diversi anche se cadono nello stesso cubetto
+
+    Ritorna:
+        - voxel_points: array (V,3), media (pesata) dei punti di ogni voxel
+        - voxel_colors: array (V,3) oppure None
+        - point_to_voxel: array (N,), il voxel di ogni punto
+        - voxel_weights: array (V,), somma dei pesi (numero di punti) di ogni voxel
+    """
+    points = _float_points(points)
+    if len(points) == 0:
+        return (np.zeros((0, 3), dtype=points.dtype), None if colors is None else np.zeros((0, 3)),
+                np.zeros(0, dtype=np.int64), np.zeros(0))
+    origin = points.min(axis=0) if origin is None else np.asarray(origin)
+    coords = np.floor((points - origin) / voxel_size).astype(np.int64)
+    coords -= coords.min(axis=0)
+    dims = coords.max(axis=0) + 1
+    keys = (coords[:, 0] * dims[1] + coords[:, 1]) * dims[2] + coords[:, 2]
+    if labels is not None:
+        labels = np.asarray(labels, dtype=np.int64)
+        labels = labels - labels.min()
+        keys = keys * (int(labels.max()) + 1) + labels
+    _, point_to_voxel = np.unique(keys, return_inverse=True)
+    point_to_voxel = point_to_voxel.ravel()
+    V = int(point_to_voxel.max()) + 1
+
+    # le medie si accumulano in float64, ma i voxel tornano nel tipo dei dati in ingresso
+    # (float32/uint8 per la nuvola compatta)
+    weights = np.ones(len(points)) if weights is None else np.asarray(weights, dtype=np.float64)
+    voxel_weights = np.bincount(point_to_voxel, weights=weights, minlength=V)
+    voxel_points = segment_sums(points, point_to_voxel, V, weights) / voxel_weights[:, None]
+    voxel_points = voxel_points.astype(points.dtype)
+    voxel_colors = None
+    if colors is not None:
+        colors = np.asarray(colors)
+        voxel_colors = segment_sums(colors, point_to_voxel, V, weights) / voxel_weights[:, None]
+        if colors.dtype.kind in "ui":
+            voxel_colors = np.round(voxel_colors)
+        voxel_colors = voxel_colors.astype(colors.dtype)
+    return voxel_points, voxel_colors, point_to_voxel, voxel_weights
+
+
+class VoxelPyramid:
+    """
+    Piramide multi-risoluzione di una nuvola di punti.
+
+    Il livello 0 è la nuvola originale; il livello i (i >= 1) è sottocampionato con
+    voxel_sizes[i-1] (in ordine crescente, quindi sempre più grossolano). Ogni livello
+    è costruito dal precedente (pesando i voxel con il numero di punti che rappresentano)
+    su una griglia con la stessa origine: con lati che raddoppiano i voxel sono annidati.
+
+    Parametri:
+        - points: array (N,3)
+        - colors: array (N,3) (opzionale)
+        - voxel_sizes: lati dei voxel dei livelli sottocampionati
+        - labels: array (N,) dell'oggetto di ogni punto (opzionale, ad es. -1 = non
+          annotato): se dato, ogni voxel contiene punti di un solo oggetto
+    """
+
+    def __init__(self, points, colors=None, voxel_sizes=(0.005, 0.01, 0.02, 0.04), labels=None):
+        points = np.asarray(points)
+        self.voxel_sizes = [0.0] + sorted(float(s) for s in voxel_sizes)
+        self._points = [points]
+        self._colors = [None if colors is None else np.asarray(colors)]
+        self._labels = [None if labels is None else np.asarray(labels)]
+        self._weights = [np.ones(len(points))]
+        self._point_to_voxel = [np.arange(len(points))]
+        origin = points.min(axis=0) if len(points) > 0 else np.zeros(3)
+        for size in self.voxel_sizes[1:]:
+            p, c, prev_to_voxel, w = voxel_downsample(self._points[-1], size, self._colors[-1],
+                                                      weights=self._weights[-1], origin=origin,
+                                                      labels=self._labels[-1])
+            voxel_labels = None
+            if labels is not None:
+                # tutti i punti di un voxel hanno la stessa label
+                voxel_labels = np.empty(len(p), dtype=self._labels[-1].dtype)
+                voxel_labels[prev_to_voxel] = self._labels[-1]
+            self._points.append(p)
+            self._colors.append(c)
+            self._labels.append(voxel_labels)
+            self._weights.append(w)
+            self._point_to_voxel.append(prev_to_voxel[self._point_to_voxel[-1]])
+
+    def __len__(self):
+        return len(self._points)
+
+    def points(self, level):
+        return self._points[level]
+
+    def colors(self, level):
+        return self._colors[level]
+
+    def labels(self, level):
+        """Oggetto di ogni voxel del livello (None se la piramide è senza label)."""
+        return self._labels[level]
+
+    def weights(self, level):
+        """Numero di punti originali rappresentati da ogni voxel del livello."""
+        return self._weights[level]
+
+    def point_to_voxel(self, level):
+        """Per ogni punto originale, il voxel del livello in cui cade."""
+        return self._point_to_voxel[level]
+
+    def level_for(self, max_voxel_size):
+        """Il livello più grossolano con voxel di lato al più max_voxel_size (0 = risoluzione piena)."""
+        return max(i for i, size in enumerate(self.voxel_sizes) if size <= max_voxel_size)
+
+    def reduce(self, values, level):
+        """Media (float64), sui voxel del livello, di un attributo per punto (array (N,) o (N,d))."""
+        values = np.asarray(values)
+        if level == 0:
+            return values.astype(np.float64)
+        p2v = self._point_to_voxel[level]
+        V = len(self._points[level])
+        counts = np.bincount(p2v, minlength=V)
+        if values.ndim == 1:
+            return np.bincount(p2v, weights=values, minlength=V) / counts
+        return segment_sums(values, p2v, V) / counts[:, None]
+
+    def object_indices(self, indices, offsets, level):
+        """
+        Traduce un indice CSR di oggetti (ad es. AnnotationIndex.subset) nei voxel del livello:
+        l'oggetto i diventa l'insieme (senza ripetizioni, ordinato) dei voxel che contengono
+        i suoi punti. Serve una piramide costruita con le label degli oggetti: senza, un
+        voxel può mediare punti di oggetti diversi e finirebbe in più oggetti.
+
+        Ritorna:
+            - indices, offsets (formato CSR, come BranchBatch.from_indices)
+        """
+        indices, offsets = np.asarray(indices), np.asarray(offsets)
+        if level == 0:
+            return indices, offsets
+        if self._labels[0] is None:
+            raise ValueError("object_indices richiede una VoxelPyramid costruita con labels")
+        V = len(self._points[level])
+        num_objects = len(offsets) - 1
+        objects = np.repeat(np.arange(num_objects, dtype=np.int64), np.diff(offsets))
+        keys = np.unique(objects * V + self._point_to_voxel[level][indices])
+        counts = np.bincount(keys // V, minlength=num_objects)
+        return keys % V, np.concatenate(([0], np.cumsum(counts)))
@@ -0,0 +1,397 @@
+import numpy as np
+
+import pointcloud_preprocessor as pcpp
+import instrumentation
+
+# =========================================================
+# Indici spaziali: voxel hash sui punti e indice dei segmenti dei tronchi
+# =========================================================
+
+# L'inclinazione di un ramo andrebbe misurata rispetto al tratto di tronco da cui parte,
+# non rispetto all'asse globale del tronco (vedi il FIXME che c'era in main.py). Per
+# trovarlo, scorrere tutti i punti (o tutti i segmenti) dei tronchi per ogni ramo è
+# O(rami * punti): su un filare con tanti tronchi diventa il collo di bottiglia.
+#
+# VoxelHash divide lo spazio in cubetti (voxel) di lato voxel_size e ordina i punti per
+# voxel: i punti di un voxel sono un intervallo contiguo, che si trova con una
+# searchsorted sulle chiavi dei voxel. Una query guarda solo i voxel vicini al punto
+# cercato, ed è vettorizzata su tutte le query insieme.
+#
+# SegmentIndex usa un VoxelHash sui punti medi dei segmenti delle polilinee dei tronchi:
+# - il punto medio del segmento più vicino dista D dalla query, quindi il segmento più
+#   vicino dista al più D
+# - un segmento di semilunghezza h con punto medio a distanza d dista almeno d - h
+# => basta guardare i segmenti con punto medio entro D + h_max e prendere il più vicino.
+#
+# Il cubo di voxel esplorato attorno a una query ha (2*reach+1)^3 celle: per query lontane
+# dalla nuvola (o raggi molto più grandi del voxel) diventerebbe enorme. Oltre _MAX_REACH
+# voxel si scorrono invece i soli voxel occupati, tenendo quelli la cui distanza minima
+# dalla query (distanza dal cubetto del voxel) è entro il raggio: costo proporzionale al
+# numero di voxel occupati, indipendente dalla distanza della query.
+
+# numero massimo di coppie (query, voxel) elaborate in un colpo solo
+_MAX_PAIRS = 1 << 22
+# ampiezza massima (in voxel, per lato) del cubo esplorato attorno a una query: 17^3 celle
+_MAX_REACH = 8
+
+
+def _with_slack(radius):
+    return radius * (1 + 1e-9) + 1e-12
+
+
+class VoxelHash:
+    """
+    Hash a griglia regolare di una nuvola di punti.
+
+    Parametri:
+        - points: array (N,3)
+        - voxel_size: lato dei voxel; conviene dell'ordine del raggio tipico delle query
+    """
+
+    def __init__(self, points, voxel_size):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        self.voxel_size = float(voxel_size)
+        if not self.voxel_size > 0:
+            raise ValueError("voxel_size deve essere positivo")
+        self.origin = self.points.min(axis=0) if len(self.points) > 0 else np.zeros(3)
+        coords = self._coords(self.points)
+        self.dims = coords.max(axis=0) + 1 if len(coords) > 0 else np.ones(3, dtype=np.int64)
+
+        keys = self._keys(coords)
+        # i punti ordinati per voxel: ogni voxel occupa l'intervallo
+        # order[starts[v]:starts[v]+counts[v]]
+        self.order = np.argsort(keys, kind="stable")
+        self.voxel_keys, self.starts, self.counts = np.unique(keys[self.order], return_index=True, return_counts=True)
+        # angolo minimo di ogni voxel occupato, per coordinata (3,V) (per le query lontane,
+        # vedi _candidates_far)
+        voxel_coords = np.stack((self.voxel_keys // (self.dims[1] * self.dims[2]),
+                                 (self.voxel_keys // self.dims[2]) % self.dims[1],
+                                 self.voxel_keys % self.dims[2]))
+        self.voxel_corners = self.origin[:, None] + voxel_coords * self.voxel_size
+
+    def __len__(self):
+        return len(self.points)
+
+    def _coords(self, points):
+        return np.floor((points - self.origin) / self.voxel_size).astype(np.int64)
+
+    def _keys(self, coords):
+        """Chiave intera di ogni voxel; -1 per i voxel fuori dalla griglia (sicuramente vuoti)."""
+        inside = np.all((coords >= 0) & (coords < self.dims), axis=-1)
+        keys = (coords[..., 0] * self.dims[1] + coords[..., 1]) * self.dims[2] + coords[..., 2]
+        return np.where(inside, keys, -1)
+
+    def _expand(self, query_ids, voxels):
+        """Coppie (query, punto) per tutti i punti delle coppie (query, voxel occupato) date."""
+        counts = self.counts[voxels]
+        # espansione degli intervalli [start, start+count) in un unico array di posizioni
+        total = int(counts.sum())
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        ranks = np.arange(total) - first + np.repeat(self.starts[voxels], counts)
+        return np.repeat(query_ids, counts), self.order[ranks]
+
+    def _candidates(self, queries, reach):
+        """
+        Coppie (query, punto) per tutti i punti nei voxel entro reach voxel (in ogni
+        direzione) da quello di ogni query. Le coppie sono ordinate per query.
+        """
+        steps = np.arange(-reach, reach + 1)
+        cube = np.stack(np.meshgrid(steps, steps, steps, indexing="ij"), axis=-1).reshape(-1, 3)
+        block = max(1, _MAX_PAIRS // len(cube))
+        query_ids, point_ids = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        if len(self.voxel_keys) == 0:
+            return query_ids[0], point_ids[0]
+        for start in range(0, len(queries), block):
+            q = queries[start:start+block]
+            keys = self._keys(self._coords(q)[:, None, :] + cube[None]).ravel()
+            pos = np.searchsorted(self.voxel_keys, keys)
+            pos = np.minimum(pos, len(self.voxel_keys) - 1)
+            found = np.flatnonzero((keys >= 0) & (self.voxel_keys[pos] == keys))
+            qid, pid = self._expand(start + found // len(cube), pos[found])
+            query_ids.append(qid)
+            point_ids.append(pid)
+        return np.concatenate(query_ids), np.concatenate(point_ids)
+
+    def _voxel_distances2(self, queries):
+        """Quadrato della distanza minima (Q,V) di ogni query dal cubetto di ogni voxel occupato."""
+        d2 = np.zeros((len(queries), len(self.voxel_keys)))
+        gap = np.empty_like(d2)
+        for a in range(3):
+            # distanza lungo l'asse a: max(angolo - q, q - (angolo + lato), 0)
+            corners = self.voxel_corners[a]
+            np.subtract(corners[None, :], queries[:, None, a], out=gap)
+            np.maximum(gap, -gap - self.voxel_size, out=gap)
+            np.maximum(gap, 0.0, out=gap)
+            d2 += gap * gap
+        return d2
+
+    def _candidates_far(self, queries, radius):
+        """
+        Come _candidates, ma per i punti dei voxel occupati a distanza al più radius (Q,)
+        da ogni query: si scorrono i voxel occupati invece del cubo attorno alla query.
+        """
+        block = max(1, _MAX_PAIRS // max(1, len(self.voxel_keys)))
+        query_ids, point_ids = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for start in range(0, len(queries), block):
+            d2 = self._voxel_distances2(queries[start:start+block])
+            qid, voxels = np.nonzero(d2 <= radius[start:start+block, None]**2)
+            qid, pid = self._expand(start + qid, voxels)
+            query_ids.append(qid)
+            point_ids.append(pid)
+        return np.concatenate(query_ids), np.concatenate(point_ids)
+
+    def _closest_voxel_points(self, queries):
+        """
+        Per ogni query, un punto del voxel occupato più vicino: la sua distanza è un limite
+        superiore della distanza dal punto più vicino.
+        """
+        block = max(1, _MAX_PAIRS // max(1, len(self.voxel_keys)))
+        voxels = np.empty(len(queries), dtype=np.int64)
+        for start in range(0, len(queries), block):
+            voxels[start:start+block] = np.argmin(self._voxel_distances2(queries[start:start+block]), axis=1)
+        return self.order[self.starts[voxels]]
+
+    def query_radius(self, queries, radius):
+        """
+        Punti entro radius da ogni query.
+
+        Parametri:
+            - queries: array (Q,3)
+            - radius: raggio, scalare oppure array (Q,)
+
+        Ritorna:
+            - indices, offsets (formato CSR): i punti vicini alla query q sono
+              indices[offsets[q]:offsets[q+1]], in ordine crescente di indice
+        """
+        queries = np.asarray(queries, dtype=np.float64).reshape(-1, 3)
+        radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), (len(queries),))
+        # le query si raggruppano per ampiezza del cubo da esplorare: una query con raggio
+        # grande non deve allargare la ricerca di tutte le altre
+        reaches = np.ceil(radius / self.voxel_size).astype(np.int64)
+        qid, pid = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for reach in np.unique(reaches):
+            sel = np.flatnonzero(reaches == reach)
+            if reach > _MAX_REACH:
+                # tutte le query con un cubo troppo grande in un colpo solo
+                sel = np.flatnonzero(reaches > _MAX_REACH)
+                q, p = self._candidates_far(queries[sel], radius[sel])
+                qid.append(sel[q])
+                pid.append(p)
+                break
+            q, p = self._candidates(queries[sel], int(reach))
+            qid.append(sel[q])
+            pid.append(p)
+        qid, pid = np.concatenate(qid), np.concatenate(pid)
+        d2 = np.sum((self.points[pid] - queries[qid])**2, axis=1)
+        keep = d2 <= radius[qid]**2
+        qid, pid = qid[keep], pid[keep]
+        order = np.lexsort((pid, qid))
+        counts = np.bincount(qid, minlength=len(queries))
+        return pid[order], np.concatenate(([0], np.cumsum(counts)))
+
+    def nearest(self, queries):
+        """
+        Punto più vicino a ogni query.
+
+        Ritorna:
+            - indices: array (Q,) (-1 se la nuvola è vuota)
+            - distances: array (Q,) (inf se la nuvola è vuota)
+        """
+        queries = np.asarray(queries, dtype=np.float64).reshape(-1, 3)
+        indices = np.full(len(queries), -1, dtype=np.int64)
+        distances = np.full(len(queries), np.inf)
+        if len(self.points) == 0:
+            return indices, distances
+
+        # 1. si allarga il cubo di ricerca (raddoppiando) finché ogni query trova un candidato
+        pending = np.flatnonzero(np.all(np.isfinite(queries), axis=1))
+        # oltre questo raggio il cubo copre tutta la griglia
+        coords = self._coords(queries[pending])
+        max_reach = int(np.max(np.maximum(np.abs(coords), np.abs(coords - self.dims)))) if len(pending) > 0 else 0
+        max_reach = min(max_reach, _MAX_REACH)
+        reach = 0
+        while len(pending) > 0:
+            qid, pid = self._candidates(queries[pending], reach)
+            d = np.linalg.norm(self.points[pid] - queries[pending][qid], axis=1)
+            has = np.bincount(qid, minlength=len(pending)) > 0
+            best = np.full(len(pending), np.inf)
+            np.minimum.at(best, qid, d)
+            distances[pending[has]] = best[has]
+            pending = pending[~has]
+            if reach >= max_reach:
+                break
+            reach = min(max(1, 2 * reach), max_reach)
+        # query rimaste senza candidati (lontane dalla nuvola): un punto del voxel occupato più vicino
+        if len(pending) > 0:
+            candidates = self._closest_voxel_points(queries[pending])
+            distances[pending] = np.linalg.norm(self.points[candidates] - queries[pending], axis=1)
+
+        # 2. il candidato trovato non è per forza il più vicino (può essercene uno più vicino
+        # in un voxel fuori dal cubo): si ripete la ricerca con raggio pari alla sua distanza
+        # (con un minimo di tolleranza, così il candidato stesso non viene perso per arrotondamento)
+        found = np.flatnonzero(np.isfinite(distances))
+        idx, offsets = self.query_radius(queries[found], _with_slack(distances[found]))
+        qid = np.repeat(np.arange(len(found)), np.diff(offsets))
+        d = np.linalg.norm(self.points[idx] - queries[found][qid], axis=1)
+        order = np.lexsort((d, qid))
+        first = order[offsets[:-1]]
+        indices[found[qid[first]]] = idx[first]
+        distances[found[qid[first]]] = d[first]
+        return indices, distances
+
+
+def point_segment_distances(points, starts, ends):
+    """
+    Distanza di ogni punto dal segmento corrispondente (righe allineate).
+
+    Ritorna:
+        - distances: array (M,)
+        - feet: array (M,3), punto del segmento più vicino
+        - t: array (M,), posizione del piede lungo il segmento (0 = inizio, 1 = fine)
+    """
+    direction = ends - starts
+    length2 = np.einsum("ij,ij->i", direction, direction)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.einsum("ij,ij->i", points - starts, direction) / length2
+    t = np.clip(np.where(length2 > 0, t, 0.0), 0.0, 1.0)
+    feet = starts + t[:, None] * direction
+    return np.linalg.norm(points - feet, axis=1), feet, t
+
+
+class SegmentIndex:
+    """
+    Indice spaziale dei segmenti di una o più polilinee (ad es. i tronchi).
+
+    Parametri:
+        - starts, ends: array (S,3) con gli estremi dei segmenti
+        - polyline: array (S,) con la polilinea di appartenenza di ogni segmento (opzionale)
+        - segment: array (S,) con la posizione del segmento nella sua polilinea (opzionale)
+    """
+
+    def __init__(self, starts, ends, polyline=None, segment=None):
+        self.starts = np.asarray(starts, dtype=np.float64).reshape(-1, 3)
+        self.ends = np.asarray(ends, dtype=np.float64).reshape(-1, 3)
+        S = len(self.starts)
+        self.polyline = np.zeros(S, dtype=np.int64) if polyline is None else np.asarray(polyline, dtype=np.int64)
+        self.segment = np.arange(S, dtype=np.int64) if segment is None else np.asarray(segment, dtype=np.int64)
+        self.midpoints = (self.starts + self.ends) / 2
+        half_lengths = np.linalg.norm(self.ends - self.starts, axis=1) / 2
+        self.max_half_length = float(half_lengths.max()) if S > 0 else 0.0
+        self._hash = VoxelHash(self.midpoints, voxel_size=max(2 * self.max_half_length, 1e-6))
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def from_polylines(cls, polylines):
+        """Costruisce l'indice da una lista di polilinee (array (n_i,3) di vertici, ad es. i centers)."""
+        starts, ends, owner, position = [], [], [], []
+        for p, vertices in enumerate(polylines):
+            vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+            if len(vertices) < 2:
+                continue
+            starts.append(vertices[:-1])
+            ends.append(vertices[1:])
+            owner.append(np.full(len(vertices) - 1, p))
+            position.append(np.arange(len(vertices) - 1))
+        if not starts:
+            return cls(np.zeros((0, 3)), np.zeros((0, 3)), np.zeros(0), np.zeros(0))
+        return cls(np.concatenate(starts), np.concatenate(ends), np.concatenate(owner), np.concatenate(position))
+
+    def directions(self, segments):
+        """Direzioni (normalizzate) dei segmenti dati."""
+        d = self.ends[segments] - self.starts[segments]
+        return d / np.linalg.norm(d, axis=1, keepdims=True)
+
+    def nearest(self, queries):
+        """
+        Segmento più vicino a ogni query.
+
+        Ritorna:
+            - segments: array (Q,) con l'indice del segmento (-1 se l'indice è vuoto o la query non è finita)
+            - distances: array (Q,)
+            - feet: array (Q,3), punto del segmento più vicino alla query
+        """
+        queries = np.asarray(queries, dtype=np.float64).reshape(-1, 3)
+        segments = np.full(len(queries), -1, dtype=np.int64)
+        distances = np.full(len(queries), np.inf)
+        feet = np.full((len(queries), 3), np.nan)
+        _, mid_dist = self._hash.nearest(queries)
+        found = np.flatnonzero(np.isfinite(mid_dist))
+        if len(found) == 0:
+            return segments, distances, feet
+
+        idx, offsets = self._hash.query_radius(queries[found], _with_slack(mid_dist[found] + self.max_half_length))
+        qid = np.repeat(np.arange(len(found)), np.diff(offsets))
+        d, f, _ = point_segment_distances(queries[found][qid], self.starts[idx], self.ends[idx])
+        order = np.lexsort((d, qid))
+        # ogni query ha almeno un candidato: il segmento del punto medio più vicino
+        first = order[offsets[:-1]]
+        segments[found] = idx[first]
+        distances[found] = d[first]
+        feet[found] = f[first]
+        return segments, distances, feet
+
+    def query_radius(self, queries, radius):
+        """
+        Segmenti a distanza al più radius da ogni query.
+
+        Ritorna:
+            - indices, offsets (formato CSR, come VoxelHash.query_radius)
+        """
+        queries = np.asarray(queries, dtype=np.float64).reshape(-1, 3)
+        radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), (len(queries),))
+        idx, offsets = self._hash.query_radius(queries, radius + self.max_half_length)
+        qid = np.repeat(np.arange(len(queries)), np.diff(offsets))
+        d, _, _ = point_segment_distances(queries[qid], self.starts[idx], self.ends[idx])
+        keep = d <= radius[qid]
+        counts = np.bincount(qid[keep], minlength=len(queries))
+        return idx[keep], np.concatenate(([0], np.cumsum(counts)))
+
+
+@instrumentation.timed()
+def attach_trunk_segments(table, trunk_index):
+    """
+    Aggancia ogni ramo della tabella (vedi BranchBatch.compute) al segmento di tronco più
+    vicino e ricalcola l'inclinazione rispetto alla direzione locale del tronco.
+
+    La base del ramo è l'estremo della sua polilinea (primo o ultimo centroide) più vicino
+    a un tronco. La tabella viene aggiornata sul posto con le colonne:
+        - trunk_polyline, trunk_segment: polilinea e segmento del tronco più vicino (-1 se nessuno)
+        - insertion_point: punto del tronco più vicino alla base del ramo
+        - local_tree_dir: direzione del segmento di tronco
+        - inclination_angle: angolo tra il ramo e local_tree_dir (invariato per i rami
+          senza tronco vicino)
+
+    Ritorna:
+        - la tabella
+    """
+    B = len(table["valid"])
+    table["trunk_polyline"] = np.full(B, -1, dtype=np.int64)
+    table["trunk_segment"] = np.full(B, -1, dtype=np.int64)
+    table["insertion_point"] = np.full((B, 3), np.nan)
+    table["local_tree_dir"] = np.full((B, 3), np.nan)
+    branches = np.flatnonzero(table["valid"])
+    if len(branches) == 0 or len(trunk_index) == 0:
+        return table
+
+    offsets = table["segment_offsets"]
+    ends = np.concatenate((table["segment_centers"][offsets[branches]],
+                           table["segment_centers"][offsets[branches + 1] - 1]))
+    segments, distances, feet = trunk_index.nearest(ends)
+    n = len(branches)
+    # per ogni ramo, l'estremo più vicino al tronco
+    use_last = distances[n:] < distances[:n]
+    pick = np.where(use_last, np.arange(n) + n, np.arange(n))
+    segments, feet = segments[pick], feet[pick]
+    ok = segments >= 0
+    branches, segments, feet = branches[ok], segments[ok], feet[ok]
+
+    local_dir = trunk_index.directions(segments)
+    table["trunk_polyline"][branches] = trunk_index.polyline[segments]
+    table["trunk_segment"][branches] = trunk_index.segment[segments]
+    table["insertion_point"][branches] = feet
+    table["local_tree_dir"][branches] = local_dir
+    table["inclination_angle"][branches] = pcpp.inclination_angles(
+        table["principal_component"][branches], local_dir)
+    return table
@@ -0,0 +1,194 @@
+import numpy as np
+
+import pointcloud_preprocessor as pcpp
+import pcd_cache
+import instrumentation
+
+# =========================================================
+# Elaborazione in streaming di pointcloud più grandi della RAM
+# =========================================================
+
+# main.py e BranchBatch assumono che tutta la nuvola stia in memoria. Per le scansioni
+# di un intero campo non è così: qui il PCD viene letto a blocchi di dimensione fissa e
+# ogni punto annotato viene smistato all'accumulatore del suo oggetto.
+#
+# Le feature dipendono solo da statistiche "sufficienti" e combinabili (mergeable):
+#   - numero di punti n
+#   - somma dei punti  S  = sum(p)
+#   - somma dei prodotti esterni  Q = sum(p p^T)
+# da cui media = S/n e covarianza = (Q - n*media*media^T) / (n-1).
+# Due accumulatori si uniscono semplicemente sommando n, S e Q.
+#
+# Servono tre passate sul file, perché ogni passata dipende dalla precedente:
+#   1. momenti per oggetto -> centro e asse principale (PCA)
+#   2. minimo/massimo delle proiezioni sull'asse -> estremi dei segmenti
+#   3. momenti (e somma dei colori) per segmento -> diametri, centroidi, colori medi
+#      dei rami e centroidi dei segmenti dei tronchi, cioè le polilinee dei tronchi a
+#      cui agganciare i rami (come analysis.approximate_trees in memoria)
+# In memoria c'è sempre al più un blocco più gli accumulatori per oggetto/segmento.
+
+
+class MomentAccumulator:
+    """
+    Statistiche sufficienti (n, somma, somma dei prodotti esterni) per num_groups gruppi.
+
+    Parametri:
+        - num_groups: numero di gruppi (oggetti o segmenti)
+        - shift: punto sottratto ai valori prima di accumularli, per limitare la
+          cancellazione numerica quando le coordinate sono lontane dall'origine
+    """
+
+    def __init__(self, num_groups, shift=None):
+        self.num_groups = num_groups
+        self.shift = np.zeros(3) if shift is None else np.asarray(shift, dtype=np.float64)
+        self.counts = np.zeros(num_groups, dtype=np.int64)
+        self.sums = np.zeros((num_groups, 3))
+        self.outer = np.zeros((num_groups, 3, 3))
+
+    def add(self, values, groups):
+        """Aggiunge i punti values (n,3), ognuno nel suo gruppo groups (n,)."""
+        counts, sums, outer = pcpp.segment_moments(values - self.shift, groups, self.num_groups)
+        self.counts += counts
+        self.sums += sums
+        self.outer += outer
+
+    def merge(self, other):
+        """Unisce un altro accumulatore (con lo stesso shift) in questo."""
+        if not np.array_equal(self.shift, other.shift):
+            raise ValueError("non si possono unire accumulatori con shift diversi")
+        self.counts += other.counts
+        self.sums += other.sums
+        self.outer += other.outer
+        return self
+
+    def covariance(self):
+        """
+        Ritorna:
+            - means: array (num_groups,3) dei centroidi (nelle coordinate originali)
+            - cov: array (num_groups,3,3) delle covarianze (NaN per gruppi con meno di 2 punti)
+        """
+        means, cov = pcpp.covariance_from_moments(self.counts, self.sums, self.outer)
+        return means + self.shift, cov
+
+
+def _routed_chunks(pcd_path, sorted_points, sorted_labels, chunk_size, cache_path):
+    """
+    Legge il PCD a blocchi e per ogni blocco ritorna solo i punti annotati, con la loro label.
+    sorted_points contiene gli indici annotati in ordine crescente, quindi i punti di un
+    blocco [start, end) si trovano con due ricerche binarie.
+    """
+    for start, xyz, rgb in pcd_cache.iter_point_chunks(pcd_path, chunk_size, cache_path):
+        lo, hi = np.searchsorted(sorted_points, [start, start + len(xyz)])
+        local = sorted_points[lo:hi] - start
+        # formato compatto (float32/uint8): la conversione a float64 avviene nell'accumulo
+        yield xyz[local], None if rgb is None else rgb[local], sorted_labels[lo:hi]
+
+
+@instrumentation.timed()
+def stream_branch_features(pcd_path, index, branch_objects, tree_objects=(), tree_dir=None,
+                           chunk_size=1_000_000, num_segments=pcpp.k, cache_path=None):
+    """
+    Calcola le feature dei rami leggendo il PCD a blocchi.
+
+    Parametri:
+        - pcd_path: percorso del file .pcd
+        - index: AnnotationIndex delle annotazioni della scansione
+        - branch_objects: posizioni (nell'indice) degli oggetti ramo
+        - tree_objects: posizioni degli oggetti tronco; se tree_dir non è dato, si usa
+          l'asse dell'ultimo tronco approssimabile (come in main.py)
+        - tree_dir: principal component del tronco (opzionale)
+        - chunk_size: numero di punti letti per blocco
+        - num_segments: numero di intervalli per ramo (come k)
+        - cache_path: cache binaria da usare, se valida, al posto del testo
+
+    Ritorna:
+        - la tabella colonnare delle feature dei rami (stesso formato di BranchBatch.compute)
+        - tree_dir usato per le inclinazioni
+        - trees: polilinee dei tronchi con almeno due segmenti non vuoti, nel formato di
+          analysis.approximate_trees ({"object", "principal_component", "centers"})
+    """
+    branch_objects = np.asarray(branch_objects, dtype=np.int64)
+    tree_objects = np.asarray(tree_objects, dtype=np.int64)
+    objects = np.concatenate((branch_objects, tree_objects))
+    B, G, ks = len(branch_objects), len(objects), num_segments
+
+    # smistamento: per ogni punto annotato, l'oggetto (tra quelli richiesti) a cui appartiene.
+    # I rami vengono per primi, quindi label < B <=> il punto è di un ramo
+    indices, offsets = index.subset(objects)
+    labels = np.repeat(np.arange(G), np.diff(offsets))
+    order = np.argsort(indices, kind="stable")
+    sorted_points, sorted_labels = indices[order], labels[order]
+
+    def chunks():
+        return _routed_chunks(pcd_path, sorted_points, sorted_labels, chunk_size, cache_path)
+
+    # ------------------------------
+    # 1. PCA DI OGNI OGGETTO
+    # ------------------------------
+    with instrumentation.stage("stream_pass_moments"):
+        objects_acc = None
+        for xyz, _, lab in chunks():
+            if objects_acc is None:
+                if len(xyz) == 0:
+                    continue
+                objects_acc = MomentAccumulator(G, shift=xyz.mean(axis=0))
+            objects_acc.add(xyz, lab)
+    if objects_acc is None:
+        objects_acc = MomentAccumulator(G)
+    shift = objects_acc.shift
+    centers, cov = objects_acc.covariance()
+    axes = pcpp.principal_axes(cov)
+
+    # ------------------------------
+    # 2. ESTREMI DELLE PROIEZIONI
+    # ------------------------------
+    proj_min = np.full(G, np.inf)
+    proj_max = np.full(G, -np.inf)
+    with instrumentation.stage("stream_pass_projections"):
+        for xyz, _, lab in chunks():
+            proj = np.einsum("ij,ij->i", xyz - centers[lab], axes[lab])
+            with np.errstate(invalid="ignore"):
+                np.minimum.at(proj_min, lab, proj)
+                np.maximum.at(proj_max, lab, proj)
+
+    # ------------------------------
+    # 3. STATISTICHE PER SEGMENTO
+    # ------------------------------
+    # i segmenti di tutti gli oggetti (rami e tronchi) stanno in un solo accumulatore: i
+    # primi B*ks sono dei rami, gli altri dei tronchi (di cui servono solo i centroidi)
+    segments_acc = MomentAccumulator(G*ks, shift=shift)
+    color_sums = np.zeros((B*ks, 3))
+    has_colors = False
+    with instrumentation.stage("stream_pass_segments"):
+        for xyz, colors, lab in chunks():
+            proj = np.einsum("ij,ij->i", xyz - centers[lab], axes[lab])
+            bins = pcpp.assign_segments(proj, lab, proj_min, proj_max, ks)
+            in_segment = bins < ks
+            seg_ids = lab[in_segment] * ks + bins[in_segment]
+            segments_acc.add(xyz[in_segment], seg_ids)
+            if colors is not None:
+                has_colors = True
+                is_branch = seg_ids < B*ks
+                color_sums += pcpp.segment_sums(colors[in_segment][is_branch], seg_ids[is_branch],
+                                                B*ks) * pcpp.color_scale(colors)
+
+    seg_means, seg_cov = segments_acc.covariance()
+
+    # polilinee dei tronchi: centroidi dei segmenti non vuoti, in ordine lungo l'asse
+    trees = []
+    for g in range(B, G):
+        tree_counts = segments_acc.counts[g*ks:(g+1)*ks]
+        if np.count_nonzero(tree_counts) < 2:
+            continue
+        trees.append({"object": int(objects[g]), "principal_component": axes[g],
+                      "centers": seg_means[g*ks:(g+1)*ks][tree_counts > 0]})
+    if tree_dir is None:
+        tree_dir = trees[-1]["principal_component"] if trees else np.array([0.0, 0.0, 1.0])
+
+    nonempty = np.flatnonzero(segments_acc.counts[:B*ks])
+    table = pcpp.branch_table_from_moments(
+        objects_acc.counts[:B], centers[:B], axes[:B], proj_min[:B], proj_max[:B],
+        nonempty, segments_acc.counts[nonempty], seg_means[nonempty], seg_cov[nonempty],
+        color_sums[nonempty] if has_colors else None,
+        tree_dir, ks)
+    return table, tree_dir, trees
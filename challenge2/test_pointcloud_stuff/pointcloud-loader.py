@@ -1,11 +1,23 @@
+import os
+import sys
 import open3d as o3d
 import numpy as np
 import matplotlib.pyplot as plt
 
-pcd = o3d.io.read_point_cloud("./pc_color_filtered.pcd")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import pcd_cache
+
+# lettura tramite la cache binaria (il testo viene parsato solo la prima volta)
+xyz, rgb = pcd_cache.load_point_cloud("./pc_color_filtered.pcd")
+pcd = o3d.geometry.PointCloud()
+pcd.points = o3d.utility.Vector3dVector(np.asarray(xyz, dtype=np.float64))
+# rgb è None se il PCD non ha colori
+if rgb is not None:
+    pcd.colors = o3d.utility.Vector3dVector(pcd_cache.rgb_to_float(rgb))
 print(pcd)
 print(np.asarray(pcd.points))  # coordinate XYZ
-print(np.asarray(pcd.colors))  # colori RGB (normalizzati tra 0 e 1)
+if pcd.has_colors():
+    print(np.asarray(pcd.colors))  # colori RGB (normalizzati tra 0 e 1)
 o3d.visualization.draw_geometries([pcd])
 
 # labels = np.asarray(pcd.colors)[:, 0] * 255  # esempio se label codificata in colore
@@ -70,4 +70,146 @@ def lineset_to_cylinders(line_set, radius=0.01, color=[1,0,0]):
         if cyl is not None:
             cylinders.append(cyl)
 
-    return cylinders
\ No newline at end of file
+    return cylinders
+
+# =========================================================
+# Rendering "batch": un'unica mesh per tutti i cilindri (o i piani di taglio)
+# =========================================================
+
+# lineset_to_cylinders crea una TriangleMesh per ogni segmento (con normali, rotazione e
+# traslazione calcolate una per una) e draw_geometries riceve migliaia di geometrie
+# separate: sia la costruzione della scena sia il frame rate del viewer crollano.
+#
+# Qui la mesh "modello" (cilindro di raggio e altezza 1, oppure il box del piano) viene
+# creata una volta sola; per tutti i segmenti insieme si calcolano in forma vettorizzata
+# scala, rotazione (formula di Rodrigues che porta l'asse z sulla direzione del segmento)
+# e traslazione, e i vertici trasformati vengono concatenati in un'unica mesh con i
+# colori per vertice.
+
+_templates = {}
+
+
+def _template(kind, resolution=20):
+    """Vertici e triangoli (numpy) di una mesh modello centrata nell'origine con asse z."""
+    key = (kind, resolution)
+    if key not in _templates:
+        if kind == "cylinder":
+            mesh = o3d.geometry.TriangleMesh.create_cylinder(radius=1.0, height=1.0, resolution=resolution, split=4)
+        else:
+            mesh = o3d.geometry.TriangleMesh.create_box(width=1.0, height=1.0, depth=1.0)
+        vertices = np.asarray(mesh.vertices)
+        vertices = vertices - (vertices.min(axis=0) + vertices.max(axis=0)) / 2
+        _templates[key] = (vertices, np.asarray(mesh.triangles))
+    return _templates[key]
+
+
+def rotations_from_z(directions):
+    """
+    Matrici di rotazione (M,3,3) che portano l'asse z sulle direzioni date (M,3), normalizzate.
+    Stessa costruzione di line_to_cylinder, ma per tutte le direzioni insieme.
+    """
+    v = directions / np.linalg.norm(directions, axis=1, keepdims=True)
+    c = v[:, 2]  # z · v
+    # z x v = (-v_y, v_x, 0)
+    vx = np.zeros((len(v), 3, 3))
+    vx[:, 0, 2] = v[:, 0]
+    vx[:, 1, 2] = v[:, 1]
+    vx[:, 2, 0] = -v[:, 0]
+    vx[:, 2, 1] = -v[:, 1]
+    s2 = v[:, 0]**2 + v[:, 1]**2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        factor = np.where(s2 > 1e-12, (1 - c) / s2, 0.0)
+    R = np.eye(3) + vx + (vx @ vx) * factor[:, None, None]
+    # direzioni (quasi) opposte a z: rotazione di pi attorno all'asse x
+    R[(s2 <= 1e-12) & (c < 0)] = np.diag([1.0, -1.0, -1.0])
+    return R
+
+
+def _merged_mesh(template, scales, rotations, translations, colors):
+    vertices, triangles = template
+    M = len(translations)
+    all_vertices = np.einsum("mij,mvj->mvi", rotations, vertices[None] * scales[:, None, :]) + translations[:, None, :]
+    all_triangles = triangles[None] + (np.arange(M) * len(vertices))[:, None, None]
+    all_colors = np.broadcast_to(np.clip(colors, 0.0, 1.0)[:, None, :], (M, len(vertices), 3))
+
+    mesh = o3d.geometry.TriangleMesh()
+    mesh.vertices = o3d.utility.Vector3dVector(all_vertices.reshape(-1, 3))
+    mesh.triangles = o3d.utility.Vector3iVector(all_triangles.reshape(-1, 3).astype(np.int32))
+    mesh.vertex_colors = o3d.utility.Vector3dVector(all_colors.reshape(-1, 3))
+    mesh.compute_vertex_normals()
+    return mesh
+
+
+def segments_to_mesh(starts, ends, radius=0.01, colors=[1,0,1], resolution=20):
+    """
+    Un'unica TriangleMesh con un cilindro per ogni segmento (come line_to_cylinder).
+
+    Parametri:
+        - starts, ends: array (S,3) con gli estremi dei segmenti
+        - radius: raggio, scalare oppure uno per segmento (S,)
+        - colors: colore RGB in [0,1], unico (3,) oppure uno per segmento (S,3)
+        - resolution: numero di lati dei cilindri
+
+    I segmenti di lunghezza nulla vengono saltati.
+    """
+    starts = np.asarray(starts, dtype=float).reshape(-1, 3)
+    ends = np.asarray(ends, dtype=float).reshape(-1, 3)
+    S = len(starts)
+    radius = np.broadcast_to(np.asarray(radius, dtype=float), (S,))
+    colors = np.broadcast_to(np.asarray(colors, dtype=float), (S, 3))
+    vec = ends - starts
+    length = np.linalg.norm(vec, axis=1)
+    keep = length > 0
+    vec, length, radius, colors = vec[keep], length[keep], radius[keep], colors[keep]
+    midpoints = (starts[keep] + ends[keep]) / 2
+    scales = np.stack((radius, radius, length), axis=1)
+    return _merged_mesh(_template("cylinder", resolution), scales, rotations_from_z(vec), midpoints, colors)
+
+
+def linesets_to_mesh(line_sets, radius=0.01, color=[1,0,0], resolution=20):
+    """Come lineset_to_cylinders, ma per più LineSet insieme e con un'unica mesh come risultato."""
+    starts, ends = [], []
+    for line_set in line_sets:
+        pts = np.asarray(line_set.points)
+        lines = np.asarray(line_set.lines)
+        if len(lines) == 0:
+            continue
+        starts.append(pts[lines[:, 0]])
+        ends.append(pts[lines[:, 1]])
+    if not starts:
+        return o3d.geometry.TriangleMesh()
+    return segments_to_mesh(np.concatenate(starts), np.concatenate(ends), radius=radius, colors=color,
+                            resolution=resolution)
+
+
+def segments_to_lineset(starts, ends, colors=[0,0,0]):
+    """Un unico LineSet con tutti i segmenti; colors è unico (3,) oppure uno per segmento (S,3)."""
+    starts = np.asarray(starts, dtype=float).reshape(-1, 3)
+    ends = np.asarray(ends, dtype=float).reshape(-1, 3)
+    S = len(starts)
+    line_set = o3d.geometry.LineSet(
+        points=o3d.utility.Vector3dVector(np.concatenate((starts, ends))),
+        lines=o3d.utility.Vector2iVector(np.stack((np.arange(S), np.arange(S) + S), axis=1).astype(np.int32))
+    )
+    line_set.colors = o3d.utility.Vector3dVector(np.broadcast_to(np.asarray(colors, dtype=float), (S, 3)))
+    return line_set
+
+
+def cut_planes_mesh(points, normals, size=0.15, thickness=0.001, colors=[0,0,1]):
+    """
+    Un'unica TriangleMesh con un piano di taglio (box quadrato sottile) per ogni coppia
+    (punto, normale): stessa geometria di create_cut_plane in main.py, per tutti i piani insieme.
+
+    Parametri:
+        - points: array (P,3), centri dei piani
+        - normals: array (P,3), normali dei piani
+        - size: lato dei piani
+        - thickness: spessore lungo la normale
+        - colors: colore unico (3,) oppure uno per piano (P,3)
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    normals = np.asarray(normals, dtype=float).reshape(-1, 3)
+    P = len(points)
+    colors = np.broadcast_to(np.asarray(colors, dtype=float), (P, 3))
+    scales = np.broadcast_to(np.array([size, size, thickness], dtype=float), (P, 3))
+    return _merged_mesh(_template("box"), scales, rotations_from_z(normals), points, colors)